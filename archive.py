@@ -0,0 +1,218 @@
+import os
+import sys
+import time
+import datetime
+import configparser
+import sql_queries
+from sql_queries import (table_definition, songplays_latest_query, songplays_months_query, archive_month_select,
+                         external_schema_create, external_table_exists, archive_table_create, archive_partition_add,
+                         archive_partition_rows, archive_month_delete, songplays_all_view, unload_query_template)
+from incremental import strip_quotes, is_s3
+from instrumentation import run_statement, recorder
+
+ARCHIVE_TABLE = 'songplays_archive'
+# external tables need sized VARCHARs; an unsized VARCHAR is VARCHAR(256)
+DEFAULT_VARCHAR = 'VARCHAR(256)'
+
+
+def archive_options(config):
+    """reads the retention window (months), archive location and Spectrum schema from dwh.cfg"""
+    return {'retention_months': config.getint('ETL', 'ARCHIVE_RETENTION_MONTHS', fallback=6),
+            'location': strip_quotes(config.get('S3', 'ARCHIVE_PREFIX', fallback='')),
+            'schema': config.get('ETL', 'SPECTRUM_SCHEMA', fallback='spectrum'),
+            'database': config.get('ETL', 'SPECTRUM_DATABASE', fallback='sparkify_archive'),
+            'role_arn': config.get('IAM_ROLE', 'ARN', fallback='')}
+
+
+def add_months(value, months):
+    """returns the first day of the month that is months after the month of value"""
+    index = value.year * 12 + value.month - 1 + months
+    return datetime.datetime(index // 12, index % 12 + 1, 1)
+
+
+def archive_cutoff(latest, retention_months):
+    """returns the first start_time kept in songplays
+    The window is counted in whole months back from the newest play, so a month is
+    archived whole once it leaves the window. Plays of it loaded later by an incremental
+    run are added to its partition next to the earlier files (see archive_partition).
+    """
+    return add_months(latest, -retention_months)
+
+
+def partition_location(root, year, month):
+    """returns the year=/month= location of a partition below an S3 prefix or a local directory"""
+    if is_s3(root):
+        return '{}/year={}/month={}/'.format(root.rstrip('/'), year, month)
+    return os.path.join(root, 'year={}'.format(year), 'month={}'.format(month))
+
+
+def plan_partitions(months, root):
+    """returns the partitions to archive
+    Args:
+        months: list of (year, month, rows) older than the cutoff
+        root (string): archive S3 prefix or local directory
+    Return(s):
+        list of dicts with year, month, rows, the month's [start, end) range and its location
+    """
+    plan = []
+    for year, month, rows in months:
+        start = datetime.datetime(year, month, 1)
+        plan.append({'year': year, 'month': month, 'rows': rows, 'start': start, 'end': add_months(start, 1),
+                     'location': partition_location(root, year, month)})
+    return plan
+
+
+def archive_columns():
+    """returns [(column, type)] of songplays as created, VARCHARs sized for the external table"""
+    definitions = dict(table_definition(query) for query in sql_queries.create_table_queries)
+    return [(name, DEFAULT_VARCHAR if column_type == 'VARCHAR' else column_type)
+            for name, column_type in definitions['songplays']]
+
+
+def ensure_archive_table(cur, options, columns):
+    """creates the external schema and the partitioned songplays_archive table unless they exist"""
+    run_statement(cur, external_schema_create.format(schema=options['schema'], database=options['database'],
+                                                     role=options['role_arn']),
+                  'archive', step='CREATE EXTERNAL SCHEMA {}'.format(options['schema']))
+    cur.execute(external_table_exists, (options['schema'], ARCHIVE_TABLE))
+    if cur.fetchone()[0]:
+        return
+    run_statement(cur, archive_table_create.format(
+                      schema=options['schema'], location=options['location'].rstrip('/') + '/',
+                      columns=',\n'.join('    {} {}'.format(name, column_type) for name, column_type in columns)),
+                  'archive', step='CREATE EXTERNAL TABLE {}'.format(ARCHIVE_TABLE))
+
+
+def archive_partition(cur, options, names, partition, run):
+    """UNLOADs one month, registers its partition and deletes the month from songplays
+    The files are named after the run, so late rows of a month archived before are
+    added next to its earlier files rather than overwriting them. The rows are only
+    deleted when the partition reads back its earlier count plus the rows unloaded,
+    and their plays are taken off the summary counts in the same transaction.
+    Return(s):
+        True when the month was moved
+    """
+    started = time.time()
+    label = 'songplays {}-{:02d}'.format(partition['year'], partition['month'])
+    rows_query = archive_partition_rows.format(schema=options['schema'], year=partition['year'],
+                                               month=partition['month'])
+    cur.execute(rows_query)
+    expected = cur.fetchone()[0] + partition['rows']
+    select = archive_month_select.format(columns=names, start=partition['start'], end=partition['end'])
+    run_statement(cur, unload_query_template.format(select.replace("'", "''"), partition['location'] + run + '_',
+                                                    options['role_arn']),
+                  'archive', step='UNLOAD {}'.format(label))
+    run_statement(cur, archive_partition_add.format(schema=options['schema'], year=partition['year'],
+                                                    month=partition['month'], location=partition['location']),
+                  'archive', step='ADD PARTITION {}'.format(label))
+    cur.execute(rows_query)
+    archived = cur.fetchone()[0]
+    if archived != expected:
+        print("{}: expected {} rows in {} but found {}, rows kept".format(label, expected, partition['location'],
+                                                                       archived))
+        recorder.record('archive', label, time.time() - started, archived, status='mismatch',
+                        expected=expected, location=partition['location'])
+        return False
+    run_statement(cur, archive_month_delete, 'archive', step='DELETE {}'.format(label),
+                  params={'start': partition['start'], 'end': partition['end']})
+    recorder.record('archive', label, time.time() - started, archived, location=partition['location'])
+    return True
+
+
+def archive_songplays(conn, config):
+    """moves songplays months older than the retention window to Parquet on S3
+    Each month is UNLOADed to its own year=/month= prefix, added as a partition of the
+    Spectrum table songplays_archive and deleted from songplays. The songplays_all view
+    unions both, so historical queries still see every play while the reports scan
+    only the hot months. External DDL cannot run inside a transaction block, so the
+    connection is switched to autocommit for the duration.
+    Only incremental loads archive: a full load rebuilds songplays from every source
+    file, so the months archived before would be unloaded into their partitions again.
+    Args:
+        conn: open connection
+        config: config object read from dwh.cfg
+    Return(s):
+        the planned partitions
+    """
+    options = archive_options(config)
+    if config.get('ETL', 'LOAD_MODE', fallback='full') != 'incremental':
+        print("songplays are archived by incremental loads only (load_mode = incremental), not archived")
+        return []
+    if not options['location']:
+        print("no ARCHIVE_PREFIX configured, songplays not archived")
+        return []
+    cur = conn.cursor()
+    cur.execute(songplays_latest_query)
+    latest = cur.fetchone()[0]
+    if latest is None:
+        conn.commit()
+        return []
+    cur.execute(songplays_months_query, (archive_cutoff(latest, options['retention_months']),))
+    plan = plan_partitions(cur.fetchall(), options['location'])
+    conn.commit()
+
+    columns = archive_columns()
+    names = ', '.join(name for name, _ in columns)
+    print("Archiving {} songplays month(s) to {}\n".format(len(plan), options['location']))
+    autocommit = conn.autocommit
+    run = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%d%H%M%S')
+    conn.autocommit = True
+    try:
+        ensure_archive_table(cur, options, columns)
+        for partition in plan:
+            archive_partition(cur, options, names, partition, run)
+        run_statement(cur, songplays_all_view.format(columns=names, schema=options['schema']),
+                      'archive', step='CREATE VIEW songplays_all')
+    finally:
+        conn.autocommit = autocommit
+    return plan
+
+
+def archive_local(songplays, output_dir, retention_months=6):
+    """writes the songplays months older than the retention window to output_dir like the UNLOADs do
+    year and month are encoded in the directory names only, as Spectrum reads them from the path.
+    Args:
+        songplays: pandas frame shaped like songplays (see local_etl.build_songplays)
+        output_dir (string): local stand-in for ARCHIVE_PREFIX
+    Return(s):
+        (plan, songplays frame of the months kept hot)
+    """
+    start_time = songplays['start_time']
+    cutoff = archive_cutoff(start_time.max(), retention_months)
+    old = start_time[start_time < cutoff]
+    months = old.groupby([old.dt.year, old.dt.month]).size()
+    plan = plan_partitions([(int(year), int(month), int(rows)) for (year, month), rows in months.items()], output_dir)
+    for partition in plan:
+        rows = songplays[(start_time >= partition['start']) & (start_time < partition['end'])]
+        os.makedirs(partition['location'], exist_ok=True)
+        rows.to_parquet(os.path.join(partition['location'], '0000_part_00.parquet'), index=False)
+    return plan, songplays[start_time >= cutoff]
+
+
+def print_plan(plan, hot_rows):
+    """prints the archived partitions and the rows left in songplays"""
+    print("{:<10} {:>10}  {}".format('month', 'rows', 'location'))
+    for partition in plan:
+        print("{:<10} {:>10}  {}".format('{}-{:02d}'.format(partition['year'], partition['month']),
+                                         partition['rows'], partition['location']))
+    print("{:<10} {:>10}".format('archived', sum(partition['rows'] for partition in plan)))
+    print("{:<10} {:>10}".format('hot', hot_rows))
+
+
+if __name__ == "__main__":
+    # python archive.py: archive on the cluster configured in dwh.cfg
+    # python archive.py --local <log_data_dir> <song_data_dir> <output_dir> [retention_months]
+    if sys.argv[1:2] == ['--local']:
+        from local_etl import read_staging_events, read_staging_songs, transform
+        songplays = transform(read_staging_events(sys.argv[2]), read_staging_songs(sys.argv[3]))['songplays']
+        plan, hot = archive_local(songplays, sys.argv[4], int(sys.argv[5]) if len(sys.argv) > 5 else 6)
+        print_plan(plan, len(hot))
+    else:
+        from db import connect
+        config = configparser.ConfigParser()
+        config.read('dwh.cfg')
+        conn = connect(config)
+        plan = archive_songplays(conn, config)
+        conn.close()
+        print_plan(plan, '-')
+        recorder.summary()
@@ -0,0 +1,209 @@
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import subprocess
+import importlib.util
+from datagen import generate
+
+# what importing etl used to load for every run, whichever phases it ran
+EAGER_IMPORTS = ['boto3', 'pandas', 'create_resources', 'create_tables', 'incremental', 'validation',
+                 'shutdown_resources', 'scheduler', 'prestage', 'load_quality', 'parquet_stage', 'db',
+                 'summaries', 'maintenance', 'song_matching']
+
+
+def current_commit():
+    """returns the short hash of the checked out commit, used to compare runs across commits"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return 'unknown'
+
+
+def timed(phase, func, results):
+    """runs func, appends (phase, seconds, rows) to results and returns func's result
+    func returns (value, rows processed).
+    """
+    started = time.time()
+    value, rows = func()
+    results.append((phase, time.time() - started, rows))
+    print("{:<12} {:>9.3f}s {:>12} rows".format(phase, results[-1][1], rows))
+    return value
+
+
+def bench_local(data_dir):
+    """runs every phase on the in-process pandas engine (local_etl.py)"""
+    from local_etl import read_staging_events, read_staging_songs, transform, reports
+    results = []
+    timed('create', lambda: (None, 0), results)
+    events, songs = timed('copy', lambda: _staged(read_staging_events(os.path.join(data_dir, 'log_data')),
+                                                    read_staging_songs(os.path.join(data_dir, 'song_data'))), results)
+    tables = timed('insert', lambda: _counted(transform(events, songs)), results)
+    timed('validation', lambda: _counted(reports(tables)), results)
+    return results
+
+
+def _staged(events, songs):
+    return (events, songs), len(events) + len(songs)
+
+
+def _counted(frames):
+    return frames, sum(len(frame) for frame in frames.values())
+
+
+def bench_start_time(data_dir):
+    """times the songplays start_time transform before and after keeping ts native
+    The legacy transform formats every event timestamp as text and parses it back,
+    as to_char/to_timestamp did in songplay_table_insert, and drops milliseconds on the way.
+    """
+    import pandas as pd
+    from local_etl import read_staging_events
+    events = read_staging_events(os.path.join(data_dir, 'log_data'))
+    plays = events.loc[events['page'] == 'NextSong', 'ts'].dropna()
+    results = []
+    legacy = timed('start_legacy', lambda: _start_times(
+        pd.to_datetime(plays.dt.strftime('%Y-%m-%d %H:%M:%S'), format='%Y-%m-%d %H:%M:%S')), results)
+    timed('start_native', lambda: _start_times(plays), results)
+    print("{} of {} plays lose their time match with the legacy transform".format(
+        int((legacy != plays).sum()), len(plays)))
+    return results
+
+
+def _start_times(start_time):
+    return start_time, len(start_time)
+
+
+def bench_startup(repeat=5):
+    """times a validation-only start of etl.py against loading everything the full pipeline imports
+    Each command runs repeat times in a fresh interpreter and the fastest run is kept.
+    """
+    eager = [module for module in EAGER_IMPORTS if importlib.util.find_spec(module)]
+    missing = sorted(set(EAGER_IMPORTS) - set(eager))
+    if missing:
+        print("not installed, left out of startup_eager: {}".format(', '.join(missing)))
+    commands = [('startup_eager', [sys.executable, '-c', 'import ' + ', '.join(eager)]),
+                ('startup_validate', [sys.executable, 'etl.py', 'validate', '--dry-run'])]
+    results = []
+    for phase, command in commands:
+        timings = []
+        for _ in range(repeat):
+            started = time.time()
+            subprocess.check_call(command, stdout=subprocess.DEVNULL)
+            timings.append(time.time() - started)
+        results.append((phase, min(timings), 0))
+        print("{:<16} {:>9.3f}s".format(phase, results[-1][1]))
+    return results
+
+
+def bench_postgres(data_dir, dsn):
+    """runs every phase against a Postgres stand-in reachable through dsn
+    Redshift specific DDL is rewritten with sql_queries.postgres_dialect and the
+    COPY phase streams the local files with COPY FROM STDIN (stream_load.py).
+    """
+    import psycopg2
+    import sql_queries
+    from sql_queries import drop_table_queries, postgres_dialect
+    from incremental import list_source_objects
+    from stream_load import stream_table
+
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+
+    def execute_all(queries):
+        rows = 0
+        for query in queries:
+            cur.execute(postgres_dialect(query))
+            rows += max(cur.rowcount, 0)
+        conn.commit()
+        return None, rows
+
+    def copy():
+        stream_table(cur, 'staging_events', list_source_objects(os.path.join(data_dir, 'log_data')))
+        stream_table(cur, 'staging_songs', list_source_objects(os.path.join(data_dir, 'song_data')))
+        conn.commit()
+        cur.execute("SELECT (SELECT COUNT(*) FROM staging_events) + (SELECT COUNT(*) FROM staging_songs);")
+        return None, cur.fetchone()[0]
+
+    def validate():
+        rows = 0
+        for query in sql_queries.validation_queries:
+            cur.execute(postgres_dialect(query))
+            rows += len(cur.fetchall())
+        conn.commit()
+        return None, rows
+
+    results = []
+    timed('create', lambda: execute_all(drop_table_queries + sql_queries.create_table_queries), results)
+    timed('copy', copy, results)
+    timed('insert', lambda: execute_all(sql_queries.song_key_queries + sql_queries.insert_table_queries), results)
+    timed('validation', validate, results)
+    conn.close()
+    return results
+
+
+def write_results(path, backend, scale, results):
+    """appends one JSON line per phase to the results file"""
+    run = {'commit': current_commit(), 'run_at': datetime.datetime.now(datetime.timezone.utc).isoformat(), 'backend': backend}
+    run.update(scale)
+    with open(path, 'a') as f:
+        for phase, seconds, rows in results:
+            record = dict(run, phase=phase, seconds=round(seconds, 4), rows=rows,
+                          rows_per_sec=round(rows / seconds, 1) if seconds else None)
+            f.write(json.dumps(record) + '\n')
+
+
+def compare(path, last=5):
+    """prints seconds per phase for the last runs recorded in the results file, one column per run"""
+    runs = {}
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            key = (record['run_at'], record['commit'], record['backend'])
+            runs.setdefault(key, {})[record['phase']] = record['seconds']
+    keys = sorted(runs)[-last:]
+    print("{:<16}".format('phase') + ''.join('{:>20}'.format('{} {}'.format(k[1], k[2])[:19]) for k in keys))
+    phases = ['create', 'copy', 'insert', 'validation', 'start_legacy', 'start_native', 'startup_eager',
+              'startup_validate']
+    for phase in [phase for phase in phases if any(phase in runs[k] for k in keys)]:
+        print("{:<16}".format(phase) + ''.join('{:>20}'.format(
+            '{:.3f}'.format(runs[k][phase]) if phase in runs[k] else '-') for k in keys))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='benchmark the pipeline phases on synthetic data')
+    parser.add_argument('--data-dir', help='defaults to a bench_data/ subdirectory named after the scale')
+    parser.add_argument('--backend', choices=['local', 'postgres'], default='local')
+    parser.add_argument('--dsn', help='Postgres connection string for the postgres backend')
+    parser.add_argument('--songs', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--events-per-day', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--artist-skew', type=float, default=1.0)
+    parser.add_argument('--title-skew', type=float, default=1.1)
+    parser.add_argument('--results', default='benchmark_results.jsonl')
+    parser.add_argument('--compare', action='store_true', help='only print the recorded results')
+    parser.add_argument('--start-time', action='store_true',
+                        help='only time the songplays start_time transform, legacy against native')
+    parser.add_argument('--startup', action='store_true',
+                        help='only time a validation-only etl.py start against eagerly importing every phase')
+    args = parser.parse_args()
+
+    if args.startup:
+        write_results(args.results, 'startup', {}, bench_startup())
+    elif not args.compare:
+        scale = {'songs': args.songs, 'users': args.users, 'events_per_day': args.events_per_day,
+                 'days': args.days, 'artist_skew': args.artist_skew, 'title_skew': args.title_skew}
+        data_dir = args.data_dir or os.path.join('bench_data', '_'.join('{}{}'.format(k, v) for k, v in scale.items()))
+        if not os.path.isdir(os.path.join(data_dir, 'log_data')):
+            generate(data_dir, args.songs, None, args.users, args.events_per_day, args.days,
+                     args.artist_skew, args.title_skew)
+        if args.start_time:
+            results = bench_start_time(data_dir)
+        elif args.backend == 'postgres':
+            results = bench_postgres(data_dir, args.dsn)
+        else:
+            results = bench_local(data_dir)
+        write_results(args.results, 'start_time' if args.start_time else args.backend, scale, results)
+    compare(args.results)
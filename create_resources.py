@@ -1,7 +1,12 @@
+import re
 import configparser
-import pandas as pd
-import boto3
+import time
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from wlm import wlm_options, wlm_parameters, PARAMETER_GROUP_FAMILY
+
+progress_lock = threading.Lock()
 
 
 def get_config(filename):
@@ -14,7 +19,7 @@ def get_config(filename):
     """
     config = configparser.ConfigParser()
     try:
-        config.read_file(open('dwh.cfg'))
+        config.read_file(open(filename))
     except Exception as e:
         print(e)
 
@@ -44,6 +49,12 @@ def update_config_file(config_file, section, key, value):
         print(f'ERROR: {e}')
         
 
+def report(message):
+    """default progress callable, prints one message at a time from any thread"""
+    with progress_lock:
+        print(message)
+
+
 def create_iam_role(iam, config):
     """
     Create an IAM role to allow Redshift to access S3.
@@ -89,52 +100,231 @@ def create_iam_role(iam, config):
     return roleArn
 
 
-def create_redshift_cluster(redshift, config, roleArn):
+def describe_cluster(redshift, config):
+    """returns the cluster descriptor of CLUSTER_IDENTIFIER, or None when no such cluster exists"""
+    try:
+        return redshift.describe_clusters(ClusterIdentifier=config['REDSHIFT']['CLUSTER_IDENTIFIER'])['Clusters'][0]
+    except redshift.exceptions.ClusterNotFoundFault:
+        return None
+
+
+def latest_snapshot(redshift, config):
+    """
+    Returns the snapshot to restore a missing cluster from: SNAPSHOT_IDENTIFIER when set,
+    otherwise, with RESTORE_LATEST_SNAPSHOT on, the newest available final snapshot that
+    shutdown_resources took of CLUSTER_IDENTIFIER, or None.
     """
-    Create a Redshfit cluster.
+    snapshot = config.get('REDSHIFT', 'SNAPSHOT_IDENTIFIER', fallback='')
+    if snapshot:
+        return snapshot
+    if not config.getboolean('REDSHIFT', 'RESTORE_LATEST_SNAPSHOT', fallback=False):
+        return None
+    identifier = config['REDSHIFT']['CLUSTER_IDENTIFIER']
+    # named by shutdown_resources.snapshot_name; other manual snapshots are left alone
+    ours = re.compile(r'^{}-\d{{8}}-\d{{6}}$'.format(re.escape(identifier)))
+    snapshots = redshift.describe_cluster_snapshots(ClusterIdentifier=identifier,
+                                                    SnapshotType='manual').get('Snapshots', [])
+    snapshots = [s for s in snapshots if s.get('Status') == 'available' and ours.match(s['SnapshotIdentifier'])]
+    if not snapshots:
+        return None
+    return max(snapshots, key=lambda s: s['SnapshotCreateTime'])['SnapshotIdentifier']
+
+
+def ensure_parameter_group(redshift, config, progress=report):
+    """
+    Creates the WLM parameter group of the [WLM] section unless it exists, and writes
+    its wlm_json_configuration when the stored one differs (see wlm.wlm_configuration).
     Arg(s):
-        redshift: a redshift resource/client
+        redshift: a redshift client
         config: an object that contains necessary information for setting up the cluster
-        roleArn: created to be attached to the cluster
+        progress: callable receiving progress messages
     Return(s):
-        cluster_prop: a cluster descriptor
+        the parameter group name, None when PARAMETER_GROUP is empty
     """
-
+    options = wlm_options(config)
+    name = options['parameter_group']
+    if not name:
+        return None
     try:
-        print('Creating a Redshift Cluster. This might take a few minutes ...')
-        response = redshift.create_cluster(
-            # parameters for hardware
-            ClusterType=config['REDSHIFT']['CLUSTER_TYPE'],
+        redshift.describe_cluster_parameter_groups(ParameterGroupName=name)
+    except redshift.exceptions.ClusterParameterGroupNotFoundFault:
+        progress('Creating parameter group {} ({} WLM)'.format(name, options['mode']))
+        redshift.create_cluster_parameter_group(ParameterGroupName=name,
+                                                ParameterGroupFamily=PARAMETER_GROUP_FAMILY,
+                                                Description='Sparkify ETL and BI workload management')
+    parameters = wlm_parameters(options)
+    current = dict((p['ParameterName'], p.get('ParameterValue'))
+                   for p in redshift.describe_cluster_parameters(ParameterGroupName=name, Source='user')['Parameters'])
+    changed = [p for p in parameters if current.get(p['ParameterName']) != p['ParameterValue']]
+    if changed:
+        progress('Updating {} of parameter group {}'.format(', '.join(p['ParameterName'] for p in changed), name))
+        redshift.modify_cluster_parameter_group(ParameterGroupName=name, Parameters=changed)
+    return name
+
+
+def attach_parameter_group(redshift, config, cluster_props, parameter_group, progress=report):
+    """
+    Switches a reused cluster to parameter_group unless it already uses it. Redshift
+    applies a new parameter group at the next reboot, which is reported, not forced.
+    Return(s):
+        cluster_props: a cluster descriptor
+    """
+    if not parameter_group:
+        return cluster_props
+    groups = cluster_props.get('ClusterParameterGroups', [])
+    if parameter_group in [group['ParameterGroupName'] for group in groups]:
+        if any(group.get('ParameterApplyStatus') == 'pending-reboot' for group in groups):
+            progress('Parameter group {} applies after the next reboot'.format(parameter_group))
+        return cluster_props
+    progress('Switching cluster to parameter group {}, it applies after the next reboot'.format(parameter_group))
+    return redshift.modify_cluster(ClusterIdentifier=config['REDSHIFT']['CLUSTER_IDENTIFIER'],
+                                   ClusterParameterGroupName=parameter_group)['Cluster']
+
+
+def start_redshift_cluster(redshift, config, progress=report, parameter_group=None):
+    """
+    Starts the Redshift cluster without waiting for it, reusing what already exists:
+    an available or pending cluster is kept, a paused one is resumed and a missing one
+    is restored from its latest snapshot (see latest_snapshot), or created from scratch otherwise.
+    The IAM role is attached once it exists (see attach_iam_role), so this does not wait for it.
+    Arg(s):
+        redshift: a redshift client
+        config: an object that contains necessary information for setting up the cluster
+        progress: callable receiving progress messages
+        parameter_group (string): parameter group new and restored clusters are created with
+    Return(s):
+        cluster_props: the cluster descriptor right after the request
+    """
+    identifier = config['REDSHIFT']['CLUSTER_IDENTIFIER']
+    group = {'ClusterParameterGroupName': parameter_group} if parameter_group else {}
+    cluster_props = describe_cluster(redshift, config)
+    if cluster_props is not None:
+        status = cluster_props['ClusterStatus']
+        if status == 'paused':
+            progress('Resuming paused Redshift cluster {}'.format(identifier))
+            redshift.resume_cluster(ClusterIdentifier=identifier)
+        else:
+            progress('Reusing Redshift cluster {} ({})'.format(identifier, status))
+        return cluster_props
+
+    snapshot = latest_snapshot(redshift, config)
+    if snapshot:
+        progress('Restoring Redshift cluster {} from snapshot {}'.format(identifier, snapshot))
+        return redshift.restore_from_cluster_snapshot(
+            ClusterIdentifier=identifier,
+            SnapshotIdentifier=snapshot,
             NodeType=config['REDSHIFT']['NODE_TYPE'],
             NumberOfNodes=int(config['REDSHIFT']['NUM_NODES']),
-            # parameters for identifiers & credentials
-            ClusterIdentifier=config['REDSHIFT']['CLUSTER_IDENTIFIER'],
-            DBName=config['REDSHIFT']['DB_NAME'],
-            MasterUsername=config['REDSHIFT']['DB_MASTER_USER'],
-            MasterUserPassword=config['REDSHIFT']['DB_MASTER_PASSWORD'],
             Port=int(config['REDSHIFT']['DB_PORT']),
-            # parameter for role (to allow s3 access)
-            IamRoles=[roleArn])
-        # Wait for up to 30 minutes until the cluster is created successfully
-        redshift.get_waiter('cluster_available').wait(
-            ClusterIdentifier=config['REDSHIFT']['CLUSTER_IDENTIFIER'],
-            WaiterConfig={'Delay': 30, 'MaxAttempts': 60})
-    except Exception as e:
-        print(e)
+            **group)['Cluster']
+
+    progress('Creating a Redshift Cluster. This might take a few minutes ...')
+    return redshift.create_cluster(
+        # parameters for hardware
+        ClusterType=config['REDSHIFT']['CLUSTER_TYPE'],
+        NodeType=config['REDSHIFT']['NODE_TYPE'],
+        NumberOfNodes=int(config['REDSHIFT']['NUM_NODES']),
+        # parameters for identifiers & credentials
+        ClusterIdentifier=identifier,
+        DBName=config['REDSHIFT']['DB_NAME'],
+        MasterUsername=config['REDSHIFT']['DB_MASTER_USER'],
+        MasterUserPassword=config['REDSHIFT']['DB_MASTER_PASSWORD'],
+        Port=int(config['REDSHIFT']['DB_PORT']),
+        # workload management, see ensure_parameter_group
+        **group)['Cluster']
+
+
+def wait_for_cluster(redshift, config, progress=report, delay=30, timeout=1800, sleep=time.sleep,
+                     target='available'):
+    """
+    Polls the cluster until it reaches the target status and reports every status change.
+    Arg(s):
+        redshift: a redshift client
+        config: an object that contains necessary information for setting up the cluster
+        progress: callable receiving progress messages
+        delay (int): seconds between polls
+        timeout (int): seconds before giving up
+        sleep: called with delay between polls, replaced in tests
+        target (string): 'available', 'paused' or 'missing' (deleted)
+    Return(s):
+        cluster_props: a cluster descriptor, None once deleted
+    """
+    identifier = config['REDSHIFT']['CLUSTER_IDENTIFIER']
+    waited = 0
+    last_status = None
+    while True:
+        cluster_props = describe_cluster(redshift, config)
+        status = cluster_props['ClusterStatus'] if cluster_props else 'missing'
+        if status != last_status:
+            progress('Cluster {}: {} after {}s'.format(identifier, status, waited))
+            last_status = status
+        # a resize or role change keeps the cluster 'available' while it is being modified
+        if status == target and (target != 'available' or
+                                 cluster_props.get('ClusterAvailabilityStatus', 'Available') == 'Available'):
+            return cluster_props
+        if waited >= timeout:
+            raise TimeoutError('cluster {} still {} after {}s'.format(identifier, status, waited))
+        sleep(delay)
+        waited += delay
 
-    # describe the cluster (codes borrowed from Lesson 3 Exercise 2)
-    try:
-        cluster_props = redshift.describe_clusters(ClusterIdentifier=config['REDSHIFT']['CLUSTER_IDENTIFIER'])['Clusters'][0]
-    except Exception as e:
-        print(e)
 
-    pd.set_option('display.max_colwidth', -1)
+def attach_iam_role(redshift, config, cluster_props, roleArn, progress=report, **wait_options):
+    """
+    Attaches roleArn to the cluster unless it already is, and waits for the change to apply.
+    Return(s):
+        cluster_props: a cluster descriptor
+    """
+    if roleArn in [role['IamRoleArn'] for role in cluster_props.get('IamRoles', [])]:
+        return cluster_props
+    progress('Attaching IAM Role {}'.format(roleArn))
+    redshift.modify_cluster_iam_roles(ClusterIdentifier=config['REDSHIFT']['CLUSTER_IDENTIFIER'],
+                                      AddIamRoles=[roleArn])
+    return wait_for_cluster(redshift, config, progress, **wait_options)
+
+
+def show_cluster(cluster_props):
+    """prints the main properties of a cluster descriptor"""
+    import pandas as pd
+    pd.set_option('display.max_colwidth', None)
     keysToShow = ["ClusterIdentifier", "NodeType", "ClusterStatus", "MasterUsername", "DBName", "Endpoint", "NumberOfNodes", 'VpcId']
     x = [(k, v) for k,v in cluster_props.items() if k in keysToShow]
     df = pd.DataFrame(data=x, columns=["Key", "Value"])
     print(df)
 
-    return cluster_props
+
+def provision(config, iam, redshift, ec2, progress=report, **wait_options):
+    """
+    Provisions the WLM parameter group, role, cluster and security group. The IAM role and
+    the security group ingress rule are set up on worker threads while the cluster starts,
+    and the role is attached once both the role and the cluster are ready.
+    Arg(s):
+        config: an object that contains necessary information for setting up the cluster
+        iam, redshift: IAM and Redshift clients
+        ec2: an EC2 resource
+        progress: callable receiving progress messages
+        wait_options: delay/timeout/sleep passed to wait_for_cluster
+    Return(s):
+        (cluster_props, roleArn, sg)
+    """
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        role = executor.submit(create_iam_role, iam, config)
+        parameter_group = ensure_parameter_group(redshift, config, progress)
+        cluster_props = start_redshift_cluster(redshift, config, progress, parameter_group)
+        # the VPC is known as soon as the cluster is requested
+        if not cluster_props.get('VpcId'):
+            cluster_props = describe_cluster(redshift, config)
+        sg = executor.submit(create_ec2_sg, ec2, config, cluster_props)
+        available = executor.submit(wait_for_cluster, redshift, config, progress, **wait_options)
+        roleArn = role.result()
+        progress('IAM Role ready after {:.0f}s'.format(time.time() - started))
+        sg = sg.result()
+        progress('SecurityGroup ready after {:.0f}s'.format(time.time() - started))
+        cluster_props = available.result()
+    cluster_props = attach_iam_role(redshift, config, cluster_props, roleArn, progress, **wait_options)
+    cluster_props = attach_parameter_group(redshift, config, cluster_props, parameter_group, progress)
+    progress('Cluster available after {:.0f}s'.format(time.time() - started))
+    return cluster_props, roleArn, sg
 
 
 def create_ec2_sg(ec2, config, cluster_props):
@@ -145,13 +335,15 @@ def create_ec2_sg(ec2, config, cluster_props):
         config: an object that contains necessary information for setting up the cluster
         cluster_props: an dict that describes the cluster
     Return(s):
-        sg: a default security group
+        sg: a default security group, None when the cluster is not in a VPC
     """
+    if not cluster_props.get('VpcId'):
+        print('Cluster {} has no VPC, no ingress rule added'.format(cluster_props['ClusterIdentifier']))
+        return None
+    vpc = ec2.Vpc(id=cluster_props['VpcId'])
+    defaultSg = list(vpc.security_groups.all())[0]
 
     try:
-        vpc = ec2.Vpc(id=cluster_props['VpcId'])
-        defaultSg = list(vpc.security_groups.all())[0]
-
         defaultSg.authorize_ingress(
             GroupName= defaultSg.group_name,
             CidrIp='0.0.0.0/0', # allow traffic from any IP source
@@ -165,25 +357,27 @@ def create_ec2_sg(ec2, config, cluster_props):
     return defaultSg
 
 
-def create_resources():
-    config = get_config('dwh.cfg')
+def create_resources(config_file='dwh.cfg'):
+    # boto3 and pandas are only imported by runs that provision
+    import boto3
+    config = get_config(config_file)
     # create resources/clients
     iam = boto3.client('iam', region_name=config['REDSHIFT']['REGION_NAME'], aws_access_key_id=config['AWS']['key'], aws_secret_access_key=config['AWS']['secret'])
     redshift = boto3.client('redshift', region_name=config['REDSHIFT']['REGION_NAME'], aws_access_key_id=config['AWS']['key'], aws_secret_access_key=config['AWS']['secret'])
     ec2 = boto3.resource('ec2', region_name=config['REDSHIFT']['REGION_NAME'], aws_access_key_id=config['AWS']['key'], aws_secret_access_key=config['AWS']['secret'])
 
-    roleArn = create_iam_role(iam, config)
-    cluster_props = create_redshift_cluster(redshift, config, roleArn)
-    sg = create_ec2_sg(ec2, config, cluster_props)
-    update_config_file('dwh.cfg', 'REDSHIFT', 'HOST', cluster_props['Endpoint']['Address'])
-    update_config_file('dwh.cfg', 'IAM_ROLE', 'ARN', roleArn)
+    cluster_props, roleArn, sg = provision(config, iam, redshift, ec2)
+    show_cluster(cluster_props)
+    update_config_file(config_file, 'REDSHIFT', 'HOST', cluster_props['Endpoint']['Address'])
+    update_config_file(config_file, 'IAM_ROLE', 'ARN', roleArn)
 
     print('Cluster Setup done.')
     print('RoleArn: {}'.format(roleArn))
     print('Cluster Endpoint: {}'.format(cluster_props['Endpoint']['Address']))
     print('SecurityGroup: {}'.format(sg))
-    print("SecurityGroup's Name: {}".format(sg.group_name))
-    print("SecurityGroup's IP permissions: {}".format(sg.ip_permissions))
+    if sg is not None:
+        print("SecurityGroup's Name: {}".format(sg.group_name))
+        print("SecurityGroup's IP permissions: {}".format(sg.ip_permissions))
     
 if __name__ == "__main__":
     create_resources()
@@ -1,6 +1,8 @@
 import configparser
-import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+from db import get_pool
+from instrumentation import run_statement, recorder, configure_from
+import sql_queries
+from sql_queries import drop_table_queries
 
 
 def drop_tables(cur, conn):
@@ -12,9 +14,10 @@ def drop_tables(cur, conn):
     try:
         print("dropping any pre existing tables")
         for query in drop_table_queries:
-            cur.execute(query)
-            conn.commit()
+            run_statement(cur, query, 'drop_tables')
+        conn.commit()
     except Exception as e:
+        conn.rollback()
         print(e)
 
 
@@ -27,10 +30,11 @@ def create_tables(cur, conn):
     
     try:
         print("creating all tables")
-        for query in create_table_queries:
-            cur.execute(query)
-            conn.commit()
+        for query in sql_queries.create_table_queries:
+            run_statement(cur, query, 'create_tables')
+        conn.commit()
     except Exception as e:
+        conn.rollback()
         print(e)
 
 
@@ -40,4 +44,11 @@ def create_dbObjects(cur, conn):
 
 
 if __name__ == "__main__":
-    create_dbObjects(cur, conn)
\ No newline at end of file
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    configure_from(config)
+    pool = get_pool(config)
+    with pool.connection() as conn:
+        create_dbObjects(conn.cursor(), conn)
+    pool.close()
+    recorder.summary()
@@ -0,0 +1,132 @@
+import os
+import json
+import random
+import string
+import argparse
+import datetime
+from itertools import accumulate
+from bisect import bisect
+
+PAGES = ['NextSong'] * 8 + ['Home', 'Logout']
+AGENTS = ['"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+          '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.125 Safari/537.36"',
+          'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0']
+LOCATIONS = ['Klamath Falls, OR', 'San Jose-Sunnyvale-Santa Clara, CA', 'Atlanta-Sandy Springs-Roswell, GA',
+             'New York-Newark-Jersey City, NY-NJ-PA', 'Chicago-Naperville-Elgin, IL-IN-WI']
+
+
+class ZipfSampler:
+    """draws ranks 0..n-1 with probability proportional to 1 / (rank + 1) ** skew; skew 0 is uniform"""
+
+    def __init__(self, n, skew, rng):
+        self.rng = rng
+        self.cumulative = list(accumulate(1.0 / (rank + 1) ** skew for rank in range(n)))
+
+    def sample(self):
+        return bisect(self.cumulative, self.rng.random() * self.cumulative[-1])
+
+
+def random_id(rng, prefix, length=16):
+    return prefix + ''.join(rng.choice(string.ascii_uppercase + string.digits) for _ in range(length))
+
+
+def generate_songs(output_dir, songs, artists, artist_skew, rng):
+    """writes one song_data/A/B/C/TR*.json file per song
+    Return(s):
+        list of (title, artist_name, duration) used to generate matching events
+    """
+    artist_rows = [(random_id(rng, 'AR'), 'Artist {}'.format(i), rng.choice(LOCATIONS + [''])) for i in range(artists)]
+    pick_artist = ZipfSampler(artists, artist_skew, rng)
+    catalog = []
+    for i in range(songs):
+        track_id = random_id(rng, 'TR')
+        artist_id, artist_name, location = artist_rows[pick_artist.sample()]
+        song = {'num_songs': 1,
+                'artist_id': artist_id,
+                'artist_latitude': None,
+                'artist_longitude': None,
+                'artist_location': location,
+                'artist_name': artist_name,
+                'song_id': random_id(rng, 'SO'),
+                'title': 'Song {}'.format(i),
+                'duration': round(rng.uniform(90, 420), 5),
+                'year': rng.choice([0] + list(range(1960, 2019)))}
+        directory = os.path.join(output_dir, 'song_data', track_id[2], track_id[3], track_id[4])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, track_id + '.json'), 'w') as f:
+            json.dump(song, f)
+        catalog.append((song['title'], artist_name, song['duration']))
+    return catalog
+
+
+def generate_events(output_dir, catalog, users, events_per_day, days, title_skew, start, rng):
+    """writes one log_data/YYYY/MM/YYYY-MM-DD-events.json file (one JSON record per line) per day"""
+    pick_song = ZipfSampler(len(catalog), title_skew, rng)
+    user_rows = [(str(i + 1), 'First{}'.format(i), 'Last{}'.format(i), rng.choice('MF'),
+                  rng.choice(LOCATIONS), rng.choice(AGENTS), rng.randint(1535000000000, 1541000000000))
+                 for i in range(users)]
+    levels = {row[0]: rng.choice(['free', 'paid']) for row in user_rows}
+    session = 0
+    written = 0
+    for day in range(days):
+        date = start + datetime.timedelta(days=day)
+        directory = os.path.join(output_dir, 'log_data', '{:04d}'.format(date.year), '{:02d}'.format(date.month))
+        os.makedirs(directory, exist_ok=True)
+        day_ms = int(datetime.datetime(date.year, date.month, date.day, tzinfo=datetime.timezone.utc).timestamp() * 1000)
+        offsets = sorted(rng.randrange(86400000) for _ in range(events_per_day))
+        with open(os.path.join(directory, '{}-events.json'.format(date.isoformat())), 'w') as f:
+            for n, offset in enumerate(offsets):
+                user_id, first, last, gender, location, agent, registration = rng.choice(user_rows)
+                if rng.random() < 0.001:
+                    # users occasionally upgrade, which the users upsert has to pick up
+                    levels[user_id] = 'paid'
+                if n % 20 == 0:
+                    session += 1
+                page = rng.choice(PAGES)
+                title, artist, duration = catalog[pick_song.sample()] if page == 'NextSong' else (None, None, None)
+                f.write(json.dumps({'artist': artist, 'auth': 'Logged In', 'firstName': first, 'gender': gender,
+                                    'itemInSession': n % 20, 'lastName': last, 'length': duration,
+                                    'level': levels[user_id], 'location': location,
+                                    'method': 'PUT' if page == 'NextSong' else 'GET', 'page': page,
+                                    'registration': float(registration), 'sessionId': session, 'song': title,
+                                    'status': 200, 'ts': day_ms + offset, 'userAgent': agent, 'userId': user_id}))
+                f.write('\n')
+                written += 1
+    return written
+
+
+def generate(output_dir, songs=1000, artists=None, users=100, events_per_day=1000, days=30,
+             artist_skew=1.0, title_skew=1.1, start=datetime.date(2018, 11, 1), seed=42):
+    """generates a synthetic Sparkify dataset in the song_data/ and log_data/ layouts
+    Args:
+        output_dir (string): directory receiving song_data/ and log_data/
+        songs (int): number of song files
+        artists (int): number of artists, defaults to songs / 4
+        users (int): number of distinct users
+        events_per_day (int): log records per daily file
+        days (int): number of daily log files
+        artist_skew (float): Zipf exponent of songs per artist
+        title_skew (float): Zipf exponent of plays per song
+        seed (int): random seed, the same arguments always produce the same files
+    """
+    rng = random.Random(seed)
+    catalog = generate_songs(output_dir, songs, artists or max(1, songs // 4), artist_skew, rng)
+    events = generate_events(output_dir, catalog, users, events_per_day, days, title_skew, start, rng)
+    print("generated {} songs and {} events in {}".format(songs, events, output_dir))
+    return songs, events
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='generate a synthetic Sparkify dataset')
+    parser.add_argument('output_dir')
+    parser.add_argument('--songs', type=int, default=1000)
+    parser.add_argument('--artists', type=int)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--events-per-day', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--artist-skew', type=float, default=1.0)
+    parser.add_argument('--title-skew', type=float, default=1.1)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    generate(args.output_dir, args.songs, args.artists, args.users, args.events_per_day, args.days,
+             args.artist_skew, args.title_skew, seed=args.seed)
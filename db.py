@@ -0,0 +1,182 @@
+import queue
+import threading
+from contextlib import contextmanager
+import psycopg2
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def connection_settings(config):
+    """returns psycopg2 connect arguments built from the [REDSHIFT] section of dwh.cfg
+    Args:
+        config: config object read from dwh.cfg
+    """
+    return {
+        'host': config.get('REDSHIFT', 'HOST'),
+        'dbname': config.get('REDSHIFT', 'DB_NAME'),
+        'user': config.get('REDSHIFT', 'DB_MASTER_USER'),
+        'password': config.get('REDSHIFT', 'DB_MASTER_PASSWORD'),
+        'port': config.getint('REDSHIFT', 'DB_PORT'),
+        'connect_timeout': config.getint('REDSHIFT', 'CONNECT_TIMEOUT', fallback=10),
+        # TCP keepalives stop idle pooled connections from being dropped by NAT/firewalls
+        'keepalives': 1,
+        'keepalives_idle': config.getint('REDSHIFT', 'KEEPALIVES_IDLE', fallback=60),
+        'keepalives_interval': 10,
+        'keepalives_count': 5,
+    }
+
+
+def connect(config):
+    """opens a single connection to the cluster configured in dwh.cfg"""
+    return psycopg2.connect(**connection_settings(config))
+
+
+class ConnectionPool:
+    """bounded, thread safe pool of health checked connections
+    created counts the open connections, idle and checked out, and never exceeds size.
+    """
+
+    def __init__(self, settings, size=4, statement_timeout=0, query_group=None):
+        self.settings = settings
+        self.size = size
+        self.statement_timeout = statement_timeout
+        # WLM routes the statements of every pooled connection to this query group's queue
+        self.query_group = query_group
+        self.created = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.idle = queue.Queue()
+
+    def _open(self):
+        conn = psycopg2.connect(**self.settings)
+        if self.statement_timeout or self.query_group:
+            cur = conn.cursor()
+            if self.statement_timeout:
+                cur.execute("SET statement_timeout TO {};".format(int(self.statement_timeout)))
+            if self.query_group:
+                cur.execute("SET query_group TO %s;", (self.query_group,))
+            cur.close()
+            conn.commit()
+        return conn
+
+    def _healthy(self, conn):
+        """checks a pooled connection with a trivial round trip"""
+        if conn.closed:
+            return False
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1;")
+            cur.fetchone()
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def acquire(self):
+        """returns an idle connection, opens a new one while below size, otherwise waits"""
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                if self.created < self.size:
+                    self.created += 1
+                    try:
+                        return self._open()
+                    except Exception:
+                        self.created -= 1
+                        raise
+            conn = self.idle.get()
+        if not self._healthy(conn):
+            print("Reconnecting stale pooled connection")
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+            try:
+                conn = self._open()
+            except Exception:
+                # the stale connection is gone, free its slot
+                with self.lock:
+                    self.created -= 1
+                raise
+        return conn
+
+    def release(self, conn):
+        """returns a connection to the pool, rolling back anything left uncommitted
+        A connection released after close() is closed instead.
+        """
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+        if self.closed:
+            self._discard(conn)
+        else:
+            self.idle.put(conn)
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self.lock:
+            self.created -= 1
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    @contextmanager
+    def transaction(self):
+        """yields a cursor; commits once when the block succeeds, rolls back otherwise"""
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                yield cur
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cur.close()
+
+    def close(self):
+        """closes the idle connections; the ones still checked out are closed when released"""
+        self.closed = True
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+
+def get_pool(config, query_group=None):
+    """returns the shared pool for the configured cluster, creating it on first use
+    Args:
+        config: config object read from dwh.cfg
+        query_group (string): WLM query group the pooled sessions are tagged with
+    """
+    settings = connection_settings(config)
+    key = (settings['host'], settings['port'], settings['dbname'], settings['user'], query_group)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(settings,
+                                         size=config.getint('REDSHIFT', 'POOL_SIZE', fallback=4),
+                                         statement_timeout=config.getint('REDSHIFT', 'STATEMENT_TIMEOUT', fallback=0),
+                                         query_group=query_group)
+        return _pools[key]
+
+
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
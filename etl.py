@@ -1,65 +1,331 @@
+import sys
+import time
+import argparse
+import importlib
 import configparser
-import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries, validation_queries
-from create_resources import create_resources
-from create_tables import create_dbObjects
-from validation import analyse_data
-from shutdown_resources import shutdown_resources
+import sql_queries
+from instrumentation import run_statement, recorder, configure_from
+from wlm import wlm_options, step_slots, run_with_slots
 
+# phases in the order they run; `python etl.py` runs all of them
+PHASES = ['provision', 'create', 'load', 'transform', 'validate', 'teardown']
+# phases the cluster is resized up for when SIZING is on, see sizing.py; the window
+# closes after transform's inserts, before the summaries, archive and maintenance
+LOAD_WINDOW = ['load', 'transform']
+# modules each phase imports when it runs, imported up front only by --dry-run
+PHASE_MODULES = {'provision': ['create_resources'],
+                 'create': ['create_tables'],
+                 'load': ['incremental', 'song_matching', 'prestage', 'parquet_stage', 'stream_load', 'load_quality',
+                          'sizing'],
+                 'transform': ['scheduler', 'summaries', 'archive', 'maintenance', 'sizing'],
+                 'validate': ['validation'],
+                 'teardown': ['shutdown_resources']}
 
-def load_staging_tables(cur, conn):
+
+def load_staging_tables(cur, conn, queries=None):
     """Loads data into staging tables
     Args:
         cur (cursor): cursor to execute queries
-        conn: open connection 
+        conn: open connection
+        queries (list): COPY statements, defaults to copying the whole S3 prefixes
     """
     try:
         print("Loading staging tables started\n")
-        for query in copy_table_queries:
-            print("Executing query: "+query)
-            cur.execute(query)
-            conn.commit()
+        for query in queries or sql_queries.copy_table_queries:
+            run_statement(cur, query, 'load_staging_tables')
+        conn.commit()
         print("Loading staging tables completed\n")
-    except Exception as e:
-        print(e)
+    except Exception:
+        conn.rollback()
+        raise
 
 
-def insert_tables(cur, conn):
+def insert_tables(cur, conn, options=None):
     """Loads data into dimension tables
     Args:
         cur (cursor): cursor to execute queries
-        conn: open connection 
+        conn: open connection
+        options (dict): wlm.wlm_options, heavy steps claim more WLM slots
     """
-    
+
     try:
         print("inserting data into dimension tables started\n")
-        for query in insert_table_queries:
-            print("Executing query: "+query)
-            cur.execute(query)
-            conn.commit()
+        for name, query, _, _ in sql_queries.insert_table_steps:
+            slots = step_slots(name, options) if options else 1
+            run_with_slots(cur, slots, lambda: run_statement(cur, query, 'insert_tables'))
+        conn.commit()
         print("inserting data into dimension tables completed\n")
-    except Exception as e:
-        print(e)
-
-
-def main(): 
-    create_resources()
-    config = configparser.ConfigParser()
-    config.read('dwh.cfg')
-    host = config.get('REDSHIFT', 'HOST')
-    db_name = config.get('REDSHIFT', 'DB_NAME')
-    db_username = config.get('REDSHIFT', 'DB_MASTER_USER')
-    db_password = config.get('REDSHIFT', 'DB_MASTER_PASSWORD')
-    port = config.getint('REDSHIFT', 'DB_PORT')
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(host, db_name, db_username, db_password, port))
-    cur = conn.cursor()  
-    create_dbObjects(cur, conn)
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
-    analyse_data(cur, conn)
-    conn.close()
-    shutdown_resources()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def insert_tables_parallel(pool, max_workers, options=None):
+    """Loads fact and dimension tables, running independent inserts concurrently
+    Args:
+        pool: db.ConnectionPool the inserts borrow their connections from
+        max_workers (int): number of concurrent statements
+        options (dict): wlm.wlm_options, heavy steps claim more WLM slots
+    """
+    from scheduler import Step, run_steps
+    print("inserting data into dimension tables started ({} workers)\n".format(max_workers))
+    steps = [Step(*declaration, slots=step_slots(declaration[0], options) if options else 1)
+             for declaration in sql_queries.insert_table_steps]
+    run_steps(steps, pool, max_workers)
+    print("inserting data into dimension tables completed\n")
+
+
+class Run:
+    """the config of one etl.py run and the connections its phases share, opened on first use
+    ETL phases and the validation reports use separate pools tagged with their WLM query group.
+    """
+
+    def __init__(self, config_file='dwh.cfg'):
+        self.config_file = config_file
+        self.pools = {}
+        self.connections = {}
+        # the sizing plan while the cluster is resized up for the load window
+        self.window = None
+        self.reload()
+
+    def reload(self):
+        """reads the config file again, e.g. after provision wrote the cluster endpoint and role to it"""
+        self.config = configparser.ConfigParser()
+        self.config.read(self.config_file)
+        self.wlm = wlm_options(self.config)
+        configure_from(self.config)
+        sql_queries.configure(self.config)
+
+    def connection(self, workload='etl'):
+        """returns (cursor, connection) of the etl or bi workload, opening its pool on first use"""
+        if workload not in self.connections:
+            conn = self.pool(workload).acquire()
+            self.connections[workload] = (conn, conn.cursor())
+        conn, cur = self.connections[workload]
+        return cur, conn
+
+    def pool(self, workload='etl'):
+        """returns the pool of the etl or bi workload, opening it on first use"""
+        if workload not in self.pools:
+            from db import get_pool
+            # query groups are Redshift WLM settings, a Postgres stand-in rejects SET query_group
+            query_group = self.wlm['{}_query_group'.format(workload)] if sql_queries.DIALECT == 'redshift' else None
+            self.pools[workload] = get_pool(self.config, query_group)
+        return self.pools[workload]
+
+    def release(self, workload='etl'):
+        """returns the workload's connection to its pool, e.g. so parallel steps can borrow all of them;
+        the next connection() acquires one again
+        """
+        if workload in self.connections:
+            conn, _ = self.connections.pop(workload)
+            self.pools[workload].release(conn)
+
+    def close(self):
+        """returns the connections and closes the pools that were opened"""
+        for workload in list(self.connections):
+            self.release(workload)
+        for pool in self.pools.values():
+            pool.close()
+        self.pools = {}
+
+    def incremental(self):
+        return self.config.get('ETL', 'LOAD_MODE', fallback='full') == 'incremental'
+
+    def sizing(self):
+        """full loads resize the cluster for their load window; incremental ones copy too little to pay off"""
+        return self.config.getboolean('ETL', 'SIZING', fallback=False) and not self.incremental()
+
+
+def provision(run):
+    """creates, resumes or restores the cluster with its IAM role and security group"""
+    from create_resources import create_resources
+    create_resources(run.config_file)
+    run.reload()
+
+
+def create(run):
+    """drops and creates the tables; incremental loads only create the missing ones"""
+    from create_tables import create_dbObjects, create_tables
+    cur, conn = run.connection()
+    if run.incremental():
+        create_tables(cur, conn)
+    else:
+        create_dbObjects(cur, conn)
+
+
+def load(run):
+    """loads the staging tables and computes the song keys
+    Incremental loads copy the new source objects and merge them right away.
+    """
+    cur, conn = run.connection()
+    config = run.config
+    if run.incremental():
+        from incremental import incremental_load
+        incremental_load(cur, conn, config)
+        return
+    from song_matching import compute_song_keys, match_rate
+    if config.getboolean('ETL', 'PRESTAGE', fallback=False):
+        from prestage import prestage, cluster_slices
+        load_staging_tables(cur, conn, prestage(config, slices=cluster_slices(config, run.window)))
+    elif config.getboolean('ETL', 'PARQUET_STAGE', fallback=False):
+        from parquet_stage import parquet_stage
+        load_staging_tables(cur, conn, parquet_stage(config))
+    elif config.getboolean('ETL', 'STREAM_LOAD', fallback=False):
+        if sql_queries.DIALECT != 'postgres':
+            raise ValueError('stream_load needs dialect = postgres: Redshift does not accept COPY FROM STDIN')
+        from stream_load import stream_load_staging
+        stream_load_staging(cur, conn, config)
+    elif config.getboolean('ETL', 'LOAD_CHECK', fallback=False):
+        from load_quality import load_staging_checked
+        load_staging_checked(cur, conn, config)
+    else:
+        load_staging_tables(cur, conn)
+    compute_song_keys(cur, conn)
+    match_rate(cur, conn)
+
+
+def transform(run):
+    """fills the fact and dimension tables, refreshes the summaries, archives old months and runs table maintenance
+    A load window ends with the inserts, so the summaries, archive and maintenance
+    neither count towards its measured throughput nor keep the cluster resized up.
+    """
+    from summaries import refresh_summaries
+    cur, conn = run.connection()
+    config = run.config
+    if run.incremental():
+        refresh_summaries(cur, conn)
+    else:
+        max_workers = config.getint('ETL', 'MAX_WORKERS', fallback=1)
+        if max_workers > 1:
+            # the steps borrow every connection of the pool, so the phase's own goes back first
+            run.release()
+            insert_tables_parallel(run.pool(), max_workers, run.wlm)
+        else:
+            insert_tables(cur, conn, run.wlm)
+        end_window(run)
+        cur, conn = run.connection()
+        refresh_summaries(cur, conn, full=True)
+    if config.getboolean('ETL', 'ARCHIVE', fallback=False):
+        from archive import archive_songplays
+        archive_songplays(conn, config)
+    if config.getboolean('ETL', 'MAINTENANCE', fallback=False):
+        from maintenance import run_maintenance, maintenance_options
+        run_maintenance(conn, **maintenance_options(config))
+
+
+def validate(run):
+    """runs the validation reports in the BI query group, like dashboard queries"""
+    from validation import analyse_data, validation_options
+    cur, conn = run.connection('bi')
+    analyse_data(cur, conn, **validation_options(run.config))
+
+
+def teardown(run):
+    """pauses, snapshots or deletes the cluster as set by SHUTDOWN_MODE"""
+    from shutdown_resources import shutdown_resources
+    run.close()
+    shutdown_resources(config_file=run.config_file)
+
+
+def open_window(run):
+    """resizes the cluster for the volume about to be loaded; the connections are reopened after the resize"""
+    from sizing import open_load_window
+    run.close()
+    return open_load_window(run.config)
+
+
+def close_window(run, plan):
+    """records the load window's throughput and resizes the cluster back to its baseline"""
+    from sizing import close_load_window
+    run.close()
+    close_load_window(run.config, plan)
+
+
+def end_window(run):
+    """closes the load window if one is open, the connections are reopened on next use"""
+    if run.window is not None:
+        plan, run.window = run.window, None
+        close_window(run, plan)
+
+
+PHASE_FUNCTIONS = {'provision': provision, 'create': create, 'load': load, 'transform': transform,
+                   'validate': validate, 'teardown': teardown}
+
+
+def select_phases(phases=None, start=None, end=None):
+    """returns the phases to run in pipeline order
+    Args:
+        phases (list): phase names, run in pipeline order whatever order they are given in
+        start, end (string): first and last phase of a range, default to the first and last phase
+    """
+    unknown = [phase for phase in (phases or []) + [start, end] if phase and phase not in PHASES]
+    if unknown:
+        raise ValueError('unknown phase(s) {}, expected {}'.format(', '.join(unknown), ', '.join(PHASES)))
+    if phases and (start or end):
+        raise ValueError('name phases or give a --from/--to range, not both')
+    if phases:
+        return [phase for phase in PHASES if phase in phases]
+    first = PHASES.index(start) if start else 0
+    last = PHASES.index(end) if end else len(PHASES) - 1
+    if first > last:
+        raise ValueError('--from {} comes after --to {}'.format(start, end))
+    return PHASES[first:last + 1]
+
+
+def run_phases(phases, config_file='dwh.cfg', dry_run=False):
+    """runs the phases in order against the cluster described in config_file
+    Args:
+        phases (list): phases from select_phases
+        config_file (string): config file the SQL is rendered from
+        dry_run (bool): only import what the phases need and print the plan
+    """
+    started = time.time()
+    run = Run(config_file)
+    if dry_run:
+        for phase in phases:
+            for module in PHASE_MODULES[phase]:
+                importlib.import_module(module)
+        print("phases {} from {}: {} settings and statements rendered, ready in {:.3f}s".format(
+            ', '.join(phases), config_file, len(sql_queries.rendered_statements()), time.time() - started))
+        return
+    window_phases = [phase for phase in phases if phase in LOAD_WINDOW]
+    try:
+        for phase in phases:
+            if window_phases and phase == window_phases[0] and run.sizing():
+                run.window = open_window(run)
+            phase_started = time.time()
+            print("== {} ==\n".format(phase))
+            try:
+                PHASE_FUNCTIONS[phase](run)
+            except Exception as e:
+                # the later phases would run on what the failed one left behind
+                recorder.record('phase', phase, time.time() - phase_started, status='failed', error=e)
+                raise
+            recorder.record('phase', phase, time.time() - phase_started)
+            if window_phases and phase == window_phases[-1]:
+                end_window(run)
+    finally:
+        end_window(run)
+        run.close()
+        recorder.summary()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='runs the Sparkify ETL pipeline, or some of its phases')
+    parser.add_argument('phases', nargs='*', metavar='phase',
+                        help='phases to run: {} (default: all, or the --from/--to range)'.format(', '.join(PHASES)))
+    parser.add_argument('--from', dest='start', metavar='PHASE', help='first phase to run')
+    parser.add_argument('--to', dest='end', metavar='PHASE', help='last phase to run')
+    parser.add_argument('--config', default='dwh.cfg', help='config file, default dwh.cfg')
+    parser.add_argument('--dry-run', action='store_true', help='import what the phases need and print the plan')
+    args = parser.parse_args(argv)
+    try:
+        phases = select_phases(args.phases, args.start, args.end)
+    except ValueError as e:
+        parser.error(str(e))
+    run_phases(phases, args.config, args.dry_run)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main(sys.argv[1:])
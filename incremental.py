@@ -0,0 +1,286 @@
+import os
+import re
+import json
+import datetime
+import sql_queries
+from sql_queries import (load_state_select, load_state_watermark, load_state_insert,
+                         staging_events_truncate, staging_songs_truncate,
+                         staging_events_copy_object, staging_songs_copy_object,
+                         staging_songs_copy_manifest,
+                         staging_events_columns, staging_songs_columns)
+from instrumentation import run_statement
+from song_matching import compute_song_keys
+from wlm import wlm_options, step_slots, run_with_slots
+
+LOG_PARTITION = re.compile(r'(\d{4})/(\d{2})/[^/]+\.json$')
+
+
+def strip_quotes(value):
+    """removes the quotes around S3 locations in dwh.cfg
+    Args:
+        value (string): raw config value e.g. 's3://udacity-dend/log-data'
+    """
+    return value.strip().strip("'\"")
+
+
+def is_s3(location):
+    return location.startswith('s3://')
+
+
+def split_s3(location):
+    """splits s3://bucket/prefix into (bucket, prefix)"""
+    bucket, _, prefix = location[len('s3://'):].partition('/')
+    return bucket, prefix
+
+
+def get_s3_client(config):
+    """creates an S3 client from the AWS credentials in dwh.cfg"""
+    import boto3
+    return boto3.client('s3', region_name=config['REDSHIFT']['REGION_NAME'],
+                        aws_access_key_id=config['AWS']['key'],
+                        aws_secret_access_key=config['AWS']['secret'])
+
+
+def list_source_objects(location, config=None, suffix='.json'):
+    """lists object keys (S3) or file paths (local directory) below a source location
+    Args:
+        location (string): s3://bucket/prefix or local directory
+        config: config object holding AWS credentials, only needed for S3
+        suffix (string): only keys ending with suffix are returned
+    """
+    if is_s3(location):
+        bucket, prefix = split_s3(location)
+        s3 = get_s3_client(config)
+        for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                if obj['Key'].endswith(suffix):
+                    yield 's3://{}/{}'.format(bucket, obj['Key'])
+    else:
+        for root, dirs, files in os.walk(location):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith(suffix):
+                    yield os.path.join(root, name).replace(os.sep, '/')
+
+
+def log_partition(key):
+    """returns the YYYY/MM partition of a log_data object key, or None"""
+    match = LOG_PARTITION.search(key)
+    if match:
+        return '{}/{}'.format(match.group(1), match.group(2))
+    return None
+
+
+def get_loaded_keys(cur, source):
+    """returns the set of object keys already loaded for a source"""
+    cur.execute(load_state_select, (source,))
+    return set(row[0] for row in cur.fetchall())
+
+
+def get_watermark(cur, source):
+    """returns the last loaded log partition (YYYY/MM) for a source, or None"""
+    cur.execute(load_state_watermark, (source,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def plan_log_load(keys, loaded, watermark=None):
+    """groups new log objects by partition
+    Partitions older than the watermark are skipped entirely. A partition in which
+    nothing was loaded yet is copied by prefix, otherwise only its new objects are copied.
+    Args:
+        keys: iterable of log object keys
+        loaded (set): keys already recorded in etl_load_state
+        watermark (string): last loaded partition
+    Return(s):
+        dict partition -> {'keys': [...], 'whole': bool}
+    """
+    seen = {}
+    for key in keys:
+        partition = log_partition(key)
+        if partition is None or (watermark and partition < watermark):
+            continue
+        entry = seen.setdefault(partition, {'keys': [], 'new': [], 'whole': True})
+        entry['keys'].append(key)
+        if key in loaded:
+            entry['whole'] = False
+        else:
+            entry['new'].append(key)
+
+    plan = {}
+    for partition, entry in sorted(seen.items()):
+        if entry['new']:
+            plan[partition] = {'keys': entry['new'], 'whole': entry['whole']}
+    return plan
+
+
+def parse_json_text(text):
+    """yields the JSON records of a text holding one document or one document per line"""
+    try:
+        yield json.loads(text)
+    except ValueError:
+        for line in text.splitlines():
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_json_records(path):
+    """yields JSON records from a local file holding one document or one document per line"""
+    with open(path) as f:
+        text = f.read()
+    for record in parse_json_text(text):
+        yield record
+
+
+def coerce_event(record):
+    """maps a raw log record onto the staging_events columns
+    ts is converted from epoch milliseconds as COPY does with TIMEFORMAT 'epochmillisecs'.
+    """
+    row = []
+    for column in staging_events_columns:
+        value = record.get(column)
+        if value == '':
+            value = None
+        if column == 'ts' and value is not None:
+            value = datetime.datetime.utcfromtimestamp(int(value) / 1000.0)
+        elif column == 'registration' and value is not None:
+            value = int(float(value))
+        elif column == 'userId' and value is not None:
+            value = int(value)
+        row.append(value)
+    return row
+
+
+def coerce_song(record):
+    """maps a raw song record onto the staging_songs columns"""
+    return [None if record.get(column) == '' else record.get(column) for column in staging_songs_columns]
+
+
+def insert_local_files(cur, table, columns, paths, coerce):
+    """inserts local JSON files into a staging table, stand-in for COPY in local runs"""
+    query = 'INSERT INTO {} ({}) VALUES ({});'.format(
+        table, ', '.join(columns), ', '.join(['%s'] * len(columns)))
+    for path in paths:
+        cur.executemany(query, [coerce(record) for record in iter_json_records(path)])
+
+
+def write_manifest(config, keys, name='songs'):
+    """writes a COPY manifest listing keys to the configured S3 manifest prefix
+    Args:
+        config: config object read from dwh.cfg
+        keys: S3 urls to list in the manifest
+        name (string): manifest file name prefix
+    Return(s):
+        S3 location of the manifest, None if no manifest prefix is configured
+    """
+    manifest_prefix = strip_quotes(config.get('S3', 'MANIFEST_PREFIX', fallback=''))
+    if not manifest_prefix:
+        return None
+    bucket, prefix = split_s3(manifest_prefix)
+    run = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%d%H%M%S')
+    key = '{}/{}-{}.manifest'.format(prefix.rstrip('/'), name, run)
+    body = json.dumps({'entries': [{'url': k, 'mandatory': True} for k in keys]})
+    s3 = get_s3_client(config)
+    s3.put_object(Bucket=bucket, Key=key, Body=body.encode('utf-8'))
+    return 's3://{}/{}'.format(bucket, key)
+
+
+def record_loaded(cur, source, keys, partition_of=lambda key: None):
+    """records loaded object keys in etl_load_state"""
+    # TIMESTAMP columns hold UTC without a zone
+    loaded_at = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    cur.executemany(load_state_insert, [(source, key, partition_of(key), loaded_at) for key in keys])
+
+
+def load_new_events(cur, conn, config):
+    """copies only new log_data partitions/objects into staging_events
+    The keys are not recorded here: incremental_load records them in the transaction
+    of the merge, so a failed merge leaves them to be loaded again.
+    Return(s):
+        list of newly loaded object keys
+    """
+    location = strip_quotes(config.get('S3', 'LOG_DATA'))
+    watermark = get_watermark(cur, 'log_data')
+    plan = plan_log_load(list_source_objects(location, config), get_loaded_keys(cur, 'log_data'), watermark)
+    loaded = []
+    for partition, entry in plan.items():
+        print("Loading log partition {} ({} new objects)".format(partition, len(entry['keys'])))
+        if not is_s3(location):
+            insert_local_files(cur, 'staging_events', staging_events_columns, entry['keys'], coerce_event)
+        elif entry['whole']:
+            prefix = '{}/{}/'.format(location.rstrip('/'), partition)
+            run_statement(cur, staging_events_copy_object.format(prefix, config.get('IAM_ROLE', 'ARN'),
+                                                                 config.get('S3', 'LOG_JSONPATH')), 'incremental_load')
+        else:
+            for key in entry['keys']:
+                run_statement(cur, staging_events_copy_object.format(key, config.get('IAM_ROLE', 'ARN'),
+                                                                     config.get('S3', 'LOG_JSONPATH')), 'incremental_load')
+        loaded.extend(entry['keys'])
+    return loaded
+
+
+def load_new_songs(cur, conn, config):
+    """copies song files that are not recorded in etl_load_state into staging_songs
+    On S3 the new keys are copied through a manifest written below MANIFEST_PREFIX,
+    or one COPY per key when no MANIFEST_PREFIX is configured.
+    Return(s):
+        list of newly loaded object keys
+    """
+    location = strip_quotes(config.get('S3', 'SONG_DATA'))
+    loaded = get_loaded_keys(cur, 'song_data')
+    new_keys = [key for key in list_source_objects(location, config) if key not in loaded]
+    if not new_keys:
+        return []
+    print("Loading {} new song files".format(len(new_keys)))
+    if not is_s3(location):
+        insert_local_files(cur, 'staging_songs', staging_songs_columns, new_keys, coerce_song)
+    else:
+        manifest = write_manifest(config, new_keys)
+        if manifest:
+            run_statement(cur, staging_songs_copy_manifest.format(manifest, config.get('IAM_ROLE', 'ARN'),
+                                                                  sql_queries.COPY_MAXERROR),
+                          'incremental_load')
+        else:
+            for key in new_keys:
+                run_statement(cur, staging_songs_copy_object.format(key, config.get('IAM_ROLE', 'ARN')),
+                              'incremental_load')
+    return new_keys
+
+
+def merge_tables(cur, conn, options=None, loaded=None):
+    """merges staged rows into fact and dimension tables without truncating them
+    Args:
+        options (dict): wlm.wlm_options, heavy steps claim more WLM slots
+        loaded (dict): source -> object keys merged, recorded in etl_load_state in the
+            same transaction as the merge
+    """
+    for name, query, _, _ in sql_queries.merge_table_steps:
+        slots = step_slots(name, options) if options else 1
+        run_with_slots(cur, slots, lambda: run_statement(cur, query, 'merge_tables', name))
+    for source, keys in (loaded or {}).items():
+        record_loaded(cur, source, keys, log_partition if source == 'log_data' else lambda key: None)
+    conn.commit()
+
+
+def incremental_load(cur, conn, config):
+    """loads only new source objects and merges them into the warehouse
+    Args:
+        cur (cursor): cursor to execute queries
+        conn: open connection
+        config: config object read from dwh.cfg
+    """
+    try:
+        print("Incremental load started\n")
+        cur.execute(staging_events_truncate)
+        cur.execute(staging_songs_truncate)
+        conn.commit()
+        events = load_new_events(cur, conn, config)
+        songs = load_new_songs(cur, conn, config)
+        if events or songs:
+            compute_song_keys(cur, conn)
+            merge_tables(cur, conn, wlm_options(config), {'log_data': events, 'song_data': songs})
+        print("Incremental load completed: {} log objects, {} song objects\n".format(len(events), len(songs)))
+    except Exception:
+        # nothing is recorded in etl_load_state, so the next run copies the same objects again
+        conn.rollback()
+        raise
@@ -0,0 +1,129 @@
+import re
+import json
+import time
+import threading
+import datetime
+
+STATEMENT_TARGET = re.compile(r'\b(COPY|INSERT INTO|MERGE INTO|UPDATE|DELETE FROM|TRUNCATE|CREATE TABLE IF NOT EXISTS|'
+                              r'CREATE TEMP TABLE|CREATE TABLE|DROP TABLE IF EXISTS|UNLOAD|VACUUM|ANALYZE)\s+\(?([\w\.]+)', re.IGNORECASE)
+# statements are named after the first of these verbs they contain,
+# so a multi statement upsert is named after its INSERT/MERGE, not its DROP TEMP TABLE
+VERB_PRIORITY = ['COPY', 'INSERT INTO', 'MERGE INTO', 'UNLOAD', 'UPDATE', 'DELETE FROM', 'TRUNCATE',
+                 'CREATE TABLE IF NOT EXISTS', 'CREATE TEMP TABLE', 'CREATE TABLE', 'DROP TABLE IF EXISTS',
+                 'VACUUM', 'ANALYZE']
+
+last_query_id_query = "SELECT pg_last_query_id();"
+copy_stats_query = ("""
+SELECT (SELECT COUNT(DISTINCT filename) FROM stl_load_commits WHERE query = %s),
+       (SELECT COALESCE(SUM(lines_scanned), 0) FROM stl_load_commits WHERE query = %s),
+       (SELECT COALESCE(SUM(transfer_size), 0) FROM stl_s3client WHERE query = %s);
+""")
+
+
+def describe(query):
+    """returns a short step name such as 'INSERT INTO songplays' for a statement"""
+    found = {}
+    for match in STATEMENT_TARGET.finditer(query):
+        verb = ' '.join(match.group(1).upper().split())
+        found.setdefault(verb, match.group(2))
+    for verb in VERB_PRIORITY:
+        if verb in found:
+            return '{} {}'.format(verb, found[verb])
+    return ' '.join(query.split())[:40]
+
+
+class Recorder:
+    """collects one record per executed statement and appends it to a JSON lines file"""
+
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+        self.path = None
+        self.capture_query_ids = True
+        self.run_id = None
+
+    def configure(self, path=None, capture_query_ids=True):
+        """sets the metrics file and whether Redshift system tables can be queried
+        Args:
+            path (string): JSON lines file records are appended to, None keeps them in memory only
+            capture_query_ids (bool): query pg_last_query_id()/STL tables, disable on plain Postgres
+        """
+        self.path = path or None
+        self.capture_query_ids = capture_query_ids
+        self.run_id = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%S')
+        self.records = []
+
+    def record(self, phase, step, seconds, rows=None, status='ok', error=None, **extra):
+        record = {'run_id': self.run_id, 'phase': phase, 'step': step, 'status': status,
+                  'seconds': round(seconds, 3), 'rows': rows}
+        record.update(extra)
+        if error is not None:
+            record['error'] = str(error).strip()
+        line = json.dumps(record, default=str)
+        with self.lock:
+            self.records.append(record)
+            print(line)
+            if self.path:
+                with open(self.path, 'a') as f:
+                    f.write(line + '\n')
+        return record
+
+    def summary(self):
+        """prints one line per recorded statement and totals per phase"""
+        print("\n{:<20} {:<40} {:>6} {:>9} {:>12} {:>12}".format('phase', 'step', 'status', 'seconds', 'rows', 'query_id'))
+        totals = {}
+        for record in self.records:
+            rows = record['rows'] if record['rows'] is not None and record['rows'] >= 0 else ''
+            print("{:<20} {:<40} {:>6} {:>9.2f} {:>12} {:>12}".format(
+                record['phase'], record['step'][:40], record['status'], record['seconds'], rows,
+                record.get('query_id') or ''))
+            totals[record['phase']] = totals.get(record['phase'], 0) + record['seconds']
+        for phase, seconds in totals.items():
+            print("{:<20} {:<40} {:>6} {:>9.2f}".format(phase, 'total', '', seconds))
+        failed = [record for record in self.records if record['status'] == 'failed']
+        if failed:
+            print("\n{} statement(s) failed:".format(len(failed)))
+            for record in failed:
+                print("  {} / {}: {}".format(record['phase'], record['step'], record.get('error')))
+        print()
+
+
+recorder = Recorder()
+
+
+def run_statement(cur, query, phase, step=None, params=None):
+    """executes a statement and records wall time, rows affected, query ID and COPY statistics
+    Failures are recorded and re-raised, so callers keep their own error handling.
+    Args:
+        cur (cursor): cursor to execute the statement on
+        query (string): SQL statement
+        phase (string): pipeline phase, e.g. load_staging_tables
+        step (string): step name, derived from the statement when omitted
+        params: optional query parameters
+    """
+    step = step or describe(query)
+    started = time.time()
+    try:
+        cur.execute(query, params)
+    except Exception as e:
+        recorder.record(phase, step, time.time() - started, status='failed', error=e)
+        raise
+    seconds = time.time() - started
+    rows = cur.rowcount
+    extra = {}
+    if recorder.capture_query_ids:
+        cur.execute(last_query_id_query)
+        extra['query_id'] = cur.fetchone()[0]
+        if step.startswith('COPY'):
+            cur.execute(copy_stats_query, (extra['query_id'],) * 3)
+            extra['files'], extra['lines'], extra['bytes'] = cur.fetchone()
+    return recorder.record(phase, step, seconds, rows, **extra)
+
+
+def configure_from(config):
+    """configures the shared recorder from the [ETL] section of dwh.cfg
+    Query IDs and the STL tables exist on Redshift only, so dialect = postgres never captures them.
+    """
+    recorder.configure(config.get('ETL', 'METRICS_FILE', fallback='') or None,
+                       config.getboolean('ETL', 'CAPTURE_QUERY_IDS', fallback=True) and
+                       config.get('ETL', 'DIALECT', fallback='redshift') != 'postgres')
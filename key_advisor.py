@@ -0,0 +1,199 @@
+import re
+import configparser
+from collections import Counter
+from upsert import dedupe_query
+from create_resources import update_config_file
+from db import connect
+import sql_queries
+from sql_queries import user_upsert, song_upsert, artist_upsert, top_ten_songs, top_ten_artists
+
+# join steps that move data between nodes; DS_DIST_NONE / DS_DIST_ALL_NONE are co-located
+REDISTRIBUTION_STEPS = ['DS_BCAST_INNER', 'DS_DIST_BOTH', 'DS_DIST_ALL_INNER', 'DS_DIST_INNER', 'DS_DIST_OUTER']
+# the sides of a join each step moves, the broadcast inner side is suggested DISTSTYLE ALL instead
+MOVED_SIDES = {'DS_DIST_BOTH': ['outer', 'inner'], 'DS_DIST_ALL_INNER': ['inner'], 'DS_DIST_INNER': ['inner'],
+               'DS_DIST_OUTER': ['outer'], 'DS_BCAST_INNER': []}
+# columns of a join condition, e.g. Hash Cond: (("outer".song_key = "inner".song_key))
+JOIN_COLUMN = re.compile(r'"(outer|inner)"\.(\w+)')
+SCAN_TABLE = re.compile(r'Seq Scan on (\w+)')
+
+table_skew_query = ("""
+SELECT "table", diststyle, tbl_rows, skew_rows, unsorted
+FROM svv_table_info
+WHERE "schema" = 'public'
+ORDER BY skew_rows DESC NULLS LAST;
+""")
+
+
+def explain_targets():
+    """returns (name, statement) pairs of the insert and validation queries to EXPLAIN
+    Upserts run several statements, so only their dedupe SELECT is explained.
+    """
+    return [('songplay_table_insert', sql_queries.songplay_insert),
+            ('user_table_insert', dedupe_query(user_upsert)),
+            ('song_table_insert', dedupe_query(song_upsert)),
+            ('artist_table_insert', dedupe_query(artist_upsert)),
+            ('time_table_insert', sql_queries.time_dimension_insert),
+            ('top_ten_songs', top_ten_songs),
+            ('top_ten_artists', top_ten_artists),
+            ('listen_time', sql_queries.listen_time_report)]
+
+
+def indent(line):
+    return len(line) - len(line.lstrip())
+
+
+def redistribution_steps(plan_lines):
+    """returns the joins of an EXPLAIN plan that redistribute or broadcast data
+    The tables are taken from the first scan below the join's outer and inner child,
+    the columns from its Hash or Merge Cond.
+    Return(s):
+        list of dicts with the plan line, step, and the outer and inner (table, column), None where unknown
+    """
+    lines = [line.rstrip() for line in plan_lines]
+    joins = []
+    for i, line in enumerate(lines):
+        step = next((step for step in REDISTRIBUTION_STEPS if step in line), None)
+        if step is None:
+            continue
+        body = []
+        for child in lines[i + 1:]:
+            if indent(child) <= indent(line):
+                break
+            body.append(child)
+        nodes = [j for j, child in enumerate(body) if child.lstrip().startswith('->')]
+        condition = ' '.join(child for child in body[:(nodes or [len(body)])[0]] if 'Cond:' in child)
+        columns = dict(JOIN_COLUMN.findall(condition))
+        # the first node below the join is its outer child, the next one at that depth its inner child
+        children = [j for j in nodes if indent(body[j]) == indent(body[nodes[0]])]
+        sides = {}
+        for side, start, end in zip(['outer', 'inner'], children, children[1:] + [len(body)]):
+            tables = [SCAN_TABLE.search(child) for child in body[start:end]]
+            table = next((match.group(1) for match in tables if match), None)
+            sides[side] = (table, columns.get(side)) if table else None
+        joins.append({'line': line.strip(), 'step': step, 'outer': sides.get('outer'), 'inner': sides.get('inner')})
+    return joins
+
+
+def explain_queries(cur):
+    """runs EXPLAIN on every target and returns name -> list of redistributing joins"""
+    findings = {}
+    for name, query in explain_targets():
+        try:
+            cur.execute('EXPLAIN ' + query.strip().rstrip(';'))
+            findings[name] = redistribution_steps(row[0] for row in cur.fetchall())
+        except Exception as e:
+            print("EXPLAIN {} failed: {}".format(name, e))
+    return findings
+
+
+def table_skew(cur, max_skew=4.0):
+    """returns svv_table_info rows whose skew_rows (largest / smallest slice) exceeds max_skew"""
+    cur.execute(table_skew_query)
+    return [row for row in cur.fetchall() if row[3] is not None and row[3] > max_skew]
+
+
+def suggest_keys(findings, skewed):
+    """derives distribution and sort keys from the redistributing joins and skewed tables
+    Each table moved by a join takes the join column it is moved on most often as DISTKEY
+    and SORTKEY, so the join becomes co-located. A table only ever broadcast as the inner
+    side gets DISTSTYLE ALL, and a skewed KEY table without a join column gets EVEN.
+    Args:
+        findings (dict): name -> joins as returned by explain_queries
+        skewed (list): svv_table_info rows as returned by table_skew
+    Return(s):
+        dict of table -> {'diststyle', 'distkey', 'sortkey'}, keys None where not suggested
+    """
+    moved = {}
+    broadcast = {}
+    for joins in findings.values():
+        for join in joins:
+            for side in MOVED_SIDES[join['step']]:
+                if join[side] and join[side][1]:
+                    moved.setdefault(join[side][0], Counter())[join[side][1]] += 1
+            if join['step'] == 'DS_BCAST_INNER' and join['inner']:
+                broadcast.setdefault(join['inner'][0], Counter())[join['inner'][1]] += 1
+    suggestions = {}
+    for table, columns in moved.items():
+        column = columns.most_common(1)[0][0]
+        suggestions[table] = {'diststyle': 'KEY', 'distkey': column, 'sortkey': column}
+    for table, columns in broadcast.items():
+        if table not in suggestions:
+            column = next((column for column, _ in columns.most_common() if column), None)
+            suggestions[table] = {'diststyle': 'ALL', 'distkey': None, 'sortkey': column}
+    for table, diststyle, rows, skew, unsorted in skewed:
+        if table not in suggestions and diststyle.upper().startswith('KEY'):
+            suggestions[table] = {'diststyle': 'EVEN', 'distkey': None, 'sortkey': None}
+    return suggestions
+
+
+def alter_statements(suggestions):
+    """returns the ALTER TABLE statements that apply suggest_keys to the existing tables"""
+    statements = []
+    for table, keys in sorted(suggestions.items()):
+        if keys['diststyle'] == 'KEY':
+            statements.append("ALTER TABLE {} ALTER DISTSTYLE KEY DISTKEY {};".format(table, keys['distkey']))
+        else:
+            statements.append("ALTER TABLE {} ALTER DISTSTYLE {};".format(table, keys['diststyle']))
+        if keys['sortkey']:
+            statements.append("ALTER TABLE {} ALTER SORTKEY ({});".format(table, keys['sortkey']))
+    return statements
+
+
+def key_profile(suggestions):
+    """returns the suggestions for the tables create_tables creates, as written by --apply
+    Suggestions naming a column the table does not have, e.g. one computed in a subquery, are left out.
+    """
+    columns = dict((table, [column for column, _ in definition]) for table, definition in
+                   (sql_queries.table_definition(query) for query in sql_queries.create_table_queries))
+    return {'tables': {table: keys for table, keys in suggestions.items() if table in columns and
+                       all(keys[key] in columns[table] for key in ['distkey', 'sortkey'] if keys[key])}}
+
+
+def advise(cur, conn):
+    """prints redistributing joins, skewed tables and the key changes derived from them
+    Args:
+        cur (cursor): cursor to execute queries
+        conn: open connection
+    Return(s):
+        (findings, skewed, suggestions) as returned by explain_queries, table_skew and suggest_keys
+    """
+    findings = explain_queries(cur)
+    skewed = table_skew(cur)
+    conn.commit()
+
+    print("Redistribution steps per query\n")
+    for name, joins in findings.items():
+        print("{}: {}".format(name, 'co-located' if not joins else ''))
+        for join in joins:
+            print("    " + join['line'])
+            print("        outer {} / inner {}".format(*[
+                '.'.join(part or '?' for part in join[side]) if join[side] else '?' for side in ['outer', 'inner']]))
+    print("\nSkewed tables (skew_rows > 4)\n")
+    for table, diststyle, rows, skew, unsorted in skewed:
+        print("{} {} rows={} skew_rows={}".format(table, diststyle, rows, skew))
+
+    suggestions = suggest_keys(findings, skewed)
+    if suggestions:
+        print("\nSuggested distribution and sort keys\n")
+        for statement in alter_statements(suggestions):
+            print(statement)
+    return findings, skewed, suggestions
+
+
+if __name__ == "__main__":
+    # python key_advisor.py [key_profile.json] [--apply]
+    import sys
+    import json
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    path = args[0] if args else 'key_profile.json'
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    conn = connect(config)
+    _, _, suggestions = advise(conn.cursor(), conn)
+    conn.close()
+    with open(path, 'w') as f:
+        json.dump(key_profile(suggestions), f, indent=2)
+    if '--apply' in sys.argv:
+        # sql_queries rewrites create_table_queries with it the next time create_tables runs
+        update_config_file('dwh.cfg', 'ETL', 'KEY_PROFILE', path)
+        print("key_profile set to {}, rerun create_tables.py/etl.py to rebuild the tables".format(path))
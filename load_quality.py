@@ -0,0 +1,232 @@
+import sys
+import json
+import time
+import datetime
+import sql_queries
+from sql_queries import (staging_events_copy_manifest, staging_songs_copy_manifest, load_file_commits,
+                         load_file_errors, last_load_error_query, load_errors_capture, staging_rejects_insert,
+                         staging_events_columns, staging_songs_columns)
+from incremental import strip_quotes, list_source_objects, write_manifest, coerce_event, coerce_song
+from instrumentation import run_statement, recorder, last_query_id_query
+
+# loaded: every line committed; rejected: committed with some lines in staging_rejects
+# quarantined: nothing committed and the file has errors, it is not retried
+# failed: nothing committed without errors of its own (aborted with another file), retried
+FILE_STATUSES = ['loaded', 'rejected', 'quarantined', 'failed']
+
+
+def file_outcomes(files, committed, errors):
+    """classifies the files of one COPY attempt
+    Args:
+        files: files the attempt was meant to load
+        committed (dict): file -> lines committed (STL_LOAD_COMMITS), empty when the COPY aborted
+        errors (dict): file -> rejected lines (STL_LOAD_ERRORS)
+    Return(s):
+        dict file -> {'lines': int, 'errors': int, 'status': one of FILE_STATUSES}
+    """
+    outcomes = {}
+    for name in files:
+        lines, rejected = committed.get(name), errors.get(name, 0)
+        if lines is not None:
+            status = 'rejected' if rejected else 'loaded'
+        else:
+            status = 'quarantined' if rejected else 'failed'
+        outcomes[name] = {'lines': lines or 0, 'errors': rejected, 'status': status}
+    return outcomes
+
+
+def load_with_retries(copy_files, files, retries=2):
+    """runs copy_files on files and then only on the failed ones, up to retries more times
+    A COPY that exceeds MAXERROR commits nothing: the files with errors are quarantined
+    and the others are retried without them.
+    Args:
+        copy_files: callable (files, attempt) -> (committed, errors), see file_outcomes
+        files: files to load
+        retries (int): number of retries of the failed files
+    Return(s):
+        dict file -> outcome of its last attempt, with 'attempts' added
+    """
+    outcomes = {}
+    pending = list(files)
+    for attempt in range(retries + 1):
+        if not pending:
+            break
+        committed, errors = copy_files(pending, attempt)
+        for name, outcome in file_outcomes(pending, committed, errors).items():
+            outcome['attempts'] = attempt + 1
+            outcomes[name] = outcome
+        pending = [name for name in pending if outcomes[name]['status'] == 'failed']
+    return outcomes
+
+
+def redshift_copy(cur, conn, config, table):
+    """returns a copy_files callable loading a staging table on Redshift
+    The first attempt copies the whole source prefix, retries copy the failed files
+    through a manifest written below MANIFEST_PREFIX. Rejected lines of every attempt
+    are copied from STL_LOAD_ERRORS into staging_rejects.
+    """
+    role_arn = config.get('IAM_ROLE', 'ARN')
+    maxerror = sql_queries.COPY_MAXERROR
+    if table == 'staging_events':
+        full_copy = sql_queries.staging_events_copy
+        manifest_copy = lambda manifest: staging_events_copy_manifest.format(manifest, role_arn, maxerror,
+                                                                             sql_queries.LOG_JSONPATH)
+    else:
+        full_copy = sql_queries.staging_songs_copy
+        manifest_copy = lambda manifest: staging_songs_copy_manifest.format(manifest, role_arn, maxerror)
+
+    def copy_files(files, attempt):
+        if attempt == 0:
+            query = full_copy
+        else:
+            manifest = write_manifest(config, files, name='retry-' + table)
+            if manifest is None:
+                print("no MANIFEST_PREFIX configured, {} failed files of {} are not retried".format(len(files), table))
+                return {}, {}
+            query = manifest_copy(manifest)
+
+        cur.execute(last_load_error_query)
+        errors_before = cur.fetchone()[0]
+        try:
+            record = run_statement(cur, query, 'load_staging_tables', step='COPY {} attempt {}'.format(table, attempt + 1))
+            query_id = record.get('query_id')
+            if query_id is None:
+                cur.execute(last_query_id_query)
+                query_id = cur.fetchone()[0]
+            conn.commit()
+            cur.execute(load_file_commits, (query_id,))
+            committed = dict(cur.fetchall())
+        except Exception as e:
+            conn.rollback()
+            print(e)
+            cur.execute(last_load_error_query)
+            query_id = cur.fetchone()[0]
+            if query_id == errors_before:
+                # failed before reading any line (e.g. access denied): every file is retried
+                return {}, {}
+            committed = {}
+
+        cur.execute(load_file_errors, (query_id,))
+        errors = dict(cur.fetchall())
+        cur.execute(load_errors_capture, (table, query_id))
+        conn.commit()
+        return committed, errors
+
+    return copy_files
+
+
+def read_lines(path):
+    """yields (line number, raw line, record or None) of a local JSON file"""
+    with open(path) as f:
+        text = f.read()
+    for line in parse_lines(text):
+        yield line
+
+
+def parse_lines(text):
+    """yields (line number, raw line, record or None) of a JSON text, None for lines that do not parse
+    A text holding one JSON document spread over several lines is returned as line 1.
+    """
+    try:
+        yield 1, text.strip(), json.loads(text)
+        return
+    except ValueError:
+        pass
+    for number, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            yield number, line, json.loads(line)
+        except ValueError:
+            yield number, line, None
+
+
+def local_copy(table, maxerror=None, cur=None):
+    """returns a copy_files callable standing in for COPY on local JSON files
+    Lines that do not parse or coerce are rejected. Like COPY, an attempt rejecting
+    more than maxerror (default COPY_MAXERROR) lines commits nothing. With a cursor the
+    good rows are inserted into the staging table and the rejected lines into staging_rejects.
+    """
+    maxerror = sql_queries.COPY_MAXERROR if maxerror is None else maxerror
+    columns, coerce = ((staging_events_columns, coerce_event) if table == 'staging_events'
+                       else (staging_songs_columns, coerce_song))
+    insert = 'INSERT INTO {} ({}) VALUES ({});'.format(table, ', '.join(columns), ', '.join(['%s'] * len(columns)))
+
+    def copy_files(files, attempt):
+        rows, committed, errors, rejects = [], {}, {}, []
+        # TIMESTAMP columns hold UTC without a zone
+        rejected_at = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        for path in files:
+            committed[path] = 0
+            for number, line, record in read_lines(path):
+                try:
+                    if not isinstance(record, dict):
+                        raise ValueError('Invalid JSONPath format')
+                    rows.append(coerce(record))
+                    committed[path] += 1
+                except (ValueError, TypeError, OverflowError) as e:
+                    errors[path] = errors.get(path, 0) + 1
+                    rejects.append((table, attempt, path, number, str(e)[:100], line[:1024], rejected_at))
+        if sum(errors.values()) > maxerror:
+            committed = {}
+        if cur is not None:
+            if committed:
+                cur.executemany(insert, rows)
+            cur.executemany(staging_rejects_insert, rejects)
+        return committed, errors
+
+    return copy_files
+
+
+def report(table, outcomes, seconds):
+    """prints the files that did not load cleanly and records per table totals"""
+    counts = {status: 0 for status in FILE_STATUSES}
+    for outcome in outcomes.values():
+        counts[outcome['status']] += 1
+    lines = sum(outcome['lines'] for outcome in outcomes.values())
+    rejected = sum(outcome['errors'] for outcome in outcomes.values())
+    retried = sum(1 for outcome in outcomes.values() if outcome['attempts'] > 1)
+    for name, outcome in sorted(outcomes.items()):
+        if outcome['status'] != 'loaded':
+            print("{:<12} {:>8} lines {:>6} rejected {:>2} attempt(s)  {}".format(
+                outcome['status'], outcome['lines'], outcome['errors'], outcome['attempts'], name))
+    recorder.record('load_check', table, seconds, lines, files=len(outcomes), rejected_lines=rejected,
+                    retried_files=retried, **counts)
+
+
+def check_and_load(table, copy_files, files, retries=2):
+    """loads files with retries and reports the per file outcome
+    Return(s):
+        dict file -> outcome
+    """
+    started = time.time()
+    outcomes = load_with_retries(copy_files, files, retries)
+    report(table, outcomes, time.time() - started)
+    return outcomes
+
+
+def load_staging_checked(cur, conn, config):
+    """loads both staging tables from S3 with MAXERROR, rejected line capture and failed file retries
+    Args:
+        cur (cursor): cursor to execute queries
+        conn: open connection
+        config: config object read from dwh.cfg
+    Return(s):
+        dict table -> dict file -> outcome
+    """
+    retries = config.getint('ETL', 'COPY_RETRIES', fallback=2)
+    sources = [('staging_events', config.get('S3', 'LOG_DATA')), ('staging_songs', config.get('S3', 'SONG_DATA'))]
+    print("Loading staging tables started\n")
+    results = {}
+    for table, location in sources:
+        files = list(list_source_objects(strip_quotes(location), config))
+        results[table] = check_and_load(table, redshift_copy(cur, conn, config, table), files, retries)
+    print("Loading staging tables completed\n")
+    return results
+
+
+if __name__ == "__main__":
+    # python load_quality.py <log_data_dir> <song_data_dir> [maxerror]: dry run on local files
+    maxerror = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    for table, directory in [('staging_events', sys.argv[1]), ('staging_songs', sys.argv[2])]:
+        check_and_load(table, local_copy(table, maxerror), list(list_source_objects(directory)))
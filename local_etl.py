@@ -0,0 +1,194 @@
+import sys
+import time
+import pandas as pd
+import sql_queries
+from incremental import list_source_objects, iter_json_records
+from sql_queries import staging_events_columns, staging_songs_columns, user_upsert, song_upsert, artist_upsert
+
+
+def song_key(title, artist, duration):
+    """hashes normalized title and artist (and the rounded duration with SONG_MATCH_DURATION)
+    into the song_key used to join events to songs, mirroring song_key_expression in sql_queries.
+    The hash is pandas' own, not FNV_HASH: the same events match, but the key values differ from Redshift's.
+    """
+    key = title.str.strip().str.lower() + '|' + artist.str.strip().str.lower()
+    if sql_queries.SONG_MATCH_DURATION:
+        key = key + '|' + pd.to_numeric(duration).round().astype('Int64').astype(str)
+    return pd.Series(pd.util.hash_pandas_object(key, index=False).astype('int64'), index=key.index).where(key.notna())
+
+
+def hour_key(ts):
+    """YYYYMMDDHH integer key of a timestamp series, mirroring hour_key_expression in sql_queries"""
+    return ts.dt.year * 1000000 + ts.dt.month * 10000 + ts.dt.day * 100 + ts.dt.hour
+
+
+def read_staging_events(log_dir):
+    """reads log_data JSON files into a frame shaped like staging_events
+    Columns follow the log_json_path.json mapping; ts is converted from epoch
+    milliseconds as COPY does with TIMEFORMAT 'epochmillisecs', empty strings become NULL.
+    Args:
+        log_dir (string): local directory laid out as log_data/YYYY/MM/*-events.json
+    """
+    records = [record for path in list_source_objects(log_dir) for record in iter_json_records(path)]
+    events = pd.DataFrame.from_records(records).reindex(columns=staging_events_columns)
+    events = events.replace('', None)
+    events['ts'] = pd.to_datetime(events['ts'], unit='ms')
+    events['registration'] = pd.to_numeric(events['registration']).astype('Int64')
+    events['userId'] = pd.to_numeric(events['userId']).astype('Int64')
+    plays = (events['page'] == 'NextSong') & events['song'].notna() & events['artist'].notna()
+    events['song_key'] = song_key(events['song'], events['artist'], events['length']).where(plays)
+    return events
+
+
+def read_staging_songs(song_dir):
+    """reads song_data JSON files into a frame shaped like staging_songs
+    Args:
+        song_dir (string): local directory laid out as song_data/A/B/C/TR*.json
+    """
+    records = [record for path in list_source_objects(song_dir) for record in iter_json_records(path)]
+    songs = pd.DataFrame.from_records(records).reindex(columns=staging_songs_columns).replace('', None)
+    songs['song_key'] = song_key(songs['title'], songs['artist_name'], songs['duration'])
+    return songs
+
+
+def upsert_frame(staging, spec):
+    """applies an upsert declaration from sql_queries: one row per natural key, latest order_by wins
+    NULLs sort last, like the DESC NULLS LAST of upsert.dedupe_query.
+    """
+    source_key = dict(spec['columns'])[spec['key']]
+    rows = staging[staging[source_key].notna()]
+    if spec.get('order_by'):
+        rows = rows.sort_values(spec['order_by'], ascending=False, kind='stable', na_position='last')
+    rows = rows.drop_duplicates(subset=[source_key], keep='first')
+    return rows[[source for _, source in spec['columns']]].set_axis(
+        [target for target, _ in spec['columns']], axis=1).reset_index(drop=True)
+
+
+def build_songplays(events, songs):
+    """songplay_table_insert: NextSong events matched to songs on song_key"""
+    plays = events[(events['page'] == 'NextSong') & events['song_key'].notna()]
+    matched = plays.merge(songs[['song_key', 'song_id', 'artist_id']].dropna(subset=['song_key']), on='song_key')
+    songplays = pd.DataFrame({
+        'start_time': matched['ts'],
+        # songplays.user_id is VARCHAR
+        'user_id': matched['userId'].astype('string'),
+        'level': matched['level'],
+        'song_id': matched['song_id'],
+        'artist_id': matched['artist_id'],
+        'session_id': matched['sessionId'],
+        'location': matched['location'],
+        'user_agent': matched['userAgent'],
+        'hour_key': hour_key(matched['ts'])}).drop_duplicates().reset_index(drop=True)
+    songplays.insert(0, 'songplay_id', range(len(songplays)))
+    return songplays
+
+
+def build_time(songplays):
+    """time_table_insert: one row per distinct songplays start_time"""
+    ts = pd.Series(songplays['start_time'].dropna().unique(), name='start_time')
+    return pd.DataFrame({
+        'start_time': ts,
+        'hour': ts.dt.hour,
+        'day': ts.dt.day,
+        'week': ts.dt.isocalendar().week.astype(int),
+        'month': ts.dt.month,
+        'year': ts.dt.year,
+        # EXTRACT(weekday) counts from Sunday = 0, stored in the VARCHAR weekday column
+        'weekday': ((ts.dt.dayofweek + 1) % 7).astype(str)})
+
+
+def build_time_hour(events):
+    """time_hour_table_insert: one row per calendar hour between the first and last NextSong event"""
+    plays = events.loc[events['page'] == 'NextSong', 'ts'].dropna()
+    if plays.empty:
+        hours = pd.Series([], dtype='datetime64[ns]', name='start_hour')
+    else:
+        hours = pd.Series(pd.date_range(plays.min().floor('h'), plays.max(), freq='h'), name='start_hour')
+    return pd.DataFrame({
+        'hour_key': hour_key(hours),
+        'start_hour': hours,
+        'hour': hours.dt.hour,
+        'day': hours.dt.day,
+        'week': hours.dt.isocalendar().week.astype(int),
+        'month': hours.dt.month,
+        'year': hours.dt.year,
+        'weekday': ((hours.dt.dayofweek + 1) % 7).astype(str)})
+
+
+def transform(events, songs):
+    """runs the insert_table_queries semantics in process
+    Return(s):
+        dict table name -> DataFrame
+    """
+    songplays = build_songplays(events, songs)
+    tables = {'songplays': songplays,
+              'users': upsert_frame(events, user_upsert),
+              'songs': upsert_frame(songs, song_upsert),
+              'artists': upsert_frame(songs, artist_upsert)}
+    if sql_queries.TIME_PROFILE == 'hourly':
+        tables['time_hour'] = build_time_hour(events)
+    else:
+        tables['time'] = build_time(songplays)
+    return tables
+
+
+def listen_bucket(hour):
+    """listen_time buckets of an hour of day"""
+    if 2 <= hour <= 8:
+        return '2-8'
+    if 9 <= hour <= 12:
+        return '9-12'
+    if 13 <= hour <= 18:
+        return '13-18'
+    if 19 <= hour <= 22:
+        return '19-22'
+    return '23-24, 0-2'
+
+
+def reports(tables):
+    """computes the validation_queries reports from the local tables
+    Return(s):
+        dict report name -> DataFrame
+    """
+    songplays = tables['songplays']
+    top_songs = (songplays.merge(tables['songs'][['song_id', 'title']], on='song_id')
+                 .groupby(['song_id', 'title']).size().rename('cnt').reset_index()
+                 .sort_values('cnt', ascending=False).head(10))
+    top_artists = (songplays.merge(tables['artists'][['artist_id', 'name']], on='artist_id')
+                   .groupby(['artist_id', 'name']).size().rename('cnt').reset_index()
+                   .rename(columns={'name': 'artist_name'}).sort_values('cnt', ascending=False).head(10))
+    if sql_queries.TIME_PROFILE == 'hourly':
+        hours = songplays.merge(tables['time_hour'][['hour_key', 'hour']], on='hour_key')['hour']
+    else:
+        hours = songplays.merge(tables['time'][['start_time', 'hour']], on='start_time')['hour']
+    listen_time = (hours.map(listen_bucket).rename('play_time').value_counts().rename('cnt').reset_index())
+    return {'top_ten_songs': top_songs, 'top_ten_artists': top_artists, 'listen_time': listen_time}
+
+
+def run_local(log_dir, song_dir):
+    """loads a local directory of JSON files and builds the fact and dimension tables
+    Args:
+        log_dir (string): directory holding the log_data layout
+        song_dir (string): directory holding the song_data layout
+    Return(s):
+        dict table name -> DataFrame, staging tables included
+    """
+    started = time.time()
+    events = read_staging_events(log_dir)
+    songs = read_staging_songs(song_dir)
+    loaded = time.time()
+    tables = transform(events, songs)
+    finished = time.time()
+
+    print("staged {} events and {} songs in {:.3f}s".format(len(events), len(songs), loaded - started))
+    print("transformed in {:.3f}s".format(finished - loaded))
+    for name, frame in tables.items():
+        print("{:<10} {:>10} rows".format(name, len(frame)))
+    tables['staging_events'] = events
+    tables['staging_songs'] = songs
+    return tables
+
+
+if __name__ == "__main__":
+    # python local_etl.py <log_data_dir> <song_data_dir>
+    run_local(sys.argv[1], sys.argv[2])
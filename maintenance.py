@@ -0,0 +1,123 @@
+import time
+import configparser
+from instrumentation import run_statement, recorder
+
+# staging tables are truncated by the next load, vacuuming them buys nothing
+SKIP_PREFIXES = ['staging_']
+# rough VACUUM throughput used to skip vacuums that cannot finish within the remaining budget
+VACUUM_MB_PER_SECOND = 50.0
+
+table_stats_query = ("""
+SELECT "table", COALESCE(unsorted, 0), COALESCE(stats_off, 0), tbl_rows,
+       COALESCE(estimated_visible_rows, tbl_rows), size
+FROM svv_table_info
+WHERE "schema" = 'public';
+""")
+
+
+def maintenance_options(config):
+    """reads the maintenance thresholds (percent) and time budget (seconds) from the [ETL] section"""
+    return {'budget': config.getfloat('ETL', 'MAINTENANCE_BUDGET', fallback=600),
+            'sort_threshold': config.getfloat('ETL', 'VACUUM_SORT_THRESHOLD', fallback=5),
+            'delete_threshold': config.getfloat('ETL', 'VACUUM_DELETE_THRESHOLD', fallback=5),
+            'analyze_threshold': config.getfloat('ETL', 'ANALYZE_THRESHOLD', fallback=10)}
+
+
+def decide(stats, sort_threshold=5, delete_threshold=5, analyze_threshold=10):
+    """returns the maintenance statements a table needs, cheapest reclaim first
+    Args:
+        stats (dict): table, unsorted (%), stats_off (%), rows, visible_rows, size_mb of SVV_TABLE_INFO
+    Return(s):
+        list of (action, reason)
+    """
+    actions = []
+    deleted = 100.0 * (stats['rows'] - stats['visible_rows']) / stats['rows'] if stats['rows'] else 0.0
+    if deleted >= delete_threshold:
+        actions.append(('VACUUM DELETE ONLY', '{:.1f}% deleted rows'.format(deleted)))
+    if stats['unsorted'] >= sort_threshold:
+        actions.append(('VACUUM SORT ONLY', '{:.1f}% unsorted'.format(stats['unsorted'])))
+    # a vacuum does not refresh statistics, so ANALYZE still follows it
+    if stats['stats_off'] >= analyze_threshold:
+        actions.append(('ANALYZE', 'stats {:.1f}% off'.format(stats['stats_off'])))
+    return actions
+
+
+def priority(stats):
+    """orders tables by how much data a stale sort order or stale statistics affects"""
+    return stats['size_mb'] * max(stats['unsorted'], stats['stats_off'], 1)
+
+
+def table_stats(cur):
+    """returns the SVV_TABLE_INFO statistics of the tables maintenance looks after"""
+    cur.execute(table_stats_query)
+    stats = [dict(zip(['table', 'unsorted', 'stats_off', 'rows', 'visible_rows', 'size_mb'], row))
+             for row in cur.fetchall()]
+    return [s for s in stats if not any(s['table'].startswith(prefix) for prefix in SKIP_PREFIXES)]
+
+
+def plan(stats, **thresholds):
+    """returns (table stats, action, reason) in the order they run, highest priority first"""
+    planned = []
+    for table in sorted(stats, key=priority, reverse=True):
+        for action, reason in decide(table, **thresholds):
+            planned.append((table, action, reason))
+    return planned
+
+
+def run_maintenance(conn, budget=600, **thresholds):
+    """runs ANALYZE/VACUUM where the table statistics call for it, within a time budget
+    VACUUM cannot run inside a transaction block, so the connection is switched to
+    autocommit for the duration. Every decision is recorded, including tables left alone
+    and statements skipped because the budget was used up.
+    Args:
+        conn: open connection
+        budget (float): seconds maintenance may take
+        thresholds: sort_threshold, delete_threshold and analyze_threshold in percent
+    """
+    cur = conn.cursor()
+    try:
+        stats = table_stats(cur)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print("maintenance skipped: {}".format(str(e).strip()))
+        return []
+
+    planned = plan(stats, **thresholds)
+    for table in stats:
+        if not decide(table, **thresholds):
+            recorder.record('maintenance', 'skip {}'.format(table['table']), 0, table['rows'], decision='none',
+                            unsorted=table['unsorted'], stats_off=table['stats_off'])
+
+    started = time.time()
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        for table, action, reason in planned:
+            remaining = budget - (time.time() - started)
+            estimate = table['size_mb'] / VACUUM_MB_PER_SECOND if action.startswith('VACUUM') else 0
+            if remaining <= 0 or estimate > remaining:
+                recorder.record('maintenance', '{} {}'.format(action, table['table']), 0, table['rows'],
+                                status='skipped', decision='budget', reason=reason,
+                                estimate=round(estimate, 1), remaining=round(max(remaining, 0), 1))
+                continue
+            print("{} {} ({})".format(action, table['table'], reason))
+            try:
+                run_statement(cur, '{} {};'.format(action, table['table']), 'maintenance',
+                              step='{} {}'.format(action, table['table']))
+            except Exception as e:
+                print(e)
+    finally:
+        conn.autocommit = autocommit
+    print("maintenance took {:.1f}s of a {:.0f}s budget\n".format(time.time() - started, budget))
+    return planned
+
+
+if __name__ == "__main__":
+    from db import connect
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    conn = connect(config)
+    run_maintenance(conn, **maintenance_options(config))
+    conn.close()
+    recorder.summary()
@@ -0,0 +1,209 @@
+import os
+import sys
+import time
+import datetime
+from decimal import Decimal
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from incremental import strip_quotes, is_s3, split_s3, get_s3_client, log_partition, coerce_event, coerce_song
+from prestage import list_source_sizes, TARGET_CHUNK_BYTES
+from stream_load import source_lines, parse_records
+from sql_queries import (staging_events_table_create, staging_songs_table_create, staging_events_columns,
+                         staging_songs_columns, staging_events_copy_parquet, staging_songs_copy_parquet,
+                         table_definition)
+from instrumentation import recorder
+
+# rows buffered per row group; bounds the memory of each worker
+BATCH_ROWS = 100000
+# an unsized VARCHAR is VARCHAR(256); Parquet COPY has no TRUNCATECOLUMNS, so values are cut here
+VARCHAR_BYTES = 256
+
+SOURCES = {'log_data': ('staging_events', staging_events_table_create, staging_events_columns, coerce_event),
+           'song_data': ('staging_songs', staging_songs_table_create, staging_songs_columns, coerce_song)}
+
+
+def column_kinds(ddl, columns):
+    """returns the staging column types in COPY column order, e.g. [('ts', 'TIMESTAMP'), ...]"""
+    types = dict((name.lower(), column_type) for name, column_type in table_definition(ddl)[1])
+    return [(column, types[column.lower()]) for column in columns]
+
+
+def arrow_schema(kinds):
+    """returns the pyarrow schema matching the staging column types"""
+    import pyarrow as pa
+    types = {'VARCHAR': pa.string(), 'INTEGER': pa.int32(), 'BIGINT': pa.int64(), 'FLOAT': pa.float64(),
+             # an unqualified DECIMAL column is DECIMAL(18,0)
+             'DECIMAL': pa.decimal128(18, 0), 'TIMESTAMP': pa.timestamp('ms')}
+    return pa.schema([(column, types[column_type.split('(')[0]]) for column, column_type in kinds])
+
+
+def cast(value, column_type):
+    """casts one coerced value to its staging column type like COPY would
+    BLANKSASNULL/EMPTYASNULL turn blank strings into NULL, TRUNCATECOLUMNS cuts long strings.
+    """
+    if value is None:
+        return None
+    if column_type == 'VARCHAR':
+        value = str(value)
+        if not value.strip():
+            return None
+        return value.encode('utf-8')[:VARCHAR_BYTES].decode('utf-8', 'ignore')
+    if column_type in ('INTEGER', 'BIGINT'):
+        return int(float(value))
+    if column_type == 'FLOAT':
+        return float(value)
+    if column_type == 'DECIMAL':
+        return Decimal(round(float(value)))
+    return value
+
+
+def convert_task(task):
+    """converts the source files of one task into one Parquet file, BATCH_ROWS rows per row group
+    Runs in a worker process; files are read line by line, S3 keys with a client created from task['credentials'].
+    Return(s):
+        dict with rows, errors, bytes_in, bytes_out and path
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    name, path = task['name'], task['path']
+    table, ddl, columns, coerce = SOURCES[name]
+    kinds = column_kinds(ddl, columns)
+    schema = arrow_schema(kinds)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    rows = errors = 0
+    batch = [[] for _ in kinds]
+    with pq.ParquetWriter(path, schema, compression='snappy') as writer:
+        for key in task['keys']:
+            for _, record in parse_records(source_lines(key, task['credentials'])):
+                try:
+                    values = [cast(value, column_type) for value, (_, column_type) in zip(coerce(record), kinds)]
+                except (ValueError, TypeError, OverflowError, AttributeError):
+                    errors += 1
+                    continue
+                for i, value in enumerate(values):
+                    batch[i].append(value)
+                rows += 1
+                if len(batch[0]) >= task['batch_rows']:
+                    writer.write_table(pa.Table.from_arrays([pa.array(b, type=f.type) for b, f in zip(batch, schema)],
+                                                            schema=schema))
+                    batch = [[] for _ in kinds]
+        if batch[0]:
+            writer.write_table(pa.Table.from_arrays([pa.array(b, type=f.type) for b, f in zip(batch, schema)],
+                                                    schema=schema))
+    return {'rows': rows, 'errors': errors, 'bytes_in': task['bytes'], 'bytes_out': os.path.getsize(path),
+            'path': path}
+
+
+def partition_of(name, key):
+    """returns the output partition of a source key: year=/month= for logs, none for songs
+    song_data is spread over many small directories; partitioning by them would write many small
+    Parquet files, so songs are only split into files of about target_bytes.
+    """
+    if name != 'log_data':
+        return ''
+    partition = log_partition(key)
+    if partition:
+        year, month = partition.split('/')
+        return 'year={}/month={}'.format(year, month)
+    return 'year=unknown'
+
+
+def plan_tasks(name, objects, output_dir, credentials=None, target_bytes=TARGET_CHUNK_BYTES,
+               batch_rows=BATCH_ROWS):
+    """groups source objects by partition and splits partitions into tasks of about target_bytes
+    Args:
+        name (string): log_data or song_data
+        objects: list of (key, size) as returned by prestage.list_source_sizes
+        output_dir (string): local directory the Parquet files are written to
+        credentials: (region, key, secret) for S3 sources, None for local files
+    Return(s):
+        list of task dicts for convert_task
+    """
+    partitions = {}
+    for key, size in objects:
+        partitions.setdefault(partition_of(name, key), []).append((key, size))
+    tasks = []
+    for partition, members in sorted(partitions.items()):
+        current, current_bytes = [], 0
+        for key, size in members:
+            if current and current_bytes + size > target_bytes:
+                tasks.append((partition, current, current_bytes))
+                current, current_bytes = [], 0
+            current.append(key)
+            current_bytes += size
+        if current:
+            tasks.append((partition, current, current_bytes))
+    return [{'name': name, 'keys': keys, 'bytes': size, 'credentials': credentials, 'batch_rows': batch_rows,
+             'path': os.path.join(output_dir, name, partition, 'part-{:05d}.parquet'.format(i))}
+            for i, (partition, keys, size) in enumerate(tasks)]
+
+
+def convert(tasks, workers=None):
+    """runs the conversion tasks on a process pool and reports the conversion rate
+    Return(s):
+        dict with the totals and the written paths
+    """
+    started = time.time()
+    totals = {'rows': 0, 'errors': 0, 'bytes_in': 0, 'bytes_out': 0, 'paths': []}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for future in as_completed([executor.submit(convert_task, task) for task in tasks]):
+            result = future.result()
+            for total in ['rows', 'errors', 'bytes_in', 'bytes_out']:
+                totals[total] += result[total]
+            totals['paths'].append(result['path'])
+    seconds = time.time() - started
+    name = tasks[0]['name'] if tasks else 'nothing'
+    print("Converted {} files of {} into {} Parquet files: {} rows ({} rejected), {:.1f} MB -> {:.1f} MB in {:.2f}s, "
+          "{:.0f} rows/s, {:.1f} MB/s".format(
+              sum(len(task['keys']) for task in tasks), name, len(tasks), totals['rows'], totals['errors'],
+              totals['bytes_in'] / 1048576.0, totals['bytes_out'] / 1048576.0, seconds,
+              totals['rows'] / seconds if seconds else 0, totals['bytes_in'] / 1048576.0 / seconds if seconds else 0))
+    recorder.record('parquet_stage', name, seconds, totals['rows'], files=len(tasks), errors=totals['errors'],
+                    bytes_in=totals['bytes_in'], bytes_out=totals['bytes_out'])
+    return totals
+
+
+def upload_parquet(config, output_dir, name, run):
+    """uploads the Parquet files of a source below MANIFEST_PREFIX and returns the prefix to COPY from"""
+    bucket, prefix = split_s3(strip_quotes(config.get('S3', 'MANIFEST_PREFIX')))
+    key_prefix = '{}/parquet/{}/{}'.format(prefix.rstrip('/'), run, name)
+    s3 = get_s3_client(config)
+    root = os.path.join(output_dir, name)
+    for directory, _, files in os.walk(root):
+        for file_name in files:
+            path = os.path.join(directory, file_name)
+            relative = os.path.relpath(path, root).replace(os.sep, '/')
+            s3.upload_file(path, bucket, '{}/{}'.format(key_prefix, relative))
+    return 's3://{}/{}/'.format(bucket, key_prefix)
+
+
+def parquet_stage(config, output_dir='parquet', workers=None):
+    """converts log_data and song_data to Parquet and returns COPY statements loading them
+    Requires a writable MANIFEST_PREFIX in the [S3] section of dwh.cfg.
+    Args:
+        config: config object read from dwh.cfg
+        output_dir (string): local working directory for the Parquet files
+        workers (int): worker processes, defaults to the number of CPUs
+    """
+    credentials = (config['REDSHIFT']['REGION_NAME'], config['AWS']['key'], config['AWS']['secret'])
+    run = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%d%H%M%S')
+    role_arn = config.get('IAM_ROLE', 'ARN')
+    queries = []
+    for name, option, template in [('log_data', 'LOG_DATA', staging_events_copy_parquet),
+                                   ('song_data', 'SONG_DATA', staging_songs_copy_parquet)]:
+        location = strip_quotes(config.get('S3', option))
+        tasks = plan_tasks(name, list_source_sizes(location, config), output_dir,
+                           credentials if is_s3(location) else None)
+        convert(tasks, workers)
+        queries.append(template.format(upload_parquet(config, output_dir, name, run), role_arn))
+    return queries
+
+
+if __name__ == "__main__":
+    # offline conversion of local directories:
+    # python parquet_stage.py <log_data_dir> <song_data_dir> <output_dir> [workers]
+    output_dir = sys.argv[3]
+    workers = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    for name, location in [('log_data', sys.argv[1]), ('song_data', sys.argv[2])]:
+        location = location.rstrip('/')
+        convert(plan_tasks(name, list_source_sizes(location), output_dir), workers)
@@ -0,0 +1,208 @@
+import os
+import sys
+import gzip
+import json
+import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from incremental import strip_quotes, is_s3, split_s3, get_s3_client, iter_json_records, parse_json_text, write_manifest
+import sql_queries
+from sql_queries import (staging_events_copy_gzip_manifest, staging_songs_copy_gzip_manifest,
+                         staging_events_copy_manifest, staging_songs_copy_manifest)
+
+# slices per node, see "Node type details" in the Redshift management guide
+NODE_SLICES = {
+    'dc2.large': 2,
+    'dc2.8xlarge': 16,
+    'ds2.xlarge': 2,
+    'ds2.8xlarge': 16,
+    'ra3.xlplus': 2,
+    'ra3.4xlarge': 4,
+    'ra3.16xlarge': 16,
+}
+
+# Redshift recommends 1 MB - 1 GB per file after compression; source JSON
+# compresses roughly 8:1, so this keeps compressed chunks comfortably above 1 MB
+TARGET_CHUNK_BYTES = 64 * 1024 * 1024
+# source objects downloaded concurrently ahead of the chunk being written
+FETCH_WORKERS = 8
+
+
+def cluster_slices(config, plan=None):
+    """returns the number of slices of the cluster the chunks are loaded into
+    Args:
+        config: config object read from dwh.cfg, its NODE_TYPE x NUM_NODES are the default
+        plan (dict): the sizing plan of an open load window, the node type and count the cluster was resized to
+    """
+    if plan:
+        node_type, num_nodes = plan['node_type'], plan['nodes']
+    else:
+        node_type, num_nodes = config.get('REDSHIFT', 'NODE_TYPE'), config.getint('REDSHIFT', 'NUM_NODES')
+    return NODE_SLICES.get(node_type, 2) * num_nodes
+
+
+def list_source_sizes(location, config=None, suffix='.json'):
+    """lists (key, size in bytes) below an S3 prefix or local directory"""
+    if is_s3(location):
+        bucket, prefix = split_s3(location)
+        s3 = get_s3_client(config)
+        for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                if obj['Key'].endswith(suffix):
+                    yield 's3://{}/{}'.format(bucket, obj['Key']), obj['Size']
+    else:
+        for root, dirs, files in os.walk(location):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith(suffix):
+                    path = os.path.join(root, name)
+                    yield path.replace(os.sep, '/'), os.path.getsize(path)
+
+
+def chunk_count(total_bytes, slices, target_bytes=TARGET_CHUNK_BYTES):
+    """returns the smallest multiple of slices that keeps chunks at or below target_bytes"""
+    per_slice = -(-total_bytes // (slices * target_bytes))
+    return slices * max(1, per_slice)
+
+
+def split_large(objects, target_bytes=TARGET_CHUNK_BYTES):
+    """splits objects into (small, large); a file of target_bytes or more is already a good COPY unit,
+    so it is listed in a manifest as it is instead of being downloaded and compacted
+    """
+    small, large = [], []
+    for key, size in objects:
+        (large if size >= target_bytes else small).append((key, size))
+    return small, large
+
+
+def assign_chunks(objects, chunks):
+    """spreads objects over chunks so each chunk receives about the same number of bytes
+    Args:
+        objects: list of (key, size)
+        chunks (int): number of chunks
+    Return(s):
+        list of key lists, one per chunk
+    """
+    assigned = [[] for _ in range(chunks)]
+    loads = [0] * chunks
+    for key, size in sorted(objects, key=lambda obj: -obj[1]):
+        smallest = loads.index(min(loads))
+        assigned[smallest].append(key)
+        loads[smallest] += size
+    return assigned
+
+
+def read_records(key, s3=None):
+    """yields JSON records from a local file or an S3 object"""
+    if is_s3(key):
+        bucket, name = split_s3(key)
+        for record in parse_json_text(s3.get_object(Bucket=bucket, Key=name)['Body'].read().decode('utf-8')):
+            yield record
+    else:
+        for record in iter_json_records(key):
+            yield record
+
+
+def fetch_records(keys, s3=None, workers=FETCH_WORKERS):
+    """yields the records of each key as a list, in key order
+    The objects are read on a thread pool, at most workers ahead of the caller, so
+    S3 round trips overlap while memory stays bounded by workers source files.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for key in keys:
+            pending.append(executor.submit(lambda key: list(read_records(key, s3)), key))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def compact(objects, output_dir, slices, name, s3=None, target_bytes=TARGET_CHUNK_BYTES, workers=FETCH_WORKERS):
+    """compacts many small JSON files into gzip compressed NDJSON chunks
+    The number of chunks is a multiple of the slice count so every slice gets
+    a share of the COPY. Chunks are written one at a time while the next source
+    files are fetched concurrently, so memory stays bounded by workers source files.
+    Args:
+        objects: list of (key, size) as returned by list_source_sizes
+        output_dir (string): local directory the chunks are written to
+        slices (int): number of slices of the target cluster
+        name (string): chunk file name prefix
+        s3: S3 client, only needed for S3 keys
+        workers (int): source files fetched concurrently
+    Return(s):
+        list of written chunk paths
+    """
+    objects = list(objects)
+    chunks = chunk_count(sum(size for _, size in objects), slices, target_bytes)
+    assigned = assign_chunks(objects, chunks)
+    records = fetch_records([key for keys in assigned for key in keys], s3, workers)
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for i, keys in enumerate(assigned):
+        path = os.path.join(output_dir, '{}-{:04d}.json.gz'.format(name, i))
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            for _ in keys:
+                for record in next(records):
+                    f.write(json.dumps(record))
+                    f.write('\n')
+        paths.append(path)
+    print("Compacted {} files into {} chunks for {} slices".format(len(objects), len(paths), slices))
+    return paths
+
+
+def upload_chunks(config, paths, name):
+    """uploads compacted chunks below MANIFEST_PREFIX and returns their S3 urls"""
+    bucket, prefix = split_s3(strip_quotes(config.get('S3', 'MANIFEST_PREFIX')))
+    run = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%d%H%M%S')
+    s3 = get_s3_client(config)
+    urls = []
+    for path in paths:
+        key = '{}/chunks/{}/{}/{}'.format(prefix.rstrip('/'), name, run, os.path.basename(path))
+        s3.upload_file(path, bucket, key)
+        urls.append('s3://{}/{}'.format(bucket, key))
+    return urls
+
+
+def prestage(config, output_dir='prestage', slices=None, target_bytes=TARGET_CHUNK_BYTES):
+    """compacts log_data and song_data and returns COPY statements that load the chunks via manifests
+    S3 files of target_bytes or more are not compacted; they are COPYed through a second,
+    uncompressed manifest listing them where they are.
+    Requires a writable MANIFEST_PREFIX in the [S3] section of dwh.cfg.
+    Args:
+        config: config object read from dwh.cfg
+        output_dir (string): local working directory for the chunks
+        slices (int): slices of the cluster the chunks are loaded into, defaults to cluster_slices(config)
+        target_bytes (int): chunk size, and the size from which source files are loaded as they are
+    """
+    slices = slices or cluster_slices(config)
+    s3 = get_s3_client(config)
+    role_arn = config.get('IAM_ROLE', 'ARN')
+    jsonpath = config.get('S3', 'LOG_JSONPATH')
+    queries = []
+    for name, option, chunks_template, files_template in [
+            ('log_data', 'LOG_DATA', staging_events_copy_gzip_manifest, staging_events_copy_manifest),
+            ('song_data', 'SONG_DATA', staging_songs_copy_gzip_manifest, staging_songs_copy_manifest)]:
+        location = strip_quotes(config.get('S3', option))
+        objects = list(list_source_sizes(location, config))
+        small, large = split_large(objects, target_bytes) if is_s3(location) else (objects, [])
+        if small:
+            paths = compact(small, os.path.join(output_dir, name), slices, name, s3, target_bytes)
+            manifest = write_manifest(config, upload_chunks(config, paths, name), name)
+            queries.append(chunks_template.format(manifest, role_arn, jsonpath) if name == 'log_data'
+                           else chunks_template.format(manifest, role_arn))
+        if large:
+            print("Listing {} files of {} MB or more as they are".format(len(large), target_bytes // 1048576))
+            manifest = write_manifest(config, [key for key, _ in large], name + '-large')
+            queries.append(files_template.format(manifest, role_arn, sql_queries.COPY_MAXERROR, jsonpath)
+                           if name == 'log_data' else
+                           files_template.format(manifest, role_arn, sql_queries.COPY_MAXERROR))
+    return queries
+
+
+if __name__ == "__main__":
+    # offline compaction of a local directory tree:
+    # python prestage.py <source_dir> <output_dir> [slices]
+    source_dir, output_dir = sys.argv[1], sys.argv[2]
+    slices = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    compact(list_source_sizes(source_dir), output_dir, slices, os.path.basename(source_dir.rstrip('/')))
@@ -0,0 +1,106 @@
+import time
+from instrumentation import run_statement
+from wlm import run_with_slots
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class Step:
+    """a SQL statement together with the tables it reads and writes and the WLM slots it claims"""
+
+    def __init__(self, name, query, inputs, outputs, slots=1):
+        self.name = name
+        self.query = query
+        self.inputs = set(inputs)
+        self.outputs = set(outputs)
+        self.slots = slots
+
+    def __repr__(self):
+        return 'Step({})'.format(self.name)
+
+
+def build_dependencies(steps):
+    """derives step dependencies from the declared table inputs and outputs
+    A step depends on every earlier step that writes a table it reads or writes,
+    and on every earlier step that reads a table it writes.
+    Args:
+        steps: list of Step in declaration order
+    Return(s):
+        dict step name -> set of step names it has to wait for
+    """
+    depends = {}
+    for i, step in enumerate(steps):
+        depends[step.name] = set()
+        for earlier in steps[:i]:
+            if (earlier.outputs & (step.inputs | step.outputs)) or (earlier.inputs & step.outputs):
+                depends[step.name].add(earlier.name)
+    return depends
+
+
+def run_step(pool, step):
+    """executes a single step on a pooled connection and returns its timing"""
+    conn = pool.acquire()
+    try:
+        cur = conn.cursor()
+        record = run_with_slots(cur, step.slots, lambda: run_statement(cur, step.query, 'insert_tables', step.name))
+        conn.commit()
+        cur.close()
+        return record['seconds']
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.release(conn)
+
+
+def run_steps(steps, pool, max_workers=4):
+    """runs steps concurrently, starting each one as soon as its dependencies finished
+    Args:
+        steps: list of Step in declaration order
+        pool: db.ConnectionPool the steps borrow their connections from
+        max_workers (int): number of concurrent statements
+    Return(s):
+        dict step name -> elapsed seconds, None for failed or skipped steps
+    """
+    depends = build_dependencies(steps)
+    pending = list(steps)
+    timings = {}
+    running = {}
+    started = time.time()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for step in list(pending):
+                if any(name not in timings for name in depends[step.name]):
+                    continue
+                pending.remove(step)
+                if any(timings[name] is None for name in depends[step.name]):
+                    print("Skipping {}: a dependency failed".format(step.name))
+                    timings[step.name] = None
+                    continue
+                print("Starting {}".format(step.name))
+                running[executor.submit(run_step, pool, step)] = step
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                try:
+                    timings[step.name] = future.result()
+                    print("Finished {} in {:.2f}s".format(step.name, timings[step.name]))
+                except Exception as e:
+                    timings[step.name] = None
+                    print("Failed {}: {}".format(step.name, e))
+
+    print_timings(steps, timings, time.time() - started)
+    return timings
+
+
+def print_timings(steps, timings, wall):
+    """prints per step timings next to the total wall time"""
+    print("\n{:<28} {:>10}".format('step', 'seconds'))
+    for step in steps:
+        elapsed = timings.get(step.name)
+        print("{:<28} {:>10}".format(step.name, 'failed' if elapsed is None else '{:.2f}'.format(elapsed)))
+    total = sum(t for t in timings.values() if t)
+    print("{:<28} {:>10.2f}".format('sum of steps', total))
+    print("{:<28} {:>10.2f}\n".format('wall time', wall))
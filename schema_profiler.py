@@ -0,0 +1,214 @@
+import re
+import sys
+import json
+import math
+import datetime
+import configparser
+from create_resources import update_config_file
+from db import connect
+import sql_queries
+from sql_queries import table_definition, apply_column_profile, user_upsert, song_upsert, artist_upsert
+
+# tables loaded by the pipeline; control and summary tables are small and already sized
+PROFILE_TABLES = ['staging_events', 'staging_songs', 'songplays', 'users', 'songs', 'artists', 'time', 'time_hour']
+AZ64_TYPES = ['INTEGER', 'INT', 'BIGINT', 'SMALLINT', 'DECIMAL', 'TIMESTAMP', 'DATE']
+PROFILE_ENCODINGS = ['az64', 'zstd', 'bytedict', 'raw']
+# a bytedict block holds a dictionary of up to 256 values
+BYTEDICT_MAX_DISTINCT = 255
+# an unsized VARCHAR is VARCHAR(256)
+DEFAULT_VARCHAR = 256
+
+# final table columns filled from staging columns that upsert.py does not declare
+SONGPLAY_SOURCES = {'level': ('staging_events', 'level'),
+                    'song_id': ('staging_songs', 'song_id'),
+                    'artist_id': ('staging_songs', 'artist_id'),
+                    'location': ('staging_events', 'location'),
+                    'user_agent': ('staging_events', 'userAgent')}
+
+analyze_compression_query = "ANALYZE COMPRESSION {} COMPROWS {};"
+table_rows_query = "SELECT COUNT(*) FROM {};"
+column_blocks_query = ("""
+SELECT b.col, COUNT(*)
+FROM stv_blocklist b
+JOIN (SELECT DISTINCT id FROM stv_tbl_perm WHERE TRIM(name) = %s) t
+  ON b.tbl = t.id
+GROUP BY b.col;
+""")
+
+
+def column_sources():
+    """returns (table, column) -> (staging table, column) for final table columns copied from staging"""
+    sources = {}
+    for spec in [user_upsert, song_upsert, artist_upsert]:
+        for target, source in spec['columns']:
+            sources[(spec['target'], target)] = (spec['source'], source)
+    for target, source in SONGPLAY_SOURCES.items():
+        sources[('songplays', target)] = source
+    return sources
+
+
+def sort_keys(ddl):
+    """returns the lower cased sort key columns of a CREATE TABLE statement"""
+    keys = set(column.strip().lower() for match in re.finditer(r'SORTKEY\s*\(([^)]*)\)', ddl, re.IGNORECASE)
+               for column in match.group(1).split(','))
+    keys.update(name.lower() for name in re.findall(r'^[ \t]*(\w+)\s+[^\n]*\bSORTKEY\b(?!\s*\()', ddl,
+                                                    re.IGNORECASE | re.MULTILINE))
+    return keys
+
+
+def varchar_size(max_length, headroom=0.25):
+    """returns the VARCHAR length for an observed maximum byte length: headroom added, rounded up to 8"""
+    size = int(math.ceil((max_length or 1) * (1 + headroom) / 8.0)) * 8
+    return min(max(size, 8), 65535)
+
+
+def choose_encoding(column_type, distinct, sortkey=False, recommended=None):
+    """picks AZ64, ZSTD or BYTEDICT for a column
+    Sort key columns stay RAW so range restricted scans can skip blocks. ANALYZE COMPRESSION's
+    recommendation is used when it is one of these, otherwise the type and cardinality decide.
+    """
+    if sortkey:
+        return 'raw'
+    if recommended in PROFILE_ENCODINGS and recommended != 'raw':
+        return recommended
+    if column_type.split('(')[0] in AZ64_TYPES:
+        return 'az64'
+    if column_type.startswith('VARCHAR') and distinct is not None and distinct <= BYTEDICT_MAX_DISTINCT:
+        return 'bytedict'
+    return 'zstd'
+
+
+def profile_columns(cur, table, columns):
+    """returns column -> (max byte length, approximate distinct count) of the VARCHAR columns"""
+    varchars = [name for name, column_type in columns if column_type.startswith('VARCHAR')]
+    if not varchars:
+        return {}
+    cur.execute('SELECT {} FROM {};'.format(', '.join(
+        'MAX(OCTET_LENGTH({0})), APPROXIMATE COUNT(DISTINCT {0})'.format(name) for name in varchars), table))
+    row = cur.fetchone()
+    return {name: (row[2 * i], row[2 * i + 1]) for i, name in enumerate(varchars)}
+
+
+def analyze_compression(cur, table, comprows):
+    """returns column -> (recommended encoding, estimated reduction %) from ANALYZE COMPRESSION
+    Empty when the statement is not available (e.g. on the Postgres stand-in).
+    """
+    try:
+        cur.execute(analyze_compression_query.format(table, comprows))
+        return {column.lower(): (encoding.lower(), float(reduction or 0))
+                for _, column, encoding, reduction in cur.fetchall()}
+    except Exception as e:
+        print("ANALYZE COMPRESSION {} skipped: {}".format(table, str(e).strip()))
+        return {}
+
+
+def column_blocks(cur, table, columns):
+    """returns column -> number of 1 MB blocks stored, empty off Redshift"""
+    try:
+        cur.execute(column_blocks_query, (table,))
+        blocks = dict(cur.fetchall())
+    except Exception:
+        return {}
+    return {name: blocks.get(i, 0) for i, (name, _) in enumerate(columns)}
+
+
+def plan_table(table, columns, sortkeys, observed, compression, sized, headroom):
+    """returns column -> {'varchar': length or None, 'encode': encoding} for one table
+    Columns copied from staging take the size of their staging column, so the inserts never overflow.
+    """
+    sources = column_sources()
+    plan = {}
+    for name, column_type in columns:
+        length, distinct = observed.get(name, (None, None))
+        size = None
+        if column_type == 'VARCHAR':
+            source = sources.get((table, name))
+            # an empty column keeps the unsized VARCHAR
+            size = sized.get(source) or (varchar_size(length, headroom) if length else None)
+            sized[(table, name)] = size
+        recommended = compression.get(name.lower(), (None, 0))[0]
+        plan[name] = {'varchar': size,
+                      'encode': choose_encoding(column_type, distinct, name.lower() in sortkeys, recommended)}
+    return plan
+
+
+def declared_width(columns, plan=None):
+    """returns the declared bytes of the VARCHAR columns of one row, as hashed and sorted by the inserts"""
+    width = 0
+    for name, column_type in columns:
+        if column_type.startswith('VARCHAR'):
+            match = re.search(r'\((\d+)\)', column_type)
+            size = int(match.group(1)) if match else DEFAULT_VARCHAR
+            width += (plan or {}).get(name, {}).get('varchar') or size
+    return width
+
+
+def build_profile(cur, headroom=0.25, comprows=100000):
+    """profiles the loaded tables and returns (profile, report rows)
+    Staging tables are profiled first so final table columns can reuse their sizes.
+    """
+    definitions = {}
+    for query in sql_queries.create_table_queries:
+        table, columns = table_definition(query)
+        if table in PROFILE_TABLES:
+            definitions[table] = (query, columns)
+
+    tables, report, sized = {}, [], {}
+    for table in [table for table in PROFILE_TABLES if table in definitions]:
+        query, columns = definitions[table]
+        cur.execute(table_rows_query.format(table))
+        rows = cur.fetchone()[0]
+        observed = profile_columns(cur, table, columns)
+        compression = analyze_compression(cur, table, comprows)
+        plan = plan_table(table, columns, sort_keys(query), observed, compression, sized, headroom)
+        tables[table] = plan
+
+        blocks = column_blocks(cur, table, columns)
+        stored = sum(blocks.values())
+        saved = sum(count * compression.get(name.lower(), (None, 0))[1] / 100.0 for name, count in blocks.items())
+        report.append({'table': table, 'rows': rows,
+                       'width_before': declared_width(columns), 'width_after': declared_width(columns, plan),
+                       'blocks_before': stored, 'blocks_after': int(round(stored - saved))})
+    profile = {'profiled_at': datetime.datetime.now(datetime.timezone.utc).isoformat(), 'headroom': headroom, 'tables': tables}
+    return profile, report
+
+
+def print_report(profile, report):
+    """prints the chosen column definitions and the estimated savings per table"""
+    for table, plan in profile['tables'].items():
+        print("\n{}".format(table))
+        for name, column in plan.items():
+            print("    {:<20} {:<14} ENCODE {}".format(
+                name, 'VARCHAR({})'.format(column['varchar']) if column['varchar'] else '', column['encode']))
+
+    print("\n{:<16} {:>12} {:>12} {:>12} {:>16} {:>10} {:>10}".format(
+        'table', 'rows', 'width', 'new width', 'varchar MB/scan', 'MB', 'new MB'))
+    for row in report:
+        print("{:<16} {:>12} {:>12} {:>12} {:>16} {:>10} {:>10}".format(
+            row['table'], row['rows'], row['width_before'], row['width_after'],
+            '{:.1f} -> {:.1f}'.format(row['rows'] * row['width_before'] / 1048576.0,
+                                      row['rows'] * row['width_after'] / 1048576.0),
+            row['blocks_before'] or '-', row['blocks_after'] or '-'))
+
+
+if __name__ == "__main__":
+    # python schema_profiler.py [profile.json] [--apply]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    path = args[0] if args else 'column_profile.json'
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    conn = connect(config)
+    # ANALYZE COMPRESSION cannot run inside a transaction block
+    conn.autocommit = True
+    profile, report = build_profile(conn.cursor(), config.getfloat('ETL', 'COLUMN_HEADROOM', fallback=0.25))
+    conn.close()
+    with open(path, 'w') as f:
+        json.dump(profile, f, indent=2)
+    print_report(profile, report)
+    print("\nProfiled CREATE TABLE statements\n")
+    for query in sql_queries.create_table_queries:
+        print(apply_column_profile(query, profile['tables']))
+    if '--apply' in sys.argv:
+        # sql_queries rewrites create_table_queries with it the next time create_tables runs
+        update_config_file('dwh.cfg', 'ETL', 'COLUMN_PROFILE', path)
+        print("column_profile set to {}, rerun create_tables.py/etl.py to rebuild the tables".format(path))
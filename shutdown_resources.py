@@ -1,51 +1,139 @@
-import configparser
-import boto3
-import json
-from create_resources import get_config
+import sys
+import datetime
+from create_resources import get_config, update_config_file, wait_for_cluster, report
+from wlm import wlm_options
 
-def shutdown_resources():
+# pause: keep cluster, role, security group and parameter group, resumed by create_resources
+# snapshot: final snapshot then delete everything, restored by create_resources
+# delete: delete everything, the next run reloads from S3
+SHUTDOWN_MODES = ['pause', 'snapshot', 'delete']
+
+
+def pause_cluster(redshift, config, progress=report, **wait_options):
+    """pauses the cluster; storage is kept and only storage is billed while paused"""
+    identifier = config['REDSHIFT']['CLUSTER_IDENTIFIER']
+    progress('Pausing Redshift cluster {}'.format(identifier))
+    redshift.pause_cluster(ClusterIdentifier=identifier)
+    wait_for_cluster(redshift, config, progress, target='paused', **wait_options)
+
+
+def delete_cluster(redshift, config, progress=report, snapshot=None, **wait_options):
+    """deletes the cluster, taking a final snapshot named snapshot unless it is None"""
+    identifier = config['REDSHIFT']['CLUSTER_IDENTIFIER']
+    if snapshot:
+        progress('Deleting Redshift cluster {} with final snapshot {}. This might take a few minutes ...'.format(
+            identifier, snapshot))
+        redshift.delete_cluster(ClusterIdentifier=identifier,
+                                SkipFinalClusterSnapshot=False,
+                                FinalClusterSnapshotIdentifier=snapshot)
+    else:
+        progress('Deleting Redshift cluster {}. This might take a few minutes ...'.format(identifier))
+        redshift.delete_cluster(ClusterIdentifier=identifier, SkipFinalClusterSnapshot=True)
+    wait_for_cluster(redshift, config, progress, target='missing', **wait_options)
+
+
+def snapshot_name(config, now=None):
+    """returns a final snapshot identifier such as sparkify-dwh-20181130-221500"""
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    return '{}-{}'.format(config['REDSHIFT']['CLUSTER_IDENTIFIER'], now.strftime('%Y%m%d-%H%M%S'))
+
+
+def delete_role_and_ingress(iam, ec2, config, progress=report):
+    """deletes the IAM role with its attached policy and revokes the ingress rule"""
+    # delete role and attached policy
+    progress('Deleting IAM Role {}'.format(config['REDSHIFT']['ROLE_NAME']))
+    iam.detach_role_policy(RoleName=config['REDSHIFT']['ROLE_NAME'],
+                           PolicyArn="arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess")
+    iam.delete_role(RoleName=config['REDSHIFT']['ROLE_NAME'])
+
+    # revoke ingress rules; none was added for a cluster outside a VPC (see create_ec2_sg)
+    from botocore.exceptions import ClientError
+    sg = list(ec2.security_groups.all())[0]
+    progress('Revoking Ingress rules for SecurityGroup {}'.format(sg))
+    try:
+        sg.revoke_ingress(GroupName=sg.group_name,
+                          CidrIp='0.0.0.0/0',
+                          IpProtocol='tcp',
+                          FromPort=int(config['REDSHIFT']['DB_PORT']),
+                          ToPort=int(config['REDSHIFT']['DB_PORT']))
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidPermission.NotFound':
+            raise
+        progress('No ingress rule to revoke in SecurityGroup {}'.format(sg))
+
+
+def delete_parameter_group(redshift, config, progress=report):
+    """deletes the WLM parameter group once no cluster uses it; a restored cluster recreates it"""
+    name = wlm_options(config)['parameter_group']
+    if not name:
+        return
+    progress('Deleting parameter group {}'.format(name))
+    try:
+        redshift.delete_cluster_parameter_group(ParameterGroupName=name)
+    except redshift.exceptions.ClusterParameterGroupNotFoundFault:
+        pass
+
+
+def shutdown(config, iam, redshift, ec2, mode, progress=report, config_file='dwh.cfg', **wait_options):
+    """
+    Applies a shutdown mode to the cluster and its role/security group.
+    Arg(s):
+        config: an object that contains necessary information about the cluster
+        iam, redshift: IAM and Redshift clients
+        ec2: an EC2 resource
+        mode (string): one of SHUTDOWN_MODES
+        progress: callable receiving progress messages
+        config_file (string): file the final snapshot identifier is recorded in
+        wait_options: delay/timeout/sleep passed to wait_for_cluster
+    Return(s):
+        the final snapshot identifier in snapshot mode, None otherwise
+    """
+    if mode not in SHUTDOWN_MODES:
+        raise ValueError('unknown shutdown mode {!r}, expected one of {}'.format(mode, SHUTDOWN_MODES))
+    if mode == 'pause':
+        pause_cluster(redshift, config, progress, **wait_options)
+        return None
+
+    snapshot = snapshot_name(config) if mode == 'snapshot' else None
+    delete_cluster(redshift, config, progress, snapshot, **wait_options)
+    # create_resources restores the next cluster from the snapshot; after a delete it creates a fresh one
+    config.set('REDSHIFT', 'SNAPSHOT_IDENTIFIER', snapshot or '')
+    update_config_file(config_file, 'REDSHIFT', 'SNAPSHOT_IDENTIFIER', snapshot or '')
+    delete_parameter_group(redshift, config, progress)
+    delete_role_and_ingress(iam, ec2, config, progress)
+    return snapshot
+
+
+def shutdown_resources(mode=None, config_file='dwh.cfg'):
     """shutdowns resources created
     Args:
-        cur (cursor): cursor to execute queries
-        conn: open connection 
+        mode (string): pause, snapshot or delete, defaults to SHUTDOWN_MODE in [REDSHIFT]
+        config_file (string): config file the cluster is described in
     """
+    import boto3
 
-    
     # parse config file
-    config = get_config('dwh.cfg')
-    
+    config = get_config(config_file)
+    mode = mode or config.get('REDSHIFT', 'SHUTDOWN_MODE', fallback='delete')
+
     # create resources/clients
     iam = boto3.client('iam', region_name=config['REDSHIFT']['REGION_NAME'],aws_access_key_id=config['AWS']['key'], aws_secret_access_key=config['AWS']['secret'])
     redshift = boto3.client('redshift', region_name=config['REDSHIFT']['REGION_NAME'],aws_access_key_id=config['AWS']['key'], aws_secret_access_key=config['AWS']['secret'])
     ec2 = boto3.resource('ec2', region_name=config['REDSHIFT']['REGION_NAME'],aws_access_key_id=config['AWS']['key'], aws_secret_access_key=config['AWS']['secret'])
 
     try:
-        # delete cluster
-        print('Deleting Redshift cluster {}. This might take a few minutes ...'.format(config['REDSHIFT']['CLUSTER_IDENTIFIER']))
-        response = redshift.delete_cluster( ClusterIdentifier=config['REDSHIFT']['cluster_identifier'],  
-                                            SkipFinalClusterSnapshot=True)
-        # Wait for up to 30 minutes until the cluster is deleted successfully
-        redshift.get_waiter('cluster_deleted').wait(ClusterIdentifier=config['REDSHIFT']['cluster_identifier'],
-                                                    WaiterConfig={'Delay': 30, 'MaxAttempts': 60})
-
-        # delete role and attached policy
-        print('Deleting IAM Role {}'.format(config['REDSHIFT']['ROLE_NAME']))
-        iam.detach_role_policy(RoleName=config['REDSHIFT']['ROLE_NAME'],
-                               PolicyArn="arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess")
-        iam.delete_role(RoleName=config['REDSHIFT']['ROLE_NAME'])
-
-        # revoke ingress rules
-        sg = list(ec2.security_groups.all())[0]
-        print('Revoking Ingress rules for SecurityGroup {}'.format(sg))
-        sg.revoke_ingress(GroupName=sg.group_name,
-                          CidrIp='0.0.0.0/0',
-                          IpProtocol='tcp',
-                          FromPort=int(config['REDSHIFT']['DB_PORT']),
-                          ToPort=int(config['REDSHIFT']['DB_PORT']))
+        snapshot = shutdown(config, iam, redshift, ec2, mode, config_file=config_file)
     except Exception as e:
         print(e)
+        return
 
-    print('Clean up completed. All resources deleted.')
+    if mode == 'pause':
+        print('Clean up completed. Cluster paused, role and security group kept.')
+    elif snapshot:
+        print('Clean up completed. All resources deleted, data kept in snapshot {}.'.format(snapshot))
+    else:
+        print('Clean up completed. All resources deleted.')
 
 if __name__ == "__main__":
-    shutdown_resources()
\ No newline at end of file
+    # python shutdown_resources.py [pause|snapshot|delete]
+    shutdown_resources(sys.argv[1] if len(sys.argv) > 1 else None)
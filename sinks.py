@@ -0,0 +1,120 @@
+import os
+import csv
+
+
+class ConsoleSink:
+    """prints rows as an aligned text table"""
+
+    def __init__(self, width=24):
+        self.width = width
+        self.rows = 0
+
+    def open(self, columns):
+        print(' | '.join(str(column)[:self.width].ljust(self.width) for column in columns))
+        print('-+-'.join('-' * self.width for _ in columns))
+
+    def write(self, row):
+        print(' | '.join(str(value)[:self.width].ljust(self.width) for value in row))
+        self.rows += 1
+
+    def close(self):
+        return self.rows
+
+
+class ListSink:
+    """collects rows in memory, only meant for small results such as the LIMIT 10 reports"""
+
+    def __init__(self, echo=True):
+        self.echo = echo
+        self.rows = []
+
+    def open(self, columns):
+        pass
+
+    def write(self, row):
+        if self.echo:
+            print(row)
+        self.rows.append(row)
+
+    def close(self):
+        return self.rows
+
+
+class CsvSink:
+    """writes rows to a CSV file as they arrive"""
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = 0
+        self.file = None
+        self.writer = None
+
+    def open(self, columns):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.file = open(self.path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns)
+
+    def write(self, row):
+        self.writer.writerow(row)
+        self.rows += 1
+
+    def close(self):
+        if self.file:
+            self.file.close()
+        print("wrote {} rows to {}".format(self.rows, self.path))
+        return self.rows
+
+
+class ParquetSink:
+    """writes rows to a Parquet file in row groups of batch_size rows (requires pyarrow)"""
+
+    def __init__(self, path, batch_size=50000):
+        self.path = path
+        self.batch_size = batch_size
+        self.rows = 0
+        self.batch = []
+        self.columns = None
+        self.writer = None
+
+    def open(self, columns):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.columns = list(columns)
+
+    def write(self, row):
+        self.batch.append(row)
+        self.rows += 1
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if not self.batch:
+            return
+        table = pa.Table.from_arrays([pa.array(list(values)) for values in zip(*self.batch)], names=self.columns)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table.cast(self.writer.schema))
+        self.batch = []
+
+    def close(self):
+        self.flush()
+        if self.writer:
+            self.writer.close()
+        print("wrote {} rows to {}".format(self.rows, self.path))
+        return self.rows
+
+
+def make_sink(kind, name, output_dir='results'):
+    """returns a sink for the configured kind: console, csv or parquet
+    Args:
+        kind (string): sink type
+        name (string): report name, used for the output file name
+        output_dir (string): directory file sinks write to
+    """
+    if kind == 'csv':
+        return CsvSink(os.path.join(output_dir, name + '.csv'))
+    if kind == 'parquet':
+        return ParquetSink(os.path.join(output_dir, name + '.parquet'))
+    return ConsoleSink()
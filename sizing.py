@@ -0,0 +1,230 @@
+import os
+import sys
+import json
+import time
+import datetime
+import configparser
+from statistics import median
+from incremental import strip_quotes
+from prestage import list_source_sizes, NODE_SLICES
+from create_resources import describe_cluster, wait_for_cluster, report
+from instrumentation import recorder
+
+# on demand price per node hour (USD, us-west-2), the nodes an elastic resize can reach and
+# the bytes of source JSON one slice loads and transforms per second before any run was measured
+NODE_TYPES = {
+    'dc2.large': {'price': 0.25, 'min_nodes': 1, 'max_nodes': 32, 'bytes_per_slice_second': 4 * 1048576},
+    'dc2.8xlarge': {'price': 4.80, 'min_nodes': 2, 'max_nodes': 128, 'bytes_per_slice_second': 6 * 1048576},
+    'ra3.xlplus': {'price': 1.086, 'min_nodes': 1, 'max_nodes': 32, 'bytes_per_slice_second': 5 * 1048576},
+    'ra3.4xlarge': {'price': 3.26, 'min_nodes': 2, 'max_nodes': 128, 'bytes_per_slice_second': 6 * 1048576},
+    'ra3.16xlarge': {'price': 13.04, 'min_nodes': 2, 'max_nodes': 128, 'bytes_per_slice_second': 6 * 1048576},
+}
+# COPY opens, reads and commits every file, so a small file costs about as much as this many bytes
+FILE_OVERHEAD_BYTES = 1048576
+# an elastic resize keeps the cluster read only for about this long, paid once up and once down
+RESIZE_SECONDS = 15 * 60
+# measured runs per node type the throughput estimate is taken from
+HISTORY_RUNS = 10
+
+
+def sizing_options(config):
+    """reads the sizing settings of the [ETL] section of dwh.cfg"""
+    node_types = [node_type.strip() for node_type in
+                  config.get('ETL', 'SIZING_NODE_TYPES', fallback=config.get('REDSHIFT', 'NODE_TYPE')).split(',')
+                  if node_type.strip()]
+    unknown = [node_type for node_type in node_types if node_type not in NODE_TYPES]
+    if unknown:
+        raise ValueError('unknown sizing_node_types {}, expected some of {}'.format(', '.join(unknown),
+                                                                                   ', '.join(NODE_TYPES)))
+    return {'node_types': node_types,
+            'max_nodes': config.getint('ETL', 'SIZING_MAX_NODES', fallback=8),
+            'target_seconds': config.getint('ETL', 'SIZING_TARGET_MINUTES', fallback=60) * 60,
+            'history': config.get('ETL', 'SIZING_HISTORY', fallback='sizing.jsonl')}
+
+
+def source_volume(config):
+    """lists LOG_DATA and SONG_DATA and returns their total bytes and file count, one object at a time"""
+    volume = {'bytes': 0, 'files': 0}
+    for option in ['LOG_DATA', 'SONG_DATA']:
+        for _, size in list_source_sizes(strip_quotes(config.get('S3', option)), config):
+            volume['bytes'] += size
+            volume['files'] += 1
+    return volume
+
+
+def load_history(path):
+    """returns node type -> measured bytes per slice second, the median of its last HISTORY_RUNS runs"""
+    if not path or not os.path.exists(path):
+        return {}
+    runs = {}
+    with open(path) as f:
+        for line in f:
+            run = json.loads(line)
+            if run.get('bytes_per_slice_second'):
+                runs.setdefault(run['node_type'], []).append(run['bytes_per_slice_second'])
+    return {node_type: median(rates[-HISTORY_RUNS:]) for node_type, rates in runs.items()}
+
+
+def predicted_seconds(volume, node_type, nodes, rates=None):
+    """returns the modelled seconds of the load window (COPY and inserts) on nodes x node_type"""
+    rate = (rates or {}).get(node_type, NODE_TYPES[node_type]['bytes_per_slice_second'])
+    effective = volume['bytes'] + volume['files'] * FILE_OVERHEAD_BYTES
+    return effective / float(NODE_SLICES[node_type] * nodes * rate)
+
+
+def candidates(baseline, options):
+    """returns the (node_type, nodes) an elastic resize can reach from baseline
+    An elastic resize to the same node type stays within half and double the node count,
+    and cannot turn a multi-node cluster into a single node.
+    """
+    base_type, base_nodes = baseline
+    sizes = []
+    for node_type in options['node_types']:
+        limits = NODE_TYPES[node_type]
+        low, high = max(limits['min_nodes'], 2 if base_nodes > 1 else 1), min(limits['max_nodes'], options['max_nodes'])
+        if node_type == base_type:
+            low, high = max(low, -(-base_nodes // 2)), min(high, base_nodes * 2)
+        sizes.extend((node_type, nodes) for nodes in range(low, high + 1))
+    if tuple(baseline) not in sizes:
+        sizes.append(tuple(baseline))
+    return sizes
+
+
+def size_plans(volume, baseline, options, rates=None):
+    """returns the modelled seconds and cost of the load window for every reachable size
+    Sizes other than the baseline add two elastic resizes of RESIZE_SECONDS.
+    """
+    plans = []
+    for node_type, nodes in candidates(baseline, options):
+        seconds = predicted_seconds(volume, node_type, nodes, rates)
+        resize = 0 if (node_type, nodes) == tuple(baseline) else 2 * RESIZE_SECONDS
+        plans.append({'node_type': node_type, 'nodes': nodes, 'predicted_seconds': seconds, 'resize_seconds': resize,
+                      'cost': round((seconds + resize) / 3600.0 * nodes * NODE_TYPES[node_type]['price'], 4)})
+    return plans
+
+
+def choose_size(volume, baseline, options, rates=None):
+    """picks the cheapest cluster size that finishes the load window within target_seconds
+    The resizes make small loads cheapest on the baseline. When no size meets the
+    target the fastest one is taken.
+    Args:
+        volume (dict): bytes and files from source_volume
+        baseline: (node_type, nodes) the cluster runs at outside the load window
+        options (dict): sizing_options
+        rates (dict): measured throughput from load_history
+    Return(s):
+        dict with node_type, nodes, predicted_seconds, resize_seconds, cost, baseline and the volume
+    """
+    plans = size_plans(volume, baseline, options, rates)
+    total = lambda plan: plan['predicted_seconds'] + plan['resize_seconds']
+    fast_enough = [plan for plan in plans if total(plan) <= options['target_seconds']]
+    if fast_enough:
+        plan = min(fast_enough, key=lambda plan: (plan['cost'], plan['nodes']))
+    else:
+        plan = min(plans, key=lambda plan: (total(plan), plan['cost']))
+    plan.update(baseline=list(baseline), bytes=volume['bytes'], files=volume['files'])
+    return plan
+
+
+def get_redshift_client(config):
+    """creates a Redshift client from the AWS credentials in dwh.cfg"""
+    import boto3
+    return boto3.client('redshift', region_name=config['REDSHIFT']['REGION_NAME'],
+                        aws_access_key_id=config['AWS']['key'],
+                        aws_secret_access_key=config['AWS']['secret'])
+
+
+def resize_cluster(redshift, config, node_type, nodes, progress=report, **wait_options):
+    """elastic resizes the cluster to nodes x node_type unless it already is, and waits for it
+    Return(s):
+        cluster_props: a cluster descriptor
+    """
+    cluster_props = describe_cluster(redshift, config)
+    if (cluster_props['NodeType'], cluster_props['NumberOfNodes']) == (node_type, nodes):
+        return cluster_props
+    progress('Resizing cluster {} from {} x {} to {} x {}'.format(
+        config['REDSHIFT']['CLUSTER_IDENTIFIER'], cluster_props['NumberOfNodes'], cluster_props['NodeType'],
+        nodes, node_type))
+    redshift.resize_cluster(ClusterIdentifier=config['REDSHIFT']['CLUSTER_IDENTIFIER'],
+                            ClusterType='multi-node' if nodes > 1 else 'single-node',
+                            NodeType=node_type, NumberOfNodes=nodes, Classic=False)
+    return wait_for_cluster(redshift, config, progress, **wait_options)
+
+
+def open_load_window(config, redshift=None, progress=report, **wait_options):
+    """sizes the cluster for the sources about to be loaded and resizes it up before the load
+    Args:
+        config: config object read from dwh.cfg
+        redshift: a redshift client, created from dwh.cfg when omitted
+        wait_options: delay/timeout/sleep passed to wait_for_cluster
+    Return(s):
+        the plan from choose_size, with the time the window opened
+    """
+    redshift = redshift or get_redshift_client(config)
+    options = sizing_options(config)
+    cluster_props = describe_cluster(redshift, config)
+    baseline = (cluster_props['NodeType'], cluster_props['NumberOfNodes'])
+    started = time.time()
+    volume = source_volume(config)
+    plan = choose_size(volume, baseline, options, load_history(options['history']))
+    progress('{} files, {:.1f} MB to load: {} x {} predicted {:.0f}s + {:.0f}s resizing, ${:.2f} '
+             '(baseline {} x {})'.format(plan['files'], plan['bytes'] / 1048576.0, plan['nodes'], plan['node_type'],
+                                         plan['predicted_seconds'], plan['resize_seconds'], plan['cost'],
+                                         baseline[1], baseline[0]))
+    recorder.record('sizing', 'plan', time.time() - started, plan['bytes'], files=plan['files'],
+                    node_type=plan['node_type'], nodes=plan['nodes'], baseline=plan['baseline'],
+                    predicted_seconds=round(plan['predicted_seconds'], 1), cost=plan['cost'])
+    resize_started = time.time()
+    resize_cluster(redshift, config, plan['node_type'], plan['nodes'], progress, **wait_options)
+    recorder.record('sizing', 'resize up', time.time() - resize_started, 0, node_type=plan['node_type'],
+                    nodes=plan['nodes'])
+    plan['opened'] = time.time()
+    return plan
+
+
+def close_load_window(config, plan, redshift=None, progress=report, **wait_options):
+    """records the measured throughput of the load window and resizes the cluster back to its baseline
+    The measured bytes per slice second are appended to SIZING_HISTORY, where the next
+    plans for the node type take their estimate from.
+    Return(s):
+        the history record
+    """
+    redshift = redshift or get_redshift_client(config)
+    options = sizing_options(config)
+    seconds = time.time() - plan['opened']
+    slices = NODE_SLICES[plan['node_type']] * plan['nodes']
+    effective = plan['bytes'] + plan['files'] * FILE_OVERHEAD_BYTES
+    run = {'run_at': datetime.datetime.now(datetime.timezone.utc).isoformat(), 'node_type': plan['node_type'], 'nodes': plan['nodes'],
+           'bytes': plan['bytes'], 'files': plan['files'], 'seconds': round(seconds, 1),
+           'predicted_seconds': round(plan['predicted_seconds'], 1),
+           'bytes_per_slice_second': round(effective / (seconds * slices), 1) if seconds else None}
+    if options['history']:
+        with open(options['history'], 'a') as f:
+            f.write(json.dumps(run) + '\n')
+    recorder.record('sizing', 'load window', seconds, plan['bytes'], node_type=plan['node_type'],
+                    nodes=plan['nodes'], predicted_seconds=run['predicted_seconds'],
+                    bytes_per_slice_second=run['bytes_per_slice_second'])
+    resize_started = time.time()
+    node_type, nodes = plan['baseline']
+    resize_cluster(redshift, config, node_type, nodes, progress, **wait_options)
+    recorder.record('sizing', 'resize down', time.time() - resize_started, 0, node_type=node_type, nodes=nodes)
+    return run
+
+
+if __name__ == "__main__":
+    # python sizing.py [config_file]: prints the plan for the configured sources without resizing
+    config = configparser.ConfigParser()
+    config.read(sys.argv[1] if len(sys.argv) > 1 else 'dwh.cfg')
+    options = sizing_options(config)
+    baseline = (config.get('REDSHIFT', 'NODE_TYPE'), config.getint('REDSHIFT', 'NUM_NODES'))
+    volume = source_volume(config)
+    rates = load_history(options['history'])
+    plan = choose_size(volume, baseline, options, rates)
+    print("{} files, {:.1f} MB".format(volume['files'], volume['bytes'] / 1048576.0))
+    print("{:<14} {:>5} {:>12} {:>9} {:>9}".format('node_type', 'nodes', 'seconds', 'resizing', 'cost'))
+    for candidate in size_plans(volume, baseline, options, rates):
+        print("{:<14} {:>5} {:>12.0f} {:>9.0f} {:>9.2f}{}".format(
+            candidate['node_type'], candidate['nodes'], candidate['predicted_seconds'], candidate['resize_seconds'],
+            candidate['cost'],
+            '  <- chosen' if (candidate['node_type'], candidate['nodes']) == (plan['node_type'], plan['nodes'])
+            else ''))
@@ -0,0 +1,41 @@
+import time
+import sql_queries
+from sql_queries import song_match_rate
+from instrumentation import run_statement, recorder
+
+
+def compute_song_keys(cur, conn):
+    """computes the hashed song_key of staged events and songs once, right after the load
+    A failure is rolled back and re-raised: songplays cannot match events without their keys.
+    Args:
+        cur (cursor): cursor to execute queries
+        conn: open connection
+    """
+    try:
+        print("computing song keys\n")
+        for query in sql_queries.song_key_queries:
+            run_statement(cur, query, 'song_matching')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def match_rate(cur, conn):
+    """prints and records the share of NextSong events whose song_key matches a staged song
+    Return(s):
+        (events, matched)
+    """
+    try:
+        started = time.time()
+        cur.execute(song_match_rate)
+        events, matched = cur.fetchone()
+        conn.commit()
+        rate = float(matched) / events if events else 0.0
+        recorder.record('song_matching', 'match rate', time.time() - started, matched,
+                        events=events, match_rate=round(rate, 4))
+        print("song match rate: {} of {} NextSong events ({:.1%})\n".format(matched, events, rate))
+        return events, matched
+    except Exception:
+        conn.rollback()
+        raise
@@ -1,14 +1,51 @@
+import re
+import json
+import threading
 import configparser
+from upsert import upsert_query
 
 
 # CONFIG
-config = configparser.ConfigParser()
-config.read('dwh.cfg')
+# nothing is read at import: the settings and statements that depend on dwh.cfg are
+# built by render() on first access, from the config passed to configure() or else CONFIG_FILE
+CONFIG_FILE = 'dwh.cfg'
+_config = None
+_rendered = None
+_render_lock = threading.Lock()
 
-LOG_DATA = config.get('S3', 'LOG_DATA')
-LOG_JSONPATH = config.get('S3', 'LOG_JSONPATH')
-SONG_DATA = config.get('S3', 'SONG_DATA')
-DWH_ROLE_ARN = config.get('IAM_ROLE', 'ARN')
+
+def settings(config):
+    """returns the dwh.cfg settings the rendered statements depend on
+    Every setting has a default, so the offline tools render without a dwh.cfg.
+    """
+    return {
+        'LOG_DATA': config.get('S3', 'LOG_DATA', fallback="''"),
+        'LOG_JSONPATH': config.get('S3', 'LOG_JSONPATH', fallback="'auto'"),
+        'SONG_DATA': config.get('S3', 'SONG_DATA', fallback="''"),
+        'DWH_ROLE_ARN': config.get('IAM_ROLE', 'ARN', fallback=''),
+        'SONG_MATCH_DURATION': config.getboolean('ETL', 'SONG_MATCH_DURATION', fallback=False),
+        # event: time holds one row per songplays timestamp; hourly: time_hour holds one row
+        # per calendar hour of the loaded range, joined to songplays on the integer hour_key
+        'TIME_PROFILE': config.get('ETL', 'TIME_PROFILE', fallback='event'),
+        # lines COPY may reject before it fails; rejected lines are kept in staging_rejects
+        'COPY_MAXERROR': config.getint('ETL', 'COPY_MAXERROR', fallback=0),
+        # JSON file of VARCHAR sizes and ENCODE per column written by schema_profiler.py, empty = bare DDL
+        'COLUMN_PROFILE': config.get('ETL', 'COLUMN_PROFILE', fallback=''),
+        # JSON file of DISTSTYLE/DISTKEY/SORTKEY per table written by key_advisor.py --apply, empty = profile DDL
+        'KEY_PROFILE': config.get('ETL', 'KEY_PROFILE', fallback=''),
+        'UPSERT_MODE': config.get('ETL', 'UPSERT_MODE', fallback='delete_insert'),
+        'SCHEMA_PROFILE': config.get('ETL', 'SCHEMA_PROFILE', fallback='default'),
+        # redshift, or postgres: the statements are rewritten with postgres_dialect for a Postgres stand-in
+        'DIALECT': config.get('ETL', 'DIALECT', fallback='redshift')}
+
+# column order of staging_events as mapped by log_json_path.json
+staging_events_columns = ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName',
+                          'length', 'level', 'location', 'method', 'page', 'registration',
+                          'sessionId', 'song', 'status', 'ts', 'userAgent', 'userId']
+staging_songs_columns = ['num_songs', 'artist_id', 'artist_latitude', 'artist_longitude',
+                         'artist_location', 'artist_name', 'song_id', 'title', 'duration', 'year']
+# COPY lists the columns explicitly so song_key, which is computed after the load, is skipped
+STAGING_EVENTS_COPY_COLUMNS = ', '.join(staging_events_columns)
 
 # DROP TABLES
 
@@ -20,6 +57,15 @@ user_table_drop = " DROP TABLE IF EXISTS users; "
 song_table_drop = " DROP TABLE IF EXISTS songs; "
 artist_table_drop = " DROP TABLE IF EXISTS artists; "
 time_table_drop = " DROP TABLE IF EXISTS time; "
+time_hour_table_drop = " DROP TABLE IF EXISTS time_hour; "
+staging_rejects_table_drop = " DROP TABLE IF EXISTS staging_rejects; "
+load_state_table_drop = " DROP TABLE IF EXISTS etl_load_state; "
+matched_events_table_drop = " DROP TABLE IF EXISTS matched_events; "
+matched_songs_table_drop = " DROP TABLE IF EXISTS matched_songs; "
+song_play_counts_drop = " DROP TABLE IF EXISTS song_play_counts; "
+artist_play_counts_drop = " DROP TABLE IF EXISTS artist_play_counts; "
+hourly_play_counts_drop = " DROP TABLE IF EXISTS hourly_play_counts; "
+summary_state_drop = " DROP TABLE IF EXISTS summary_state; "
 
 # CREATE TABLES
 
@@ -43,7 +89,8 @@ song VARCHAR,
 status INTEGER,
 ts TIMESTAMP,
 userAgent VARCHAR,
-userId INTEGER
+userId INTEGER,
+song_key BIGINT
 );
  
 """)
@@ -59,7 +106,8 @@ staging_songs_table_create = ("""
     song_id VARCHAR NOT NULL,
     title varchar,
     duration DECIMAL,
-    year INTEGER
+    year INTEGER,
+    song_key BIGINT
     );
 """)
 
@@ -73,7 +121,9 @@ song_id VARCHAR NOT NULL,
 artist_id VARCHAR NOT NULL, 
 session_id INTEGER, 
 location VARCHAR, 
-user_agent VARCHAR
+user_agent VARCHAR,
+hour_key INTEGER,
+loaded_at TIMESTAMP DEFAULT GETDATE()
 );
 """)
 
@@ -92,7 +142,8 @@ CREATE TABLE IF NOT EXISTS songs(
     title VARCHAR, 
     artist_id VARCHAR, 
     year INTEGER,
-    duration DECIMAL);
+    duration DECIMAL,
+    song_key BIGINT);
 """)
 
 artist_table_create = ("""
@@ -115,29 +166,301 @@ CREATE TABLE IF NOT EXISTS time(
     weekday VARCHAR);
 """)
 
+time_hour_table_create = ("""
+CREATE TABLE IF NOT EXISTS time_hour(
+    hour_key INTEGER PRIMARY KEY,
+    start_hour TIMESTAMP,
+    hour int,
+    day int,
+    week int,
+    month int,
+    year int,
+    weekday VARCHAR);
+""")
+
+# KEYED SCHEMA PROFILE: co-located distribution keys for the songplays joins
+# and DISTSTYLE ALL for the small dimensions (see key_advisor.py). COPY places the
+# staging rows while song_key is still NULL, so the staging tables stay EVEN and the
+# matched rows are copied into matched_events/matched_songs, both on DISTKEY(song_key)
+
+staging_events_table_create_keyed = ("""
+CREATE TABLE IF NOT EXISTS staging_events(
+event_id INTEGER IDENTITY(0,1) NOT NULL,
+artist VARCHAR,
+auth VARCHAR,
+firstName VARCHAR,
+gender VARCHAR,
+iteminSession INTEGER,
+lastName VARCHAR,
+length FLOAT,
+level VARCHAR,
+location VARCHAR,
+method VARCHAR,
+page VARCHAR,
+registration BIGINT,
+sessionId INTEGER,
+song VARCHAR,
+status INTEGER,
+ts TIMESTAMP,
+userAgent VARCHAR,
+userId INTEGER,
+song_key BIGINT
+)
+DISTSTYLE EVEN SORTKEY(ts);
+""")
+
+staging_songs_table_create_keyed = ("""
+CREATE TABLE IF NOT EXISTS staging_songs(
+    num_songs INTEGER,
+    artist_id VARCHAR NOT NULL,
+    artist_latitude DECIMAL,
+    artist_longitude DECIMAL,
+    artist_location VARCHAR,
+    artist_name VARCHAR,
+    song_id VARCHAR NOT NULL,
+    title VARCHAR,
+    duration DECIMAL,
+    year INTEGER,
+    song_key BIGINT
+    )
+DISTSTYLE EVEN;
+""")
+
+matched_events_table_create = ("""
+CREATE TABLE IF NOT EXISTS matched_events(
+ts TIMESTAMP,
+userId INTEGER,
+level VARCHAR,
+sessionId INTEGER,
+location VARCHAR,
+userAgent VARCHAR,
+song_key BIGINT NOT NULL
+)
+DISTSTYLE KEY DISTKEY(song_key) SORTKEY(song_key);
+""")
+
+matched_songs_table_create = ("""
+CREATE TABLE IF NOT EXISTS matched_songs(
+    song_key BIGINT NOT NULL,
+    song_id VARCHAR NOT NULL,
+    artist_id VARCHAR NOT NULL)
+DISTSTYLE KEY DISTKEY(song_key) SORTKEY(song_key);
+""")
+
+songplay_table_create_keyed = ("""
+CREATE TABLE IF NOT EXISTS songplays(
+songplay_id INTEGER IDENTITY(0,1) PRIMARY KEY,
+start_time TIMESTAMP,
+user_id VARCHAR,
+level VARCHAR,
+song_id VARCHAR NOT NULL,
+artist_id VARCHAR NOT NULL,
+session_id INTEGER,
+location VARCHAR,
+user_agent VARCHAR,
+hour_key INTEGER,
+loaded_at TIMESTAMP DEFAULT GETDATE()
+)
+DISTSTYLE KEY DISTKEY(song_id) SORTKEY(start_time);
+""")
+
+user_table_create_keyed = ("""
+CREATE TABLE IF NOT EXISTS users(
+    user_id INTEGER NOT NULL PRIMARY KEY,
+    first_name VARCHAR,
+    last_name VARCHAR,
+    gender VARCHAR,
+    level VARCHAR)
+DISTSTYLE ALL SORTKEY(user_id);
+""")
+
+song_table_create_keyed = ("""
+CREATE TABLE IF NOT EXISTS songs(
+    song_id VARCHAR NOT NULL PRIMARY KEY,
+    title VARCHAR,
+    artist_id VARCHAR,
+    year INTEGER,
+    duration DECIMAL,
+    song_key BIGINT)
+DISTSTYLE KEY DISTKEY(song_id) SORTKEY(song_id);
+""")
+
+artist_table_create_keyed = ("""
+CREATE TABLE IF NOT EXISTS artists(
+    artist_id VARCHAR NOT NULL PRIMARY KEY,
+    name VARCHAR,
+    location VARCHAR,
+    latitude DECIMAL,
+    longitude DECIMAL)
+DISTSTYLE ALL SORTKEY(artist_id);
+""")
+
+time_table_create_keyed = ("""
+CREATE TABLE IF NOT EXISTS time(
+    start_time timestamp PRIMARY KEY,
+    hour int,
+    day int,
+    week int,
+    month int,
+    year int,
+    weekday VARCHAR)
+DISTSTYLE ALL SORTKEY(start_time);
+""")
+
+time_hour_table_create_keyed = ("""
+CREATE TABLE IF NOT EXISTS time_hour(
+    hour_key INTEGER PRIMARY KEY,
+    start_hour TIMESTAMP,
+    hour int,
+    day int,
+    week int,
+    month int,
+    year int,
+    weekday VARCHAR)
+DISTSTYLE ALL SORTKEY(hour_key);
+""")
+
+load_state_table_create = ("""
+CREATE TABLE IF NOT EXISTS etl_load_state(
+    source VARCHAR(32) NOT NULL,
+    object_key VARCHAR(1024) NOT NULL,
+    partition VARCHAR(16),
+    loaded_at TIMESTAMP NOT NULL);
+""")
+
+# SUMMARY TABLES: play counts maintained after every load for the reports
+
+song_play_counts_create = ("""
+CREATE TABLE IF NOT EXISTS song_play_counts(
+    song_id VARCHAR NOT NULL PRIMARY KEY,
+    play_count BIGINT NOT NULL);
+""")
+
+artist_play_counts_create = ("""
+CREATE TABLE IF NOT EXISTS artist_play_counts(
+    artist_id VARCHAR NOT NULL PRIMARY KEY,
+    play_count BIGINT NOT NULL);
+""")
+
+hourly_play_counts_create = ("""
+CREATE TABLE IF NOT EXISTS hourly_play_counts(
+    hour INTEGER NOT NULL PRIMARY KEY,
+    play_count BIGINT NOT NULL);
+""")
+
+summary_state_create = ("""
+CREATE TABLE IF NOT EXISTS summary_state(
+    last_loaded_at TIMESTAMP NOT NULL);
+""")
+
+# lines rejected by COPY, copied from STL_LOAD_ERRORS (see load_quality.py)
+staging_rejects_table_create = ("""
+CREATE TABLE IF NOT EXISTS staging_rejects(
+    source_table VARCHAR(32),
+    query INTEGER,
+    filename VARCHAR(256),
+    line_number BIGINT,
+    colname VARCHAR(127),
+    err_code INTEGER,
+    err_reason VARCHAR(100),
+    raw_line VARCHAR(1024),
+    raw_field_value VARCHAR(1024),
+    rejected_at TIMESTAMP);
+""")
+
 # STAGING TABLES
 
-staging_events_copy = ("""
-COPY staging_events FROM {}
+staging_events_copy_template = ("""
+COPY staging_events (""" + STAGING_EVENTS_COPY_COLUMNS + """) FROM {}
                        CREDENTIALS 'aws_iam_role={}'
                        TIMEFORMAT as 'epochmillisecs'
                        TRUNCATECOLUMNS
                        BLANKSASNULL
                        EMPTYASNULL
+                       MAXERROR {}
                        JSON {}
-                       """).format(LOG_DATA, DWH_ROLE_ARN, LOG_JSONPATH)
+                       """)
 
 
 
 
-staging_songs_copy = ("""
+staging_songs_copy_template = ("""
 COPY staging_songs FROM {}
                       CREDENTIALS 'aws_iam_role={}'
                       TRUNCATECOLUMNS
                       BLANKSASNULL
                       EMPTYASNULL
+                      MAXERROR {}
                       JSON 'auto';
-                      """).format(SONG_DATA, DWH_ROLE_ARN)
+                      """)
+
+# SONG MATCHING: songplays join staging_events to staging_songs on a hashed key
+# of the normalized title and artist name (optionally the rounded duration)
+# instead of two wide VARCHAR equalities
+
+def song_key_expression(title, artist, duration, match_duration=False):
+    """returns the SQL expression computing song_key from the given columns"""
+    key = "LOWER(TRIM({})) || '|' || LOWER(TRIM({}))".format(title, artist)
+    if match_duration:
+        key += " || '|' || CAST(ROUND({}) AS VARCHAR)".format(duration)
+    return 'FNV_HASH({})'.format(key)
+
+staging_events_song_key_template = ("""
+UPDATE staging_events
+SET song_key = {}
+WHERE page = 'NextSong' AND song IS NOT NULL AND artist IS NOT NULL;
+""")
+
+staging_songs_song_key_template = ("""
+UPDATE staging_songs
+SET song_key = {}
+WHERE title IS NOT NULL AND artist_name IS NOT NULL;
+""")
+
+song_match_rate = ("""
+SELECT COUNT(*), COUNT(matched.song_key)
+FROM staging_events events
+LEFT JOIN (SELECT DISTINCT song_key FROM staging_songs) matched
+    ON events.song_key = matched.song_key
+WHERE events.page = 'NextSong';
+""")
+
+# keyed profile only: the matched rows are copied onto DISTKEY(song_key) tables after
+# the keys are computed, so the songplays join runs on co-located slices
+matched_events_insert = ("""
+DELETE FROM matched_events;
+INSERT INTO matched_events (ts, userId, level, sessionId, location, userAgent, song_key)
+SELECT ts, userId, level, sessionId, location, userAgent, song_key
+FROM staging_events
+WHERE page = 'NextSong' AND song_key IS NOT NULL;
+""")
+
+matched_songs_insert = ("""
+DELETE FROM matched_songs;
+INSERT INTO matched_songs (song_key, song_id, artist_id)
+SELECT DISTINCT song_key, song_id, artist_id
+FROM staging_songs
+WHERE song_key IS NOT NULL;
+""")
+
+# incremental loads resolve songs against the songs dimension, so matched_songs
+# mirrors it: rows of the merged songs are replaced, songs it lacks are added
+matched_songs_merge = ("""
+DELETE FROM matched_songs WHERE song_id IN (SELECT song_id FROM staging_songs);
+INSERT INTO matched_songs (song_key, song_id, artist_id)
+SELECT song_key, song_id, artist_id
+FROM songs
+WHERE song_key IS NOT NULL
+AND NOT EXISTS (SELECT 1 FROM matched_songs m WHERE m.song_id = songs.song_id);
+""")
+
+# HOUR KEYS
+
+
+def hour_key_expression(ts):
+    """returns the SQL expression of the YYYYMMDDHH integer key of a timestamp column"""
+    return ("CAST(EXTRACT(year FROM {0}) * 1000000 + EXTRACT(month FROM {0}) * 10000"
+            " + EXTRACT(day FROM {0}) * 100 + EXTRACT(hour FROM {0}) AS INTEGER)").format(ts)
 
 # FINAL TABLES
 
@@ -149,68 +472,89 @@ songplay_table_insert = ("""
                                                 artist_id,
                                                 session_id,
                                                 location,
-                                                user_agent)
-                         SELECT DISTINCT to_timestamp(to_char(events.ts,'9999-99-99 99:99:99'),
-                                                      'YYYY-MM-DD HH24:MI:SS'),
+                                                user_agent,
+                                                hour_key)
+                         SELECT DISTINCT events.ts AS start_time,
                                          events.userId AS user_id,
                                          events.level AS level,
                                          songs.song_id AS song_id,
                                          songs.artist_id AS artist_id,
                                          events.sessionId AS session_id,
                                          events.location AS location,
-                                         events.userAgent AS user_agent
+                                         events.userAgent AS user_agent,
+                                         {hour_key} AS hour_key
                          FROM staging_events events
                          JOIN staging_songs songs
-                             ON events.song = songs.title
-                             AND events.artist = songs.artist_name
+                             ON events.song_key = songs.song_key
                              WHERE events.page = 'NextSong';
-                         """)
-
-user_table_insert = ("""
-                     INSERT INTO users (user_id,
-                                        first_name,
-                                        last_name,
-                                        gender,
-                                        level)
-                     SELECT DISTINCT userId AS user_id,
-                                     firstName AS first_name,
-                                     lastName AS last_name,
-                                     gender AS gender,
-                                     level AS level
-                     FROM staging_events
-                     WHERE userId IS NOT NULL;
-                     """)
+                         """).format(hour_key=hour_key_expression('events.ts'))
 
-song_table_insert = ("""
-                     INSERT INTO songs (song_id,
-                                        title,
-                                        artist_id,
-                                        year,
-                                        duration)
-                     SELECT DISTINCT song_id AS song_id,
-                                     title AS title,
-                                     artist_id AS artist_id,
-                                     year AS year,
-                                     duration AS duration
-                     FROM staging_songs
-                     WHERE song_id IS NOT NULL;
-                     """)
+songplay_table_insert_keyed = ("""
+                               INSERT INTO songplays (start_time,
+                                                      user_id,
+                                                      level,
+                                                      song_id,
+                                                      artist_id,
+                                                      session_id,
+                                                      location,
+                                                      user_agent,
+                                                      hour_key)
+                               SELECT DISTINCT events.ts AS start_time,
+                                               events.userId AS user_id,
+                                               events.level AS level,
+                                               songs.song_id AS song_id,
+                                               songs.artist_id AS artist_id,
+                                               events.sessionId AS session_id,
+                                               events.location AS location,
+                                               events.userAgent AS user_agent,
+                                               {hour_key} AS hour_key
+                               FROM matched_events events
+                               JOIN matched_songs songs
+                                   ON events.song_key = songs.song_key;
+                               """).format(hour_key=hour_key_expression('events.ts'))
 
-artist_table_insert = ("""
-                       INSERT INTO artists (artist_id,
-                                            name,
-                                            location,
-                                            latitude,
-                                            longitude)
-                       SELECT DISTINCT artist_id AS artist_id,
-                                       artist_name AS name,
-                                       artist_location AS location,
-                                       artist_latitude AS latitude,
-                                       artist_longitude AS longitude
-                       FROM staging_songs
-                       WHERE artist_id IS NOT NULL;
-                       """)
+# dimensions are upserted on their natural key only, keeping the latest staged record;
+# song files carry no load time, so songs and artists rank by year and break ties on
+# the remaining columns, which keeps the winner the same from run to run
+user_upsert = {
+    'target': 'users',
+    'source': 'staging_events',
+    'key': 'user_id',
+    'columns': [('user_id', 'userId'),
+                ('first_name', 'firstName'),
+                ('last_name', 'lastName'),
+                ('gender', 'gender'),
+                ('level', 'level')],
+    'order_by': 'ts',
+    'where': 'userId IS NOT NULL'}
 
+song_upsert = {
+    'target': 'songs',
+    'source': 'staging_songs',
+    'key': 'song_id',
+    'columns': [('song_id', 'song_id'),
+                ('title', 'title'),
+                ('artist_id', 'artist_id'),
+                ('year', 'year'),
+                ('duration', 'duration'),
+                ('song_key', 'song_key')],
+    'order_by': ['year', 'artist_id', 'title', 'duration'],
+    'where': 'song_id IS NOT NULL'}
+
+artist_upsert = {
+    'target': 'artists',
+    'source': 'staging_songs',
+    'key': 'artist_id',
+    'columns': [('artist_id', 'artist_id'),
+                ('name', 'artist_name'),
+                ('location', 'artist_location'),
+                ('latitude', 'artist_latitude'),
+                ('longitude', 'artist_longitude')],
+    'order_by': ['year', 'song_id'],
+    'where': 'artist_id IS NOT NULL'}
+
+# songplays keeps the native millisecond ts, and time is built from exactly the
+# timestamps in songplays, so the listen_time join matches every play
 time_table_insert = ("""
                      INSERT INTO time (start_time,
                                        hour,
@@ -219,17 +563,309 @@ time_table_insert = ("""
                                        month,
                                        year,
                                        weekday)
-                     SELECT DISTINCT ts,
-                     EXTRACT(hour FROM ts),
-                     EXTRACT(day FROM ts),
-                     EXTRACT(week FROM ts),
-                     EXTRACT(month FROM ts),
-                     EXTRACT(year FROM ts),
-                     EXTRACT(weekday FROM ts)
-                     FROM staging_events
-                     WHERE ts IS NOT NULL;
+                     SELECT start_time,
+                     EXTRACT(hour FROM start_time),
+                     EXTRACT(day FROM start_time),
+                     EXTRACT(week FROM start_time),
+                     EXTRACT(month FROM start_time),
+                     EXTRACT(year FROM start_time),
+                     EXTRACT(weekday FROM start_time)
+                     FROM (SELECT DISTINCT start_time FROM songplays) plays;
                      """)
 
+# calendar hours from the first to the last NextSong event staged, numbered by
+# crossing five digit tables (up to 100000 hours, about eleven years).
+# Hours already present are skipped, so full and incremental loads share it.
+time_hour_table_insert = ("""
+INSERT INTO time_hour (hour_key,
+                       start_hour,
+                       hour,
+                       day,
+                       week,
+                       month,
+                       year,
+                       weekday)
+WITH digits AS (SELECT 0 AS n UNION ALL SELECT 1 UNION ALL SELECT 2 UNION ALL SELECT 3 UNION ALL SELECT 4
+                UNION ALL SELECT 5 UNION ALL SELECT 6 UNION ALL SELECT 7 UNION ALL SELECT 8 UNION ALL SELECT 9),
+hours AS (SELECT DATEADD(hour, offsets.n, bounds.first_hour) AS start_hour, bounds.last_ts
+          FROM (SELECT DATE_TRUNC('hour', MIN(ts)) AS first_hour, MAX(ts) AS last_ts
+                FROM staging_events
+                WHERE page = 'NextSong') bounds
+          CROSS JOIN (SELECT d1.n + d2.n * 10 + d3.n * 100 + d4.n * 1000 + d5.n * 10000 AS n
+                      FROM digits d1 CROSS JOIN digits d2 CROSS JOIN digits d3
+                      CROSS JOIN digits d4 CROSS JOIN digits d5) offsets)
+SELECT {hour_key},
+       start_hour,
+       EXTRACT(hour FROM start_hour),
+       EXTRACT(day FROM start_hour),
+       EXTRACT(week FROM start_hour),
+       EXTRACT(month FROM start_hour),
+       EXTRACT(year FROM start_hour),
+       EXTRACT(weekday FROM start_hour)
+FROM hours
+WHERE start_hour <= last_ts
+AND NOT EXISTS (SELECT 1 FROM time_hour t WHERE t.hour_key = {hour_key});
+""").format(hour_key=hour_key_expression('start_hour'))
+
+
+# INCREMENTAL LOAD
+
+staging_events_truncate = " TRUNCATE staging_events; "
+staging_songs_truncate = " TRUNCATE staging_songs; "
+
+load_state_select = ("SELECT object_key FROM etl_load_state WHERE source = %s;")
+load_state_watermark = ("SELECT MAX(partition) FROM etl_load_state WHERE source = %s;")
+load_state_insert = ("INSERT INTO etl_load_state (source, object_key, partition, loaded_at) "
+                     "VALUES (%s, %s, %s, %s);")
+
+staging_events_copy_object = ("""
+COPY staging_events (""" + STAGING_EVENTS_COPY_COLUMNS + """) FROM '{}'
+                       CREDENTIALS 'aws_iam_role={}'
+                       TIMEFORMAT as 'epochmillisecs'
+                       TRUNCATECOLUMNS
+                       BLANKSASNULL
+                       EMPTYASNULL
+                       JSON {}
+                       """)
+
+staging_songs_copy_object = ("""
+COPY staging_songs FROM '{}'
+                      CREDENTIALS 'aws_iam_role={}'
+                      TRUNCATECOLUMNS
+                      BLANKSASNULL
+                      EMPTYASNULL
+                      JSON 'auto';
+                      """)
+
+staging_events_copy_manifest = ("""
+COPY staging_events (""" + STAGING_EVENTS_COPY_COLUMNS + """) FROM '{}'
+                       CREDENTIALS 'aws_iam_role={}'
+                       MANIFEST
+                       TIMEFORMAT as 'epochmillisecs'
+                       TRUNCATECOLUMNS
+                       BLANKSASNULL
+                       EMPTYASNULL
+                       MAXERROR {}
+                       JSON {}
+                       """)
+
+staging_songs_copy_manifest = ("""
+COPY staging_songs FROM '{}'
+                      CREDENTIALS 'aws_iam_role={}'
+                      MANIFEST
+                      TRUNCATECOLUMNS
+                      BLANKSASNULL
+                      EMPTYASNULL
+                      MAXERROR {}
+                      JSON 'auto';
+                      """)
+
+# LOAD CHECKS: per file outcome of a COPY, read back from the system tables
+
+load_file_commits = ("""
+SELECT TRIM(filename), SUM(lines_scanned)
+FROM stl_load_commits
+WHERE query = %s
+GROUP BY 1;
+""")
+
+load_file_errors = ("""
+SELECT TRIM(filename), COUNT(*)
+FROM stl_load_errors
+WHERE query = %s
+GROUP BY 1;
+""")
+
+# a COPY that exceeds MAXERROR aborts, pg_last_query_id() is not set by it
+last_load_error_query = ("""
+SELECT COALESCE(MAX(query), 0) FROM stl_load_errors WHERE session = pg_backend_pid();
+""")
+
+load_errors_capture = ("""
+INSERT INTO staging_rejects (source_table, query, filename, line_number, colname, err_code,
+                             err_reason, raw_line, raw_field_value, rejected_at)
+SELECT %s, query, TRIM(filename), line_number, TRIM(colname), err_code,
+       TRIM(err_reason), TRIM(raw_line), TRIM(raw_field_value), starttime
+FROM stl_load_errors
+WHERE query = %s;
+""")
+
+staging_rejects_insert = ("INSERT INTO staging_rejects (source_table, query, filename, line_number, err_reason, "
+                          "raw_line, rejected_at) VALUES (%s, %s, %s, %s, %s, %s, %s);")
+
+# PARQUET COPY: source JSON converted to Parquet with the staging column order and types
+# (see parquet_stage.py); columns are listed because song_key is computed after the load
+
+staging_events_copy_parquet = ("""
+COPY staging_events (""" + STAGING_EVENTS_COPY_COLUMNS + """) FROM '{}'
+                       CREDENTIALS 'aws_iam_role={}'
+                       FORMAT AS PARQUET;
+                       """)
+
+staging_songs_copy_parquet = ("""
+COPY staging_songs (""" + ', '.join(staging_songs_columns) + """) FROM '{}'
+                      CREDENTIALS 'aws_iam_role={}'
+                      FORMAT AS PARQUET;
+                      """)
+
+# STREAMED COPY: rows parsed client side and sent over the connection in COPY's text format
+# (see stream_load.py), for Postgres compatible targets that cannot read S3
+
+staging_events_copy_stdin = "COPY staging_events (" + STAGING_EVENTS_COPY_COLUMNS + ") FROM STDIN;"
+
+staging_songs_copy_stdin = "COPY staging_songs (" + ', '.join(staging_songs_columns) + ") FROM STDIN;"
+
+# PRE-STAGED COPY: gzip compressed NDJSON chunks listed in a manifest
+
+staging_events_copy_gzip_manifest = ("""
+COPY staging_events (""" + STAGING_EVENTS_COPY_COLUMNS + """) FROM '{}'
+                       CREDENTIALS 'aws_iam_role={}'
+                       MANIFEST
+                       GZIP
+                       TIMEFORMAT as 'epochmillisecs'
+                       TRUNCATECOLUMNS
+                       BLANKSASNULL
+                       EMPTYASNULL
+                       JSON {}
+                       """)
+
+staging_songs_copy_gzip_manifest = ("""
+COPY staging_songs FROM '{}'
+                      CREDENTIALS 'aws_iam_role={}'
+                      MANIFEST
+                      GZIP
+                      TRUNCATECOLUMNS
+                      BLANKSASNULL
+                      EMPTYASNULL
+                      JSON 'auto';
+                      """)
+
+# merge statements only add rows that are not already in the warehouse,
+# so they can run after every incremental load without truncating.
+# songplays resolves songs against the songs dimension because staging_songs
+# only holds the song files that are new in this run
+songplay_table_merge = ("""
+                        INSERT INTO songplays (start_time,
+                                               user_id,
+                                               level,
+                                               song_id,
+                                               artist_id,
+                                               session_id,
+                                               location,
+                                               user_agent,
+                                               hour_key)
+                        SELECT DISTINCT events.ts,
+                                        events.userId,
+                                        events.level,
+                                        songs.song_id,
+                                        songs.artist_id,
+                                        events.sessionId,
+                                        events.location,
+                                        events.userAgent,
+                                        {hour_key}
+                        FROM staging_events events
+                        JOIN songs
+                            ON events.song_key = songs.song_key
+                        WHERE events.page = 'NextSong'
+                        AND NOT EXISTS (SELECT 1
+                                        FROM songplays sp
+                                        WHERE sp.start_time = events.ts
+                                        AND sp.user_id = CAST(events.userId AS VARCHAR)
+                                        AND sp.session_id = events.sessionId);
+                        """).format(hour_key=hour_key_expression('events.ts'))
+
+songplay_table_merge_keyed = ("""
+                              INSERT INTO songplays (start_time,
+                                                     user_id,
+                                                     level,
+                                                     song_id,
+                                                     artist_id,
+                                                     session_id,
+                                                     location,
+                                                     user_agent,
+                                                     hour_key)
+                              SELECT DISTINCT events.ts,
+                                              events.userId,
+                                              events.level,
+                                              songs.song_id,
+                                              songs.artist_id,
+                                              events.sessionId,
+                                              events.location,
+                                              events.userAgent,
+                                              {hour_key}
+                              FROM matched_events events
+                              JOIN matched_songs songs
+                                  ON events.song_key = songs.song_key
+                              WHERE NOT EXISTS (SELECT 1
+                                                FROM songplays sp
+                                                WHERE sp.start_time = events.ts
+                                                AND sp.user_id = CAST(events.userId AS VARCHAR)
+                                                AND sp.session_id = events.sessionId);
+                              """).format(hour_key=hour_key_expression('events.ts'))
+
+time_table_merge = ("""
+                    INSERT INTO time (start_time,
+                                      hour,
+                                      day,
+                                      week,
+                                      month,
+                                      year,
+                                      weekday)
+                    SELECT plays.start_time,
+                    EXTRACT(hour FROM plays.start_time),
+                    EXTRACT(day FROM plays.start_time),
+                    EXTRACT(week FROM plays.start_time),
+                    EXTRACT(month FROM plays.start_time),
+                    EXTRACT(year FROM plays.start_time),
+                    EXTRACT(weekday FROM plays.start_time)
+                    FROM (SELECT DISTINCT start_time
+                          FROM songplays
+                          WHERE start_time >= (SELECT MIN(ts) FROM staging_events)) plays
+                    WHERE NOT EXISTS (SELECT 1 FROM time t WHERE t.start_time = plays.start_time);
+                    """)
+time_hour_table_merge = time_hour_table_insert
+
+# SUMMARY REFRESH: folds songplays added since the last refresh into the counts
+
+# DELETE rather than TRUNCATE: TRUNCATE commits on Redshift, the rebuild must stay in the refresh's transaction
+summary_delete_queries = [" DELETE FROM song_play_counts; ", " DELETE FROM artist_play_counts; ",
+                          " DELETE FROM hourly_play_counts; ", " DELETE FROM summary_state; "]
+
+# songplays are told apart by the time their load wrote them: IDENTITY values are
+# unique but not increasing across loads, so songplay_id cannot serve as a watermark
+
+songplays_delta_create = ("""
+DROP TABLE IF EXISTS songplays_delta;
+CREATE TEMP TABLE songplays_delta AS
+SELECT loaded_at, song_id, artist_id, EXTRACT(hour FROM start_time) AS hour
+FROM songplays
+WHERE loaded_at > (SELECT COALESCE(MAX(last_loaded_at), '1900-01-01') FROM summary_state);
+""")
+
+summary_refresh_template = ("""
+UPDATE {table}
+SET play_count = {table}.play_count + delta.cnt
+FROM (SELECT {key}, COUNT(*) AS cnt FROM songplays_delta GROUP BY {key}) delta
+WHERE {table}.{key} = delta.{key};
+INSERT INTO {table} ({key}, play_count)
+SELECT d.{key}, COUNT(*)
+FROM songplays_delta d
+WHERE d.{key} IS NOT NULL
+AND NOT EXISTS (SELECT 1 FROM {table} t WHERE t.{key} = d.{key})
+GROUP BY d.{key};
+""")
+
+summary_state_advance = ("""
+INSERT INTO summary_state (last_loaded_at)
+SELECT MAX(loaded_at) FROM songplays_delta HAVING COUNT(*) > 0;
+DROP TABLE songplays_delta;
+""")
+
+summary_refresh_queries = [songplays_delta_create,
+                           summary_refresh_template.format(table='song_play_counts', key='song_id'),
+                           summary_refresh_template.format(table='artist_play_counts', key='artist_id'),
+                           summary_refresh_template.format(table='hourly_play_counts', key='hour'),
+                           summary_state_advance]
 
 top_ten_songs = (
   """SELECT sp.song_id, s.title, count(*) AS cnt 
@@ -266,10 +902,365 @@ GROUP BY 1
 ORDER BY 2 DESC;
 """)
 
+listen_time_hourly = ("""SELECT CASE
+           WHEN t.hour BETWEEN 2 AND 8  THEN '2-8'
+           WHEN t.hour BETWEEN 9 AND 12 THEN '9-12'
+           WHEN t.hour BETWEEN 13 AND 18 THEN '13-18'
+           WHEN t.hour BETWEEN 19 AND 22 THEN '19-22'
+           ELSE '23-24, 0-2'
+         END AS play_time,
+         count(*) AS cnt
+    FROM songplays sp
+    JOIN time_hour t
+      ON sp.hour_key = t.hour_key
+GROUP BY 1
+ORDER BY 2 DESC;
+""")
+
+# REPORTS ANSWERED FROM THE SUMMARY TABLES
+
+top_ten_songs_summary = ("""
+  SELECT c.song_id, s.title, c.play_count AS cnt
+    FROM (SELECT song_id, play_count FROM song_play_counts ORDER BY play_count DESC LIMIT 10) c
+    JOIN songs s
+      ON c.song_id = s.song_id
+ORDER BY 3 DESC;
+""")
+
+top_ten_artists_summary = ("""
+  SELECT c.artist_id, a.name AS artist_name, c.play_count AS cnt
+    FROM (SELECT artist_id, play_count FROM artist_play_counts ORDER BY play_count DESC LIMIT 10) c
+    JOIN artists a
+      ON c.artist_id = a.artist_id
+ORDER BY 3 DESC;
+""")
+
+listen_time_summary = ("""SELECT CASE
+           WHEN hour BETWEEN 2 AND 8  THEN '2-8'
+           WHEN hour BETWEEN 9 AND 12 THEN '9-12'
+           WHEN hour BETWEEN 13 AND 18 THEN '13-18'
+           WHEN hour BETWEEN 19 AND 22 THEN '19-22'
+           ELSE '23-24, 0-2'
+         END AS play_time,
+         SUM(play_count) AS cnt
+    FROM hourly_play_counts
+GROUP BY 1
+ORDER BY 2 DESC;
+""")
+
+unload_query_template = ("""
+UNLOAD ('{}')
+TO '{}'
+IAM_ROLE '{}'
+FORMAT AS PARQUET
+ALLOWOVERWRITE;
+""")
+
+# ARCHIVE: songplays months older than the retention window move to Parquet on S3,
+# read back through a Spectrum external table
+
+songplays_latest_query = "SELECT MAX(start_time) FROM songplays;"
+
+songplays_months_query = ("""
+SELECT CAST(EXTRACT(year FROM start_time) AS INTEGER), CAST(EXTRACT(month FROM start_time) AS INTEGER), COUNT(*)
+FROM songplays
+WHERE start_time < %s
+GROUP BY 1, 2
+ORDER BY 1, 2;
+""")
+
+archive_month_select = "SELECT {columns} FROM songplays WHERE start_time >= '{start}' AND start_time < '{end}'"
+
+external_schema_create = ("""
+CREATE EXTERNAL SCHEMA IF NOT EXISTS {schema}
+FROM DATA CATALOG DATABASE '{database}'
+IAM_ROLE '{role}'
+CREATE EXTERNAL DATABASE IF NOT EXISTS;
+""")
+
+external_table_exists = "SELECT COUNT(*) FROM svv_external_tables WHERE schemaname = %s AND tablename = %s;"
+
+archive_table_create = ("""
+CREATE EXTERNAL TABLE {schema}.songplays_archive (
+{columns}
+)
+PARTITIONED BY (year INTEGER, month INTEGER)
+STORED AS PARQUET
+LOCATION '{location}';
+""")
+
+archive_partition_add = ("""
+ALTER TABLE {schema}.songplays_archive
+ADD IF NOT EXISTS PARTITION (year={year}, month={month})
+LOCATION '{location}';
+""")
+
+archive_partition_rows = "SELECT COUNT(*) FROM {schema}.songplays_archive WHERE year = {year} AND month = {month};"
+
+# the archived plays are taken off the summary counts in the transaction that deletes them,
+# so the summary reports keep matching songplays
+archive_summary_adjust_template = ("""
+UPDATE {table}
+SET play_count = {table}.play_count - archived.cnt
+FROM (SELECT {key}, COUNT(*) AS cnt
+      FROM (SELECT song_id, artist_id, EXTRACT(hour FROM start_time) AS hour
+            FROM songplays
+            WHERE start_time >= %(start)s AND start_time < %(end)s) month
+      GROUP BY {key}) archived
+WHERE {table}.{key} = archived.{key};
+DELETE FROM {table} WHERE play_count <= 0;
+""")
+
+archive_month_delete = ("BEGIN;" +
+                        archive_summary_adjust_template.format(table='song_play_counts', key='song_id') +
+                        archive_summary_adjust_template.format(table='artist_play_counts', key='artist_id') +
+                        archive_summary_adjust_template.format(table='hourly_play_counts', key='hour') +
+                        "DELETE FROM songplays WHERE start_time >= %(start)s AND start_time < %(end)s;\nCOMMIT;")
+
+# a late binding view, external tables cannot be bound
+songplays_all_view = ("""
+CREATE OR REPLACE VIEW songplays_all AS
+SELECT {columns} FROM public.songplays
+UNION ALL
+SELECT {columns} FROM {schema}.songplays_archive
+WITH NO SCHEMA BINDING;
+""")
+
+# DIALECTS
+
+def postgres_dialect(query):
+    """rewrites Redshift specific DDL/DML so it runs on a plain Postgres stand-in"""
+    query = re.sub(r'INTEGER IDENTITY\(0,\s*1\)', 'SERIAL', query)
+    query = re.sub(r'\bDISTSTYLE\s+(ALL|KEY|EVEN|AUTO)\b', '', query, flags=re.IGNORECASE)
+    query = re.sub(r'\b(DISTKEY|SORTKEY)\b(\s*\([^)]*\))?', '', query, flags=re.IGNORECASE)
+    query = re.sub(r'\bENCODE\s+\w+', '', query, flags=re.IGNORECASE)
+    query = re.sub(r'\bFNV_HASH\(', 'hashtext(', query)
+    query = re.sub(r'\bGETDATE\(\)', 'now()', query, flags=re.IGNORECASE)
+    query = re.sub(r'\bAPPROXIMATE\s+COUNT', 'COUNT', query, flags=re.IGNORECASE)
+    query = re.sub(r"\bDATEADD\((\w+),\s*([\w\.]+),\s*([\w\.]+)\)", r"(\3 + \2 * INTERVAL '1 \1')", query)
+    return re.sub(r'EXTRACT\(weekday FROM', 'EXTRACT(dow FROM', query, flags=re.IGNORECASE)
+
+
+def apply_dialect(value, rewrite=postgres_dialect):
+    """rewrites a statement, or every statement in a list, step declaration or report mapping"""
+    if isinstance(value, str):
+        return rewrite(value)
+    if isinstance(value, dict):
+        return {name: apply_dialect(item, rewrite) for name, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(apply_dialect(item, rewrite) for item in value)
+    return value
+
+# COLUMN PROFILES: DDL rewritten with the VARCHAR sizes and encodings chosen by schema_profiler.py
+
+COLUMN_DEFINITION = re.compile(r'^(?P<indent>[ \t]*)(?P<name>\w+)\s+'
+                               r'(?P<type>VARCHAR(?:\(\d+\))?|INTEGER|INT|BIGINT|SMALLINT|FLOAT|DECIMAL|TIMESTAMP|DATE|BOOLEAN)'
+                               r'(?P<identity>\s+IDENTITY\(\d+,\s*\d+\))?(?=[\s,)]|$)', re.IGNORECASE | re.MULTILINE)
+CREATE_TABLE_NAME = re.compile(r'CREATE TABLE IF NOT EXISTS\s+(\w+)', re.IGNORECASE)
+
+
+def table_definition(ddl):
+    """returns (table name, [(column, type), ...]) of a CREATE TABLE statement"""
+    return (CREATE_TABLE_NAME.search(ddl).group(1),
+            [(match.group('name'), match.group('type').upper()) for match in COLUMN_DEFINITION.finditer(ddl)])
+
+
+def apply_column_profile(ddl, profile):
+    """sizes bare VARCHAR columns and adds ENCODE to the columns listed for the table in profile
+    Args:
+        ddl (string): CREATE TABLE statement
+        profile (dict): table -> column -> {'varchar': length or None, 'encode': encoding}
+    """
+    columns = profile.get(CREATE_TABLE_NAME.search(ddl).group(1), {})
+
+    def rewrite(match):
+        plan = columns.get(match.group('name'))
+        if not plan:
+            return match.group(0)
+        column_type = match.group('type')
+        if plan.get('varchar') and column_type.upper() == 'VARCHAR':
+            column_type = 'VARCHAR({})'.format(plan['varchar'])
+        return '{}{} {}{} ENCODE {}'.format(match.group('indent'), match.group('name'), column_type,
+                                            match.group('identity') or '', plan['encode'])
+
+    return COLUMN_DEFINITION.sub(rewrite, ddl)
+
+
+def apply_key_profile(ddl, profile):
+    """replaces the distribution and sort keys of a CREATE TABLE statement with those listed for the table
+    Args:
+        ddl (string): CREATE TABLE statement
+        profile (dict): table -> {'diststyle': KEY/ALL/EVEN, 'distkey': column or None, 'sortkey': column or None}
+    """
+    keys = profile.get(CREATE_TABLE_NAME.search(ddl).group(1))
+    if not keys:
+        return ddl
+    ddl = re.sub(r'\s*\bDISTSTYLE\s+(ALL|KEY|EVEN|AUTO)\b', '', ddl, flags=re.IGNORECASE)
+    ddl = re.sub(r'\s*\b(DISTKEY|SORTKEY)\b(\s*\([^)]*\))?', '', ddl, flags=re.IGNORECASE)
+    clause = 'DISTSTYLE {}'.format(keys['diststyle'])
+    if keys.get('distkey'):
+        clause += ' DISTKEY({})'.format(keys['distkey'])
+    if keys.get('sortkey'):
+        clause += ' SORTKEY({})'.format(keys['sortkey'])
+    body, end = ddl.rsplit(')', 1)
+    return '{})\n{}{}'.format(body, clause, end)
+
+
 # QUERY LISTS
 
-create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
-copy_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
-validation_queries = [top_ten_songs,top_ten_artists,listen_time]
\ No newline at end of file
+drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, time_hour_table_drop, load_state_table_drop, staging_rejects_table_drop, matched_events_table_drop, matched_songs_table_drop, song_play_counts_drop, artist_play_counts_drop, hourly_play_counts_drop, summary_state_drop]
+
+# RENDERED STATEMENTS
+
+
+def render(config):
+    """returns the settings and statements that depend on dwh.cfg, by module attribute name
+    Args:
+        config: config object read from dwh.cfg
+    """
+    rendered = settings(config)
+    staging_events_copy = staging_events_copy_template.format(rendered['LOG_DATA'], rendered['DWH_ROLE_ARN'],
+                                                              rendered['COPY_MAXERROR'], rendered['LOG_JSONPATH'])
+    staging_songs_copy = staging_songs_copy_template.format(rendered['SONG_DATA'], rendered['DWH_ROLE_ARN'],
+                                                            rendered['COPY_MAXERROR'])
+    song_key_queries = [staging_events_song_key_template.format(
+                            song_key_expression('song', 'artist', 'length', rendered['SONG_MATCH_DURATION'])),
+                        staging_songs_song_key_template.format(
+                            song_key_expression('title', 'artist_name', 'duration', rendered['SONG_MATCH_DURATION']))]
+
+    user_table_insert = upsert_query(user_upsert, rendered['UPSERT_MODE'])
+    song_table_insert = upsert_query(song_upsert, rendered['UPSERT_MODE'])
+    artist_table_insert = upsert_query(artist_upsert, rendered['UPSERT_MODE'])
+    # upserts are idempotent, so incremental loads reuse them for the dimensions
+    user_table_merge, song_table_merge, artist_table_merge = user_table_insert, song_table_insert, artist_table_insert
+
+    # the time dimension of TIME_PROFILE, its insert/merge statement and the listen_time report reading it
+    if rendered['TIME_PROFILE'] == 'hourly':
+        time_dimension_create, time_dimension_create_keyed = time_hour_table_create, time_hour_table_create_keyed
+        time_dimension_insert, time_dimension_merge = time_hour_table_insert, time_hour_table_merge
+        time_dimension_steps = [('time_hour_table_insert', time_hour_table_insert, ['staging_events'], ['time_hour'])]
+        time_dimension_merge_steps = [('time_hour_table_merge', time_hour_table_merge, ['staging_events', 'time_hour'], ['time_hour'])]
+        listen_time_report = listen_time_hourly
+    else:
+        time_dimension_create, time_dimension_create_keyed = time_table_create, time_table_create_keyed
+        time_dimension_insert, time_dimension_merge = time_table_insert, time_table_merge
+        time_dimension_steps = [('time_table_insert', time_table_insert, ['songplays'], ['time'])]
+        time_dimension_merge_steps = [('time_table_merge', time_table_merge, ['staging_events', 'songplays', 'time'], ['time'])]
+        listen_time_report = listen_time
+
+    create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_dimension_create, load_state_table_create, staging_rejects_table_create, song_play_counts_create, artist_play_counts_create, hourly_play_counts_create, summary_state_create]
+    keyed_create_table_queries = [staging_events_table_create_keyed, staging_songs_table_create_keyed, matched_events_table_create, matched_songs_table_create, songplay_table_create_keyed, user_table_create_keyed, song_table_create_keyed, artist_table_create_keyed, time_dimension_create_keyed, load_state_table_create, staging_rejects_table_create, song_play_counts_create, artist_play_counts_create, hourly_play_counts_create, summary_state_create]
+    if rendered['SCHEMA_PROFILE'] == 'keyed':
+        create_table_queries = keyed_create_table_queries
+    if rendered['KEY_PROFILE']:
+        with open(rendered['KEY_PROFILE']) as f:
+            key_profile = json.load(f)['tables']
+        create_table_queries = [apply_key_profile(query, key_profile) for query in create_table_queries]
+    if rendered['COLUMN_PROFILE']:
+        with open(rendered['COLUMN_PROFILE']) as f:
+            column_profile = json.load(f)['tables']
+        create_table_queries = [apply_column_profile(query, column_profile) for query in create_table_queries]
+
+    # STEP DECLARATIONS: (name, query, tables read, tables written)
+
+    # the keyed profile joins songplays on the song_key distributed copies of the matched rows
+    if rendered['SCHEMA_PROFILE'] == 'keyed':
+        songplay_insert, songplay_merge = songplay_table_insert_keyed, songplay_table_merge_keyed
+        songplay_steps = [
+            ('matched_events_insert', matched_events_insert, ['staging_events'], ['matched_events']),
+            ('matched_songs_insert', matched_songs_insert, ['staging_songs'], ['matched_songs']),
+            ('songplay_table_insert', songplay_insert, ['matched_events', 'matched_songs'], ['songplays'])]
+        songplay_merge_steps = [
+            ('matched_events_insert', matched_events_insert, ['staging_events'], ['matched_events']),
+            ('matched_songs_merge', matched_songs_merge, ['staging_songs', 'songs', 'matched_songs'], ['matched_songs']),
+            ('songplay_table_merge', songplay_merge, ['matched_events', 'matched_songs', 'songplays'], ['songplays'])]
+    else:
+        songplay_insert, songplay_merge = songplay_table_insert, songplay_table_merge
+        songplay_steps = [('songplay_table_insert', songplay_insert, ['staging_events', 'staging_songs'], ['songplays'])]
+        songplay_merge_steps = [('songplay_table_merge', songplay_merge, ['staging_events', 'songs', 'songplays'], ['songplays'])]
+
+    insert_table_steps = songplay_steps + [
+        ('user_table_insert', user_table_insert, ['staging_events'], ['users']),
+        ('song_table_insert', song_table_insert, ['staging_songs'], ['songs']),
+        ('artist_table_insert', artist_table_insert, ['staging_songs'], ['artists'])] + time_dimension_steps
+    merge_table_steps = [
+        ('user_table_merge', user_table_merge, ['staging_events', 'users'], ['users']),
+        ('song_table_merge', song_table_merge, ['staging_songs', 'songs'], ['songs']),
+        ('artist_table_merge', artist_table_merge, ['staging_songs', 'artists'], ['artists'])] + songplay_merge_steps + time_dimension_merge_steps
+
+    statements = {
+        'staging_events_copy': staging_events_copy,
+        'staging_songs_copy': staging_songs_copy,
+        'staging_events_song_key_update': song_key_queries[0],
+        'staging_songs_song_key_update': song_key_queries[1],
+        'song_key_queries': song_key_queries,
+        'user_table_insert': user_table_insert,
+        'song_table_insert': song_table_insert,
+        'artist_table_insert': artist_table_insert,
+        'user_table_merge': user_table_merge,
+        'song_table_merge': song_table_merge,
+        'artist_table_merge': artist_table_merge,
+        'time_dimension_create': time_dimension_create,
+        'time_dimension_create_keyed': time_dimension_create_keyed,
+        'time_dimension_insert': time_dimension_insert,
+        'time_dimension_merge': time_dimension_merge,
+        'time_dimension_steps': time_dimension_steps,
+        'time_dimension_merge_steps': time_dimension_merge_steps,
+        'listen_time_report': listen_time_report,
+        'create_table_queries': create_table_queries,
+        'keyed_create_table_queries': keyed_create_table_queries,
+        'copy_table_queries': [staging_events_copy, staging_songs_copy],
+        'songplay_insert': songplay_insert,
+        'songplay_merge': songplay_merge,
+        'insert_table_queries': [query for _, query, _, _ in songplay_steps] + [user_table_insert, song_table_insert, artist_table_insert, time_dimension_insert],
+        'validation_queries': [top_ten_songs, top_ten_artists, listen_time_report],
+        # report name -> (raw query, summary query)
+        'report_queries': {'top_ten_songs': (top_ten_songs, top_ten_songs_summary),
+                           'top_ten_artists': (top_ten_artists, top_ten_artists_summary),
+                           'listen_time': (listen_time_report, listen_time_summary)},
+        'merge_table_queries': [user_table_merge, song_table_merge, artist_table_merge] + [query for _, query, _, _ in songplay_merge_steps] + [time_dimension_merge],
+        'insert_table_steps': insert_table_steps,
+        'merge_table_steps': merge_table_steps}
+    if rendered['DIALECT'] == 'postgres':
+        statements = apply_dialect(statements)
+    rendered.update(statements)
+    return rendered
+
+
+def load_config(path=CONFIG_FILE):
+    """reads a config file"""
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config
+
+
+def configure(config):
+    """sets the config the statements are rendered from and drops those rendered from the previous one
+    The pipeline modules read rendered names as sql_queries.<name> when they run, so they
+    pick up the new statements whenever they were imported. A name bound with
+    `from sql_queries import <name>` keeps the value it was imported with.
+    """
+    global _config, _rendered
+    with _render_lock:
+        _config, _rendered = config, None
+
+
+def rendered_statements():
+    """returns the statements rendered from the configured config, rendering them on first use"""
+    global _config, _rendered
+    with _render_lock:
+        if _rendered is None:
+            if _config is None:
+                _config = load_config()
+            _rendered = render(_config)
+        return _rendered
+
+
+def __getattr__(name):
+    """resolves the names render() returns, e.g. `from sql_queries import copy_table_queries`"""
+    # dunder lookups (e.g. __path__ during from-imports) must not read the config
+    if not name.startswith('__'):
+        rendered = rendered_statements()
+        if name in rendered:
+            return rendered[name]
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
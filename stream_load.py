@@ -0,0 +1,286 @@
+import re
+import json
+import time
+import datetime
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from incremental import strip_quotes, is_s3, split_s3, list_source_objects, coerce_event, coerce_song
+from sql_queries import (staging_events_columns, staging_songs_columns, staging_events_copy_stdin,
+                         staging_songs_copy_stdin)
+from instrumentation import recorder
+
+# bytes handed to the server per COPY data message
+COPY_BUFFER_BYTES = 1 << 20
+# files parsed ahead of the COPY stream per worker; bounds the memory of a parallel load
+FILES_IN_FLIGHT = 4
+
+SOURCES = {'staging_events': ('LOG_DATA', staging_events_columns, coerce_event, staging_events_copy_stdin),
+           'staging_songs': ('SONG_DATA', staging_songs_columns, coerce_song, staging_songs_copy_stdin)}
+
+JSONPATH_ELEMENT = re.compile(r"\['([^']*)'\]|\[\"([^\"]*)\"\]|\.(\w+)|\[(\d+)\]")
+
+_s3_clients = {}
+
+
+def s3_client(credentials):
+    """returns an S3 client for (region, key, secret), one per process"""
+    if credentials not in _s3_clients:
+        import boto3
+        region, key, secret = credentials
+        _s3_clients[credentials] = boto3.client('s3', region_name=region, aws_access_key_id=key,
+                                                aws_secret_access_key=secret)
+    return _s3_clients[credentials]
+
+
+def source_lines(key, credentials=None):
+    """yields the lines of a local file or an S3 object without reading it whole"""
+    if is_s3(key):
+        bucket, name = split_s3(key)
+        body = s3_client(credentials).get_object(Bucket=bucket, Key=name)['Body']
+        for line in body.iter_lines():
+            yield line.decode('utf-8')
+    else:
+        with open(key) as f:
+            for line in f:
+                yield line
+
+
+def jsonpath_keys(expression):
+    """splits a COPY JSONPath expression such as $['artist'] or $.song.title into its keys"""
+    keys, position = [], 1
+    if not expression.startswith('$'):
+        raise ValueError('invalid JSONPath expression {!r}'.format(expression))
+    while position < len(expression):
+        match = JSONPATH_ELEMENT.match(expression, position)
+        if not match:
+            raise ValueError('invalid JSONPath expression {!r}'.format(expression))
+        quoted, double_quoted, name, index = match.groups()
+        if index is not None:
+            keys.append(int(index))
+        else:
+            keys.append(quoted if quoted is not None else double_quoted if double_quoted is not None else name)
+        position = match.end()
+    return keys
+
+
+def read_jsonpaths(location, credentials=None):
+    """returns the key paths of a COPY jsonpaths file in column order, None for 'auto'"""
+    if location in ('', 'auto'):
+        return None
+    document = json.loads(''.join(source_lines(location, credentials)))
+    return [jsonpath_keys(expression) for expression in document['jsonpaths']]
+
+
+def extract(record, paths):
+    """returns the values a jsonpaths file maps a record onto, None for missing elements like COPY"""
+    values = []
+    for keys in paths:
+        value = record
+        for key in keys:
+            try:
+                value = value[key]
+            except (KeyError, IndexError, TypeError):
+                value = None
+                break
+        values.append(value)
+    return values
+
+
+def parse_records(lines):
+    """yields (line, record or None) of JSON lines, None for lines that do not parse
+    A file whose first line does not parse is read whole, it may hold one document spread
+    over several lines.
+    """
+    lines = iter(lines)
+    first = True
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            yield line, json.loads(line)
+        except ValueError:
+            if not first:
+                yield line, None
+                continue
+            text = line + ''.join(lines)
+            try:
+                yield text, json.loads(text)
+            except ValueError:
+                yield line, None
+                for rest in text.splitlines()[1:]:
+                    if rest.strip():
+                        try:
+                            yield rest, json.loads(rest)
+                        except ValueError:
+                            yield rest, None
+            return
+        first = False
+
+
+def copy_text(value):
+    """formats one value for COPY's text format: NULL as \\N, backslashes and delimiters escaped"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat(' ')
+    elif isinstance(value, float):
+        value = repr(value)
+    else:
+        value = str(value)
+    return (value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+            .replace('\x00', ''))
+
+
+def encode_file(task):
+    """parses one source file into COPY text rows
+    Runs in a worker process for parallel loads; S3 keys are read with a client created
+    from task['credentials'].
+    Return(s):
+        (utf-8 COPY data, rows, rejected lines)
+    """
+    _, columns, coerce, _ = SOURCES[task['table']]
+    paths = task['jsonpaths']
+    rows, errors, out = 0, 0, []
+    for _, record in parse_records(source_lines(task['key'], task['credentials'])):
+        try:
+            if not isinstance(record, dict):
+                raise ValueError('Invalid JSONPath format')
+            values = coerce(dict(zip(columns, extract(record, paths))) if paths else record)
+        except (ValueError, TypeError, OverflowError):
+            errors += 1
+            continue
+        out.append('\t'.join(copy_text(value) for value in values))
+        rows += 1
+    return ('\n'.join(out) + '\n' if out else '').encode('utf-8'), rows, errors
+
+
+def encoded_files(tasks, workers=1):
+    """yields encode_file results in source order
+    With several workers the files are parsed on a process pool, at most
+    workers * FILES_IN_FLIGHT ahead of the COPY stream, so neither the file list nor
+    the parsed rows are held in memory.
+    """
+    if workers <= 1:
+        for task in tasks:
+            yield encode_file(task)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for task in tasks:
+            pending.append(executor.submit(encode_file, task))
+            if len(pending) >= workers * FILES_IN_FLIGHT:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class ChunkStream:
+    """file like view of an iterator of bytes, read by copy_expert as the COPY data"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = bytearray()
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+def stream_table(cur, table, keys, jsonpaths=None, workers=1, credentials=None, maxerror=0):
+    """streams source files into a staging table through a single COPY FROM STDIN
+    Like COPY, lines that do not parse or coerce are rejected and more than maxerror
+    rejected lines abort the load.
+    Args:
+        cur (cursor): psycopg2 cursor
+        table (string): staging_events or staging_songs
+        keys: iterable of local paths or S3 keys, consumed lazily
+        jsonpaths: key paths from read_jsonpaths, None maps columns by name
+        workers (int): parser processes, 1 parses in this process
+        credentials: (region, key, secret) for S3 keys
+    Return(s):
+        dict with files, rows, errors, bytes and seconds
+    """
+    stats = {'files': 0, 'rows': 0, 'errors': 0, 'bytes': 0}
+    tasks = ({'table': table, 'key': key, 'jsonpaths': jsonpaths, 'credentials': credentials} for key in keys)
+
+    def chunks():
+        for data, rows, errors in encoded_files(tasks, workers):
+            stats['files'] += 1
+            stats['rows'] += rows
+            stats['errors'] += errors
+            stats['bytes'] += len(data)
+            if stats['errors'] > maxerror:
+                raise ValueError('{} lines of {} rejected, more than MAXERROR {}'.format(stats['errors'], table,
+                                                                                         maxerror))
+            yield data
+
+    started = time.time()
+    cur.copy_expert(SOURCES[table][3], ChunkStream(chunks()), size=COPY_BUFFER_BYTES)
+    stats['seconds'] = time.time() - started
+    print("Streamed {} files into {}: {} rows ({} rejected), {:.1f} MB in {:.2f}s, {:.0f} rows/s".format(
+        stats['files'], table, stats['rows'], stats['errors'], stats['bytes'] / 1048576.0, stats['seconds'],
+        stats['rows'] / stats['seconds'] if stats['seconds'] else 0))
+    recorder.record('stream_load', table, stats['seconds'], stats['rows'], files=stats['files'],
+                    errors=stats['errors'], bytes=stats['bytes'], workers=workers)
+    return stats
+
+
+def stream_load_staging(cur, conn, config, workers=None):
+    """loads both staging tables from LOG_DATA/SONG_DATA with COPY FROM STDIN instead of COPY from S3
+    The sources may be S3 prefixes or local directories; log records are mapped with
+    LOG_JSONPATH like the S3 COPY.
+    Args:
+        cur (cursor): cursor to execute queries
+        conn: open connection
+        config: config object read from dwh.cfg
+        workers (int): parser processes, defaults to STREAM_WORKERS
+    """
+    workers = workers or config.getint('ETL', 'STREAM_WORKERS', fallback=1)
+    maxerror = config.getint('ETL', 'COPY_MAXERROR', fallback=0)
+    credentials = (config['REDSHIFT']['REGION_NAME'], config['AWS']['key'], config['AWS']['secret'])
+    try:
+        print("Loading staging tables started\n")
+        jsonpath = strip_quotes(config.get('S3', 'LOG_JSONPATH', fallback='auto'))
+        jsonpaths = {'staging_events': read_jsonpaths(jsonpath, credentials if is_s3(jsonpath) else None),
+                     'staging_songs': None}
+        for table, (option, _, _, _) in SOURCES.items():
+            location = strip_quotes(config.get('S3', option))
+            stream_table(cur, table, list_source_objects(location, config), jsonpaths[table], workers,
+                         credentials if is_s3(location) else None, maxerror)
+        conn.commit()
+        print("Loading staging tables completed\n")
+    except Exception:
+        conn.rollback()
+        raise
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='streams local JSON files into the staging tables of a '
+                                                 'Postgres compatible database with COPY FROM STDIN')
+    parser.add_argument('dsn', help='connection string, e.g. "host=localhost dbname=sparkify"')
+    parser.add_argument('log_data', help='log_data directory')
+    parser.add_argument('song_data', help='song_data directory')
+    parser.add_argument('--jsonpaths', default='auto', help='COPY jsonpaths file for log_data, default auto')
+    parser.add_argument('--workers', type=int, default=1, help='parser processes, default 1')
+    parser.add_argument('--maxerror', type=int, default=0, help='rejected lines tolerated per table')
+    args = parser.parse_args()
+
+    import psycopg2
+    conn = psycopg2.connect(args.dsn)
+    cur = conn.cursor()
+    for table, location, jsonpaths in [('staging_events', args.log_data, read_jsonpaths(args.jsonpaths)),
+                                       ('staging_songs', args.song_data, None)]:
+        stream_table(cur, table, list_source_objects(location.rstrip('/')), jsonpaths, args.workers,
+                     maxerror=args.maxerror)
+    conn.commit()
+    conn.close()
+    recorder.summary()
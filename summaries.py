@@ -0,0 +1,26 @@
+from sql_queries import summary_delete_queries, summary_refresh_queries
+from instrumentation import run_statement
+
+
+def refresh_summaries(cur, conn, full=False):
+    """folds songplays added since the last refresh into the summary tables
+    songplays.loaded_at is set when a load writes a row, so rows after the recorded
+    watermark are the ones inserted since the last refresh. The refresh, including the
+    DELETEs of a full rebuild, runs as one transaction.
+    Args:
+        cur (cursor): cursor to execute queries
+        conn: open connection
+        full (bool): rebuild the summaries from all songplays, required after songplays was recreated
+    """
+    try:
+        print("refreshing summary tables ({})\n".format('full' if full else 'incremental'))
+        if full:
+            for query in summary_delete_queries:
+                run_statement(cur, query, 'refresh_summaries')
+        for query in summary_refresh_queries:
+            run_statement(cur, query, 'refresh_summaries')
+        conn.commit()
+        print("refreshing summary tables completed\n")
+    except Exception:
+        conn.rollback()
+        raise
@@ -0,0 +1,191 @@
+import os
+import sys
+import json
+import configparser
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import sql_queries
+from instrumentation import recorder
+
+
+def make_config(path=os.path.join(ROOT, 'dwh.cfg'), **sections):
+    """reads dwh.cfg and overrides options, e.g. make_config(ETL={'load_mode': 'incremental'})"""
+    config = configparser.ConfigParser()
+    config.read(path)
+    for section, options in sections.items():
+        if not config.has_section(section):
+            config.add_section(section)
+        for option, value in options.items():
+            config.set(section, option, str(value))
+    return config
+
+
+def song_record(**values):
+    """a song_data record, fields overridden by values"""
+    record = {'num_songs': 1, 'artist_id': 'A1', 'artist_latitude': None, 'artist_longitude': None,
+              'artist_location': '', 'artist_name': 'Artist', 'song_id': 'S1', 'title': 'Song', 'duration': 200.0,
+              'year': 2000}
+    record.update(values)
+    return record
+
+
+def event_record(**values):
+    """a NextSong log_data record, fields overridden by values"""
+    record = {'artist': 'Artist', 'auth': 'Logged In', 'firstName': 'A', 'gender': 'F', 'itemInSession': 0,
+              'lastName': 'B', 'length': 200.0, 'level': 'free', 'location': 'X', 'method': 'PUT', 'page': 'NextSong',
+              'registration': 1540000000000.0, 'sessionId': 1, 'song': 'Song', 'status': 200, 'ts': 1541105830796,
+              'userAgent': 'ua', 'userId': '7'}
+    record.update(values)
+    return record
+
+
+def write_records(path, records):
+    """writes records as JSON lines, creating the parent directories"""
+    os.makedirs(os.path.dirname(str(path)), exist_ok=True)
+    with open(str(path), 'w') as f:
+        f.write('\n'.join(json.dumps(record) for record in records) + '\n')
+    return str(path)
+
+
+class FakeCursor:
+    """records executed statements; fetches return the rows queued in results"""
+
+    def __init__(self, results=None, fail_on=None):
+        self.statements = []
+        self.results = list(results or [])
+        self.rowcount = 0
+        self.fail_on = fail_on
+
+    def execute(self, query, params=None):
+        if self.fail_on and self.fail_on in query:
+            raise RuntimeError('failed: ' + self.fail_on)
+        self.statements.append((query, params))
+
+    def executemany(self, query, rows):
+        self.statements.append((query, list(rows)))
+
+    def fetchone(self):
+        return self.results.pop(0) if self.results else (0,)
+
+    def fetchall(self):
+        return self.results.pop(0) if self.results else []
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, cursor=None):
+        self.cur = cursor or FakeCursor()
+        self.commits = 0
+        self.rollbacks = 0
+        self.autocommit = False
+        self.closed = False
+
+    def cursor(self):
+        return self.cur
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture(autouse=True)
+def isolated_run():
+    """renders the statements from the repo's dwh.cfg and keeps metrics in memory"""
+    recorder.configure(None, capture_query_ids=False)
+    sql_queries.configure(make_config())
+    yield
+    sql_queries.configure(make_config())
+
+
+@pytest.fixture
+def config():
+    return make_config()
+
+
+@pytest.fixture
+def conn():
+    return FakeConnection()
+
+
+@pytest.fixture
+def pg_conn():
+    """a connection to the Postgres stand-in named by SPARKIFY_TEST_DSN, its tables dropped"""
+    psycopg2 = pytest.importorskip('psycopg2')
+    dsn = os.environ.get('SPARKIFY_TEST_DSN')
+    if not dsn:
+        pytest.skip('SPARKIFY_TEST_DSN is not set')
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    for query in sql_queries.drop_table_queries:
+        cur.execute(query)
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+REGION = 'us-west-2'
+
+
+class MotoRedshift:
+    """a moto Redshift client with the calls moto does not implement recorded instead"""
+
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def modify_cluster_iam_roles(self, ClusterIdentifier, AddIamRoles):
+        self.calls.append(('modify_cluster_iam_roles', AddIamRoles))
+        cluster = self.client.describe_clusters(ClusterIdentifier=ClusterIdentifier)['Clusters'][0]
+        cluster['IamRoles'] = [{'IamRoleArn': arn, 'ApplyStatus': 'in-sync'} for arn in AddIamRoles]
+        return {'Cluster': cluster}
+
+    def modify_cluster_parameter_group(self, ParameterGroupName, Parameters):
+        self.calls.append(('modify_cluster_parameter_group', ParameterGroupName, Parameters))
+        return {'ParameterGroupName': ParameterGroupName, 'ParameterGroupStatus': 'Your parameter group has been updated'}
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    """moto backed iam, redshift and s3 clients and an ec2 resource"""
+    moto = pytest.importorskip('moto')
+    boto3 = pytest.importorskip('boto3')
+    for name in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SECURITY_TOKEN', 'AWS_SESSION_TOKEN']:
+        monkeypatch.setenv(name, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', REGION)
+    # AmazonS3ReadOnlyAccess is attached to and detached from the cluster role
+    monkeypatch.setenv('MOTO_IAM_LOAD_MANAGED_POLICIES', 'true')
+    with moto.mock_aws():
+        yield {'iam': boto3.client('iam', region_name=REGION),
+               'redshift': MotoRedshift(boto3.client('redshift', region_name=REGION)),
+               'ec2': boto3.resource('ec2', region_name=REGION),
+               's3': boto3.client('s3', region_name=REGION)}
+
+
+@pytest.fixture
+def redshift():
+    """a Redshift client whose responses are queued with botocore's Stubber, for calls moto lacks"""
+    boto3 = pytest.importorskip('boto3')
+    botocore_stub = pytest.importorskip('botocore.stub')
+    client = boto3.client('redshift', region_name=REGION, aws_access_key_id='testing',
+                          aws_secret_access_key='testing')
+    with botocore_stub.Stubber(client) as stubber:
+        client.stubber = stubber
+        yield client
+        stubber.assert_no_pending_responses()
+
+
+# wait_for_cluster options that poll without sleeping
+NO_WAIT = {'delay': 1, 'timeout': 5, 'sleep': lambda seconds: None}
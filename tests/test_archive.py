@@ -0,0 +1,60 @@
+import datetime
+import sql_queries
+import archive
+from create_tables import create_tables
+from conftest import make_config, FakeCursor, FakeConnection
+
+PARTITION = {'year': 2018, 'month': 1, 'rows': 5, 'start': datetime.datetime(2018, 1, 1),
+             'end': datetime.datetime(2018, 2, 1), 'location': 's3://bucket/archive/year=2018/month=1/'}
+OPTIONS = {'schema': 'spectrum', 'role_arn': 'arn:aws:iam::1:role/r'}
+
+
+def archive_config(load_mode):
+    return make_config(S3={'archive_prefix': 's3://bucket/archive'}, ETL={'archive': 'true', 'load_mode': load_mode})
+
+
+def test_full_loads_do_not_archive():
+    conn = FakeConnection()
+    assert archive.archive_songplays(conn, archive_config('full')) == []
+    assert conn.cursor().statements == []
+
+
+def test_moved_month_is_taken_off_the_summaries():
+    cur = FakeCursor(results=[(3,), (8,)])
+    assert archive.archive_partition(cur, OPTIONS, 'songplay_id', PARTITION, '20180301000000')
+
+    query, params = cur.statements[-1]
+    assert query == sql_queries.archive_month_delete
+    assert params == {'start': PARTITION['start'], 'end': PARTITION['end']}
+    assert query.index('UPDATE song_play_counts') < query.index('DELETE FROM songplays')
+    assert 'UPDATE artist_play_counts' in query and 'UPDATE hourly_play_counts' in query
+
+
+def test_mismatched_month_is_kept():
+    cur = FakeCursor(results=[(3,), (7,)])
+    assert not archive.archive_partition(cur, OPTIONS, 'songplay_id', PARTITION, '20180301000000')
+    assert all(query != sql_queries.archive_month_delete for query, _ in cur.statements)
+
+
+def test_month_delete_adjusts_summaries_on_postgres(pg_conn):
+    from summaries import refresh_summaries
+    sql_queries.configure(make_config(ETL={'dialect': 'postgres'}))
+    cur = pg_conn.cursor()
+    create_tables(cur, pg_conn)
+    plays = [('2018-01-10 10:00', 'S1', 'A1'), ('2018-01-11 10:00', 'S1', 'A1'), ('2018-01-12 11:00', 'S2', 'A1'),
+             ('2018-02-10 10:00', 'S1', 'A1')]
+    cur.executemany("INSERT INTO songplays (start_time, user_id, song_id, artist_id) VALUES (%s, '7', %s, %s);",
+                    plays)
+    pg_conn.commit()
+    refresh_summaries(cur, pg_conn, full=True)
+
+    pg_conn.autocommit = True
+    cur.execute(sql_queries.archive_month_delete, {'start': PARTITION['start'], 'end': PARTITION['end']})
+    cur.execute("SELECT song_id, play_count FROM song_play_counts ORDER BY 1;")
+    assert cur.fetchall() == [('S1', 1)]
+    cur.execute("SELECT artist_id, play_count FROM artist_play_counts;")
+    assert cur.fetchall() == [('A1', 1)]
+    cur.execute("SELECT hour, play_count FROM hourly_play_counts;")
+    assert cur.fetchall() == [(10, 1)]
+    cur.execute("SELECT COUNT(*) FROM songplays;")
+    assert cur.fetchone()[0] == 1
@@ -0,0 +1,92 @@
+import pytest
+from create_resources import provision, create_ec2_sg, describe_cluster
+from conftest import make_config, NO_WAIT
+
+
+def cluster_config():
+    # moto does not implement modify_cluster_parameter_group, see test_wlm.py for the parameter group
+    return make_config(WLM={'parameter_group': ''}, REDSHIFT={'snapshot_identifier': ''})
+
+
+def run_provision(aws, config):
+    messages = []
+    cluster_props, roleArn, sg = provision(config, aws['iam'], aws['redshift'], aws['ec2'], messages.append, **NO_WAIT)
+    return cluster_props, roleArn, sg, messages
+
+
+def test_provision_creates_cluster_and_role(aws):
+    config = cluster_config()
+    cluster_props, roleArn, sg, messages = run_provision(aws, config)
+
+    assert cluster_props['ClusterStatus'] == 'available'
+    assert roleArn == aws['iam'].get_role(RoleName=config['REDSHIFT']['ROLE_NAME'])['Role']['Arn']
+    assert aws['redshift'].calls == [('modify_cluster_iam_roles', [roleArn])]
+    # moto clusters are not placed in a VPC
+    assert sg is None
+    assert any(message.startswith('Creating a Redshift Cluster') for message in messages)
+
+
+def test_provision_reuses_available_cluster(aws):
+    config = cluster_config()
+    run_provision(aws, config)
+    cluster_props, _, _, messages = run_provision(aws, config)
+
+    assert any(message.startswith('Reusing Redshift cluster') for message in messages)
+    assert len(aws['redshift'].describe_clusters()['Clusters']) == 1
+    assert cluster_props['ClusterStatus'] == 'available'
+
+
+def test_provision_resumes_paused_cluster(aws):
+    config = cluster_config()
+    run_provision(aws, config)
+    aws['redshift'].pause_cluster(ClusterIdentifier=config['REDSHIFT']['CLUSTER_IDENTIFIER'])
+    cluster_props, _, _, messages = run_provision(aws, config)
+
+    assert any(message.startswith('Resuming paused Redshift cluster') for message in messages)
+    assert describe_cluster(aws['redshift'], config)['ClusterStatus'] == 'available'
+
+
+def delete_with_snapshot(aws, config, snapshot):
+    aws['redshift'].delete_cluster(ClusterIdentifier=config['REDSHIFT']['CLUSTER_IDENTIFIER'],
+                                   SkipFinalClusterSnapshot=False, FinalClusterSnapshotIdentifier=snapshot)
+    assert describe_cluster(aws['redshift'], config) is None
+
+
+def test_provision_restores_latest_snapshot_when_enabled(aws):
+    config = cluster_config()
+    config.set('REDSHIFT', 'restore_latest_snapshot', 'true')
+    identifier = config['REDSHIFT']['CLUSTER_IDENTIFIER']
+    run_provision(aws, config)
+    delete_with_snapshot(aws, config, identifier + '-20181130-221500')
+    cluster_props, _, _, messages = run_provision(aws, config)
+
+    assert 'Restoring Redshift cluster {} from snapshot {}-20181130-221500'.format(identifier, identifier) in messages
+    assert cluster_props['ClusterStatus'] == 'available'
+
+
+@pytest.mark.parametrize('restore_latest, snapshot', [('false', 'sparkify-dwh-20181130-221500'),
+                                                      ('true', 'sparkify-dwh-manual-backup')])
+def test_provision_ignores_snapshots_it_may_not_restore(aws, restore_latest, snapshot):
+    config = cluster_config()
+    config.set('REDSHIFT', 'restore_latest_snapshot', restore_latest)
+    run_provision(aws, config)
+    delete_with_snapshot(aws, config, snapshot)
+    cluster_props, _, _, messages = run_provision(aws, config)
+
+    assert any(message.startswith('Creating a Redshift Cluster') for message in messages)
+    assert cluster_props['ClusterStatus'] == 'available'
+
+
+def test_security_group_opened_on_cluster_port(aws):
+    config = cluster_config()
+    vpc = list(aws['ec2'].vpcs.all())[0]
+    sg = create_ec2_sg(aws['ec2'], config, {'ClusterIdentifier': 'sparkify-dwh', 'VpcId': vpc.id})
+
+    sg.reload()
+    port = int(config['REDSHIFT']['DB_PORT'])
+    assert any(permission.get('FromPort') == port and permission.get('ToPort') == port
+               for permission in sg.ip_permissions)
+
+
+def test_security_group_skipped_without_vpc(aws):
+    assert create_ec2_sg(aws['ec2'], cluster_config(), {'ClusterIdentifier': 'sparkify-dwh'}) is None
@@ -0,0 +1,85 @@
+import threading
+import pytest
+from conftest import FakeConnection
+
+psycopg2 = pytest.importorskip('psycopg2')
+import db  # noqa: E402
+
+
+@pytest.fixture
+def opened(monkeypatch):
+    """the connections the pool opens; connect fails while the list ends with None"""
+    connections = []
+
+    def connect(**settings):
+        if connections and connections[-1] is None:
+            raise psycopg2.OperationalError('could not connect')
+        connections.append(FakeConnection())
+        return connections[-1]
+
+    monkeypatch.setattr(db.psycopg2, 'connect', connect)
+    return connections
+
+
+def test_released_connection_is_reused(opened):
+    pool = db.ConnectionPool({}, size=2, statement_timeout=1000, query_group='etl')
+    conn = pool.acquire()
+    pool.release(conn)
+
+    assert pool.acquire() is conn
+    assert len(opened) == 1 and pool.created == 1
+    assert [query for query, _ in conn.cur.statements[:2]] == ['SET statement_timeout TO 1000;',
+                                                               'SET query_group TO %s;']
+    assert conn.rollbacks >= 1
+
+
+def test_stale_connection_is_replaced(opened):
+    pool = db.ConnectionPool({}, size=1)
+    stale = pool.acquire()
+    pool.release(stale)
+    stale.closed = True
+
+    conn = pool.acquire()
+    assert conn is not stale and conn is opened[-1]
+    assert pool.created == 1
+
+
+def test_failed_reconnect_frees_the_slot(opened):
+    pool = db.ConnectionPool({}, size=1)
+    stale = pool.acquire()
+    pool.release(stale)
+    stale.closed = True
+    opened.append(None)
+
+    with pytest.raises(psycopg2.OperationalError):
+        pool.acquire()
+    assert pool.created == 0
+    opened.pop()
+    assert pool.acquire() is opened[-1]
+
+
+def test_acquire_waits_at_size(opened):
+    pool = db.ConnectionPool({}, size=2)
+    first, second = pool.acquire(), pool.acquire()
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(pool.acquire()))
+    waiter.start()
+    waiter.join(0.2)
+
+    assert waiter.is_alive() and len(opened) == 2
+    pool.release(first)
+    waiter.join(5)
+    assert acquired == [first] and pool.created == 2
+    pool.release(second)
+
+
+def test_close_keeps_count_of_checked_out_connections(opened):
+    pool = db.ConnectionPool({}, size=2)
+    idle, busy = pool.acquire(), pool.acquire()
+    pool.release(idle)
+    pool.close()
+
+    assert idle.closed and not busy.closed
+    assert pool.created == 1
+    pool.release(busy)
+    assert busy.closed and pool.created == 0
@@ -0,0 +1,65 @@
+import pytest
+import etl
+import summaries
+import maintenance
+from instrumentation import recorder
+from conftest import ROOT, FakeCursor, FakeConnection
+
+
+@pytest.fixture
+def run(monkeypatch):
+    """an etl.Run whose pools open FakeConnections"""
+    pytest.importorskip('psycopg2')
+    import db
+    monkeypatch.setattr(db.psycopg2, 'connect', lambda **settings: FakeConnection())
+    run = etl.Run(ROOT + '/dwh.cfg')
+    yield run
+    run.close()
+    db.close_pools()
+
+
+def test_parallel_inserts_get_every_pooled_connection(run, monkeypatch):
+    run.config.set('ETL', 'MAX_WORKERS', '4')
+    pool = run.pool()
+    borrowed = []
+
+    def insert_tables_parallel(pool, max_workers, options=None):
+        # no connection may still be checked out, otherwise the last worker waits for it
+        assert pool.created - pool.idle.qsize() == 0
+        borrowed.extend(pool.acquire() for _ in range(max_workers))
+        for conn in borrowed:
+            pool.release(conn)
+
+    monkeypatch.setattr(etl, 'insert_tables_parallel', insert_tables_parallel)
+    monkeypatch.setattr(summaries, 'refresh_summaries', lambda cur, conn, full=False: None)
+    monkeypatch.setattr(maintenance, 'run_maintenance', lambda conn, **options: None)
+    run.connection()
+    etl.transform(run)
+
+    assert len(borrowed) == run.config.getint('ETL', 'MAX_WORKERS') == pool.size
+    # the phase's connection is acquired again for the summaries
+    assert 'etl' in run.connections
+
+
+def test_close_returns_connections_and_closes_pools(run):
+    run.connection()
+    run.connection('bi')
+    pools = list(run.pools.values())
+    run.close()
+
+    assert (run.connections, run.pools) == ({}, {})
+    assert [(pool.created, pool.idle.qsize()) for pool in pools] == [(0, 0), (0, 0)]
+
+
+def test_failed_copy_stops_the_run_and_records_the_phase(run, monkeypatch):
+    ran = []
+    monkeypatch.setattr(etl, 'Run', lambda config_file: run)
+    monkeypatch.setattr(run, 'connection', lambda workload='etl': (FakeCursor(fail_on='COPY'), FakeConnection()))
+    monkeypatch.setattr(etl, 'PHASE_FUNCTIONS', dict(etl.PHASE_FUNCTIONS, transform=lambda run: ran.append('transform')))
+    with pytest.raises(RuntimeError):
+        etl.run_phases(['load', 'transform'], ROOT + '/dwh.cfg')
+
+    assert ran == []
+    phases = [(record['step'], record['status']) for record in recorder.records if record['phase'] == 'phase']
+    assert phases == [('load', 'failed')]
+    assert [record['status'] for record in recorder.records if record['phase'] == 'load_staging_tables'] == ['failed']
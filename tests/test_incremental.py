@@ -0,0 +1,97 @@
+import pytest
+import sql_queries
+import incremental
+from create_tables import create_tables
+from conftest import make_config, FakeCursor, FakeConnection, song_record, event_record, write_records
+
+
+def local_config(tmp_path, **etl):
+    etl.setdefault('load_mode', 'incremental')
+    return make_config(S3={'log_data': str(tmp_path / 'log_data'), 'song_data': str(tmp_path / 'song_data')},
+                       ETL=etl)
+
+
+def state_inserts(cur):
+    return [rows for query, rows in cur.statements if query == sql_queries.load_state_insert]
+
+
+def test_state_recorded_in_merge_transaction(tmp_path):
+    config = local_config(tmp_path)
+    write_records(tmp_path / 'log_data' / '2018' / '11' / 'events.json', [event_record()])
+    write_records(tmp_path / 'song_data' / 'A' / 'song.json', [song_record()])
+    conn = FakeConnection(FakeCursor(results=[(None,), [], []]))
+    incremental.incremental_load(conn.cursor(), conn, config)
+
+    statements = [query for query, _ in conn.cursor().statements]
+    merge = statements.index(sql_queries.merge_table_steps[-1][1])
+    first_state = statements.index(sql_queries.load_state_insert)
+    assert first_state > merge
+    assert [[row[1] for row in rows] for rows in state_inserts(conn.cursor())] == [
+        [str(tmp_path / 'log_data' / '2018' / '11' / 'events.json')],
+        [str(tmp_path / 'song_data' / 'A' / 'song.json')]]
+    assert conn.rollbacks == 0
+
+
+def test_failed_merge_records_nothing(tmp_path):
+    config = local_config(tmp_path)
+    write_records(tmp_path / 'log_data' / '2018' / '11' / 'events.json', [event_record()])
+    write_records(tmp_path / 'song_data' / 'A' / 'song.json', [song_record()])
+    conn = FakeConnection(FakeCursor(results=[(None,), [], []], fail_on='INSERT INTO songplays'))
+    with pytest.raises(RuntimeError):
+        incremental.incremental_load(conn.cursor(), conn, config)
+
+    assert state_inserts(conn.cursor()) == []
+    assert conn.rollbacks == 1
+
+
+def test_failed_song_keys_stop_before_the_merge(tmp_path):
+    config = local_config(tmp_path)
+    write_records(tmp_path / 'log_data' / '2018' / '11' / 'events.json', [event_record()])
+    write_records(tmp_path / 'song_data' / 'A' / 'song.json', [song_record()])
+    conn = FakeConnection(FakeCursor(results=[(None,), [], []], fail_on='SET song_key'))
+    with pytest.raises(RuntimeError):
+        incremental.incremental_load(conn.cursor(), conn, config)
+
+    statements = [query for query, _ in conn.cursor().statements]
+    assert not any(query in statements for _, query, _, _ in sql_queries.merge_table_steps)
+    assert state_inserts(conn.cursor()) == []
+
+
+def test_new_songs_copied_by_key_without_manifest_prefix(monkeypatch):
+    config = make_config(S3={'song_data': 's3://bucket/song-data', 'manifest_prefix': ''},
+                         IAM_ROLE={'arn': 'arn:aws:iam::1:role/r'})
+    keys = ['s3://bucket/song-data/A/a.json', 's3://bucket/song-data/B/b.json', 's3://bucket/song-data/C/c.json']
+    monkeypatch.setattr(incremental, 'list_source_objects', lambda location, config=None: iter(keys))
+    cur = FakeCursor(results=[[(keys[0],)]])
+    loaded = incremental.load_new_songs(cur, FakeConnection(cur), config)
+
+    copies = [query for query, _ in cur.statements if query.strip().startswith('COPY')]
+    assert loaded == keys[1:]
+    assert len(copies) == 2
+    assert all("FROM '{}'".format(key) in copy for key, copy in zip(keys[1:], copies))
+    assert not any("FROM 's3://bucket/song-data'" in copy for copy in copies)
+
+
+@pytest.mark.parametrize('schema_profile', ['default', 'keyed'])
+def test_two_incremental_loads_on_postgres(tmp_path, pg_conn, schema_profile):
+    config = local_config(tmp_path, dialect='postgres', time_profile='event', schema_profile=schema_profile)
+    sql_queries.configure(config)
+    cur = pg_conn.cursor()
+    write_records(tmp_path / 'song_data' / 'A' / 'a.json', [song_record()])
+    write_records(tmp_path / 'log_data' / '2018' / '11' / 'day1.json',
+                  [event_record(ts=1541105830796), event_record(ts=1541105930796, userId='8')])
+    create_tables(cur, pg_conn)
+    incremental.incremental_load(cur, pg_conn, config)
+
+    write_records(tmp_path / 'song_data' / 'B' / 'b.json',
+                  [song_record(song_id='S2', title='Other', artist_id='A2', artist_name='Band')])
+    write_records(tmp_path / 'log_data' / '2018' / '11' / 'day2.json',
+                  [event_record(ts=1541205830796, song='Other', artist='Band'),
+                   event_record(ts=1541205830796, song='Other', artist='Band')])
+    incremental.incremental_load(cur, pg_conn, config)
+
+    counts = {}
+    for table in ['songplays', 'users', 'songs', 'artists', 'time', 'etl_load_state']:
+        cur.execute('SELECT COUNT(*) FROM {};'.format(table))
+        counts[table] = cur.fetchone()[0]
+    assert counts == {'songplays': 3, 'users': 2, 'songs': 2, 'artists': 2, 'time': 3, 'etl_load_state': 4}
@@ -0,0 +1,70 @@
+from key_advisor import explain_targets, redistribution_steps, advise, alter_statements
+from conftest import FakeCursor, FakeConnection
+
+SONGPLAYS_PLAN = [
+    'XN Hash Join DS_DIST_BOTH  (cost=0.05..0.12 rows=1 width=48)',
+    '  Hash Cond: (("outer".song_key = "inner".song_key))',
+    '  ->  XN Seq Scan on staging_events events  (cost=0.00..0.04 rows=1 width=40)',
+    '        Filter: ((page)::text = \'NextSong\'::text)',
+    '  ->  XN Hash  (cost=0.04..0.04 rows=1 width=24)',
+    '        ->  XN Hash Join DS_BCAST_INNER  (cost=0.01..0.04 rows=1 width=24)',
+    '              Hash Cond: (("outer".artist_id = "inner".artist_id))',
+    '              ->  XN Seq Scan on staging_songs songs  (cost=0.00..0.01 rows=1 width=24)',
+    '              ->  XN Hash  (cost=0.00..0.00 rows=1 width=16)',
+    '                    ->  XN Seq Scan on artists  (cost=0.00..0.00 rows=1 width=16)',
+]
+
+
+def test_joins_parsed_with_their_tables_and_columns():
+    both, bcast = redistribution_steps(SONGPLAYS_PLAN)
+    assert (both['step'], both['outer'], both['inner']) == \
+        ('DS_DIST_BOTH', ('staging_events', 'song_key'), ('staging_songs', 'song_key'))
+    assert (bcast['step'], bcast['outer'], bcast['inner']) == \
+        ('DS_BCAST_INNER', ('staging_songs', 'artist_id'), ('artists', 'artist_id'))
+    assert redistribution_steps(['XN Hash Join DS_DIST_NONE  (cost=0.05..0.12 rows=1 width=48)']) == []
+
+
+def test_keys_derived_from_the_plans_and_skew():
+    plans = [[(line,) for line in SONGPLAYS_PLAN]] + [[]] * (len(explain_targets()) - 1)
+    skew = [('users', 'KEY(user_id)', 1000, 9.5, 0), ('time', 'ALL', 1000, 12.0, 0)]
+    conn = FakeConnection(FakeCursor(results=plans + [skew]))
+    findings, skewed, suggestions = advise(conn.cursor(), conn)
+
+    assert suggestions == {'staging_events': {'diststyle': 'KEY', 'distkey': 'song_key', 'sortkey': 'song_key'},
+                           'staging_songs': {'diststyle': 'KEY', 'distkey': 'song_key', 'sortkey': 'song_key'},
+                           'artists': {'diststyle': 'ALL', 'distkey': None, 'sortkey': 'artist_id'},
+                           'users': {'diststyle': 'EVEN', 'distkey': None, 'sortkey': None}}
+    assert alter_statements(suggestions) == [
+        'ALTER TABLE artists ALTER DISTSTYLE ALL;',
+        'ALTER TABLE artists ALTER SORTKEY (artist_id);',
+        'ALTER TABLE staging_events ALTER DISTSTYLE KEY DISTKEY song_key;',
+        'ALTER TABLE staging_events ALTER SORTKEY (song_key);',
+        'ALTER TABLE staging_songs ALTER DISTSTYLE KEY DISTKEY song_key;',
+        'ALTER TABLE staging_songs ALTER SORTKEY (song_key);',
+        'ALTER TABLE users ALTER DISTSTYLE EVEN;']
+
+
+def test_co_located_plans_suggest_nothing():
+    conn = FakeConnection(FakeCursor(results=[[]] * len(explain_targets()) + [[]]))
+    assert advise(conn.cursor(), conn)[2] == {}
+
+
+def test_applied_key_profile_rewrites_the_create_statements(tmp_path):
+    import json
+    import sql_queries
+    from key_advisor import key_profile
+    from conftest import make_config
+    suggestions = {'songplays': {'diststyle': 'KEY', 'distkey': 'user_id', 'sortkey': 'start_time'},
+                   'users': {'diststyle': 'ALL', 'distkey': None, 'sortkey': 'user_id'},
+                   # a column of a subquery, not of the table
+                   'songs': {'diststyle': 'KEY', 'distkey': 'play_count', 'sortkey': None},
+                   'spectrum_songplays': {'diststyle': 'EVEN', 'distkey': None, 'sortkey': None}}
+    path = tmp_path / 'key_profile.json'
+    path.write_text(json.dumps(key_profile(suggestions)))
+    sql_queries.configure(make_config(ETL={'key_profile': str(path)}))
+
+    ddl = {sql_queries.table_definition(query)[0]: query for query in sql_queries.create_table_queries}
+    assert ddl['songplays'].rstrip().endswith(')\nDISTSTYLE KEY DISTKEY(user_id) SORTKEY(start_time);')
+    assert ddl['songplays'].count('DISTKEY') == ddl['songplays'].count('SORTKEY') == 1
+    assert ddl['users'].rstrip().endswith(')\nDISTSTYLE ALL SORTKEY(user_id);')
+    assert 'play_count' not in ddl['songs']
@@ -0,0 +1,71 @@
+from load_quality import file_outcomes, load_with_retries, local_copy, check_and_load
+from instrumentation import recorder
+from sql_queries import staging_rejects_insert
+from conftest import FakeCursor, song_record, event_record, write_records
+
+
+def song_files(tmp_path):
+    """a clean song file, one with a corrupt line and one that is not JSON at all"""
+    clean = write_records(tmp_path / 'A' / 'clean.json', [song_record(), song_record(song_id='S2')])
+    partial = write_records(tmp_path / 'B' / 'partial.json', [song_record(song_id='S3')])
+    with open(partial, 'a') as f:
+        f.write('{"song_id": "S4", "title": \n')
+    broken = tmp_path / 'broken.json'
+    broken.write_text('not json\n')
+    return clean, partial, str(broken)
+
+
+def test_file_outcomes():
+    outcomes = file_outcomes(['a', 'b', 'c', 'd'], {'a': 10, 'b': 8}, {'b': 2, 'c': 1})
+    assert {name: outcome['status'] for name, outcome in outcomes.items()} == {
+        'a': 'loaded', 'b': 'rejected', 'c': 'quarantined', 'd': 'failed'}
+    assert outcomes['b'] == {'lines': 8, 'errors': 2, 'status': 'rejected'}
+
+
+def test_aborted_copy_quarantines_bad_files_and_retries_the_rest(tmp_path):
+    clean, partial, broken = song_files(tmp_path)
+    outcomes = load_with_retries(local_copy('staging_songs', maxerror=0), [clean, partial, broken])
+
+    assert outcomes[partial] == {'lines': 0, 'errors': 1, 'status': 'quarantined', 'attempts': 1}
+    assert outcomes[broken] == {'lines': 0, 'errors': 1, 'status': 'quarantined', 'attempts': 1}
+    assert outcomes[clean] == {'lines': 2, 'errors': 0, 'status': 'loaded', 'attempts': 2}
+
+
+def test_rejected_lines_within_maxerror_commit_the_rest(tmp_path):
+    clean, partial, broken = song_files(tmp_path)
+    outcomes = load_with_retries(local_copy('staging_songs', maxerror=2), [clean, partial, broken])
+
+    assert {name: (outcome['status'], outcome['lines'], outcome['attempts']) for name, outcome in outcomes.items()} == {
+        clean: ('loaded', 2, 1), partial: ('rejected', 1, 1), broken: ('rejected', 0, 1)}
+
+
+def test_failed_attempts_are_retried_until_retries_run_out(tmp_path):
+    clean = write_records(tmp_path / 'events.json', [event_record()])
+    copy = local_copy('staging_events', maxerror=0)
+    attempts = []
+
+    def flaky(files, attempt):
+        attempts.append(list(files))
+        # the first two attempts abort before reading a line, e.g. a dropped connection
+        return ({}, {}) if attempt < 2 else copy(files, attempt)
+
+    assert load_with_retries(flaky, [clean], retries=2)[clean] == {'lines': 1, 'errors': 0, 'status': 'loaded',
+                                                                     'attempts': 3}
+    assert attempts == [[clean]] * 3
+    attempts.clear()
+    assert load_with_retries(flaky, [clean], retries=1)[clean]['status'] == 'failed'
+    assert len(attempts) == 2
+
+
+def test_rows_and_rejects_written_through_a_cursor(tmp_path):
+    clean, partial, broken = song_files(tmp_path)
+    cur = FakeCursor()
+    check_and_load('staging_songs', local_copy('staging_songs', maxerror=2, cur=cur), [clean, partial, broken])
+
+    (insert, rows), (rejects_query, rejects) = cur.statements
+    assert insert.startswith('INSERT INTO staging_songs') and len(rows) == 3
+    assert rejects_query == staging_rejects_insert
+    assert sorted((reject[2], reject[3]) for reject in rejects) == [(partial, 2), (broken, 1)]
+    record = recorder.records[-1]
+    assert (record['phase'], record['step'], record['rejected'], record['loaded'], record['rejected_lines']) == \
+        ('load_check', 'staging_songs', 2, 1, 2)
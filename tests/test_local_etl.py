@@ -0,0 +1,111 @@
+import os
+import pandas as pd
+import pytest
+import sql_queries
+import local_etl
+from conftest import make_config, song_record, event_record, write_records
+
+# 2018-11-01, a Thursday: 20:57:10, 21:01:46 and 21:17:33 UTC
+TS = [1541105830796, 1541106106796, 1541107053796]
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    """three songs by two artists, four events: two matched plays of a user who upgrades, one unmatched, one Home"""
+    write_records(tmp_path / 'song_data' / 'A' / 'A' / 'A' / 'TRA.json',
+                  [song_record(song_id='S1', title='Song', artist_id='A1', artist_name='Artist',
+                               artist_location='Old', year=1999)])
+    write_records(tmp_path / 'song_data' / 'A' / 'A' / 'B' / 'TRB.json',
+                  [song_record(song_id='S2', title='Other', artist_id='A1', artist_name='Artist',
+                               artist_location='New', year=2005)])
+    write_records(tmp_path / 'song_data' / 'A' / 'B' / 'A' / 'TRC.json',
+                  [song_record(song_id='S3', title='Tune', artist_id='A2', artist_name='Band',
+                               artist_location='Here', year=2010)])
+    write_records(tmp_path / 'log_data' / '2018' / '11' / '2018-11-01-events.json', [
+        # matched case and whitespace insensitively
+        event_record(ts=TS[0], userId='7', level='free', song=' song ', artist='ARTIST'),
+        event_record(ts=TS[1], userId='7', level='paid', song='Tune', artist='Band', sessionId=2),
+        event_record(ts=TS[2], userId='8', level='free', song='Unknown', artist='Nobody'),
+        event_record(ts=TS[2], userId='', page='Home', song='', artist='', length='')])
+    return str(tmp_path / 'log_data'), str(tmp_path / 'song_data')
+
+
+def load(dataset):
+    log_dir, song_dir = dataset
+    return local_etl.transform(local_etl.read_staging_events(log_dir), local_etl.read_staging_songs(song_dir))
+
+
+def rows(frame, columns):
+    return sorted(frame[columns].itertuples(index=False, name=None))
+
+
+def test_songplays_join_matched_events_only(dataset):
+    songplays = load(dataset)['songplays']
+
+    assert rows(songplays, ['user_id', 'level', 'song_id', 'artist_id', 'session_id']) == [
+        ('7', 'free', 'S1', 'A1', 1), ('7', 'paid', 'S3', 'A2', 2)]
+    assert list(songplays['hour_key']) == [2018110120, 2018110121]
+
+
+def test_upserts_keep_one_row_per_key_latest_wins(dataset):
+    tables = load(dataset)
+
+    assert rows(tables['users'], ['user_id', 'level']) == [(7, 'paid'), (8, 'free')]
+    assert rows(tables['songs'], ['song_id', 'title', 'artist_id', 'year']) == [
+        ('S1', 'Song', 'A1', 1999), ('S2', 'Other', 'A1', 2005), ('S3', 'Tune', 'A2', 2010)]
+    # the artist row of the newest song wins
+    assert rows(tables['artists'], ['artist_id', 'name', 'location']) == [('A1', 'Artist', 'New'),
+                                                                            ('A2', 'Band', 'Here')]
+
+
+def test_time_has_one_row_per_songplay_start(dataset):
+    time = load(dataset)['time']
+
+    assert list(time['start_time']) == list(pd.to_datetime(TS[:2], unit='ms'))
+    assert rows(time, ['hour', 'day', 'week', 'month', 'year', 'weekday']) == [
+        (20, 1, 44, 11, 2018, '4'), (21, 1, 44, 11, 2018, '4')]
+
+
+def test_hourly_time_covers_every_hour_between_plays(dataset):
+    sql_queries.configure(make_config(ETL={'time_profile': 'hourly'}))
+    tables = load(dataset)
+
+    assert 'time' not in tables
+    assert list(tables['time_hour']['hour_key']) == [2018110120, 2018110121]
+    assert set(tables['songplays']['hour_key']) <= set(tables['time_hour']['hour_key'])
+
+
+def test_duration_matching_drops_plays_of_other_lengths(dataset):
+    sql_queries.configure(make_config(ETL={'song_match_duration': 'true'}))
+    log_dir, song_dir = dataset
+    write_records(log_dir + '/2018/11/2018-11-02-events.json',
+                  [event_record(ts=TS[2], userId='9', song='Song', artist='Artist', length=260.0)])
+
+    assert rows(load(dataset)['songplays'], ['user_id', 'song_id']) == [('7', 'S1'), ('7', 'S3')]
+
+
+def test_postgres_pipeline_builds_the_same_tables(dataset, pg_conn, tmp_path, monkeypatch):
+    import db
+    import etl
+    log_dir, song_dir = dataset
+    config = make_config(S3={'log_data': log_dir, 'song_data': song_dir, 'log_jsonpath': "'auto'"},
+                         ETL={'stream_load': 'true', 'dialect': 'postgres', 'max_workers': 1, 'metrics_file': ''})
+    path = str(tmp_path / 'dwh.cfg')
+    with open(path, 'w') as f:
+        config.write(f)
+    connect = db.psycopg2.connect
+    monkeypatch.setattr(db.psycopg2, 'connect', lambda **settings: connect(os.environ['SPARKIFY_TEST_DSN']))
+    try:
+        etl.run_phases(['create', 'load', 'transform'], path)
+    finally:
+        db.close_pools()
+    local = load(dataset)
+
+    cur = pg_conn.cursor()
+    for table, columns in [('songplays', ['user_id', 'level', 'song_id', 'artist_id', 'session_id']),
+                           ('users', ['user_id', 'level']),
+                           ('songs', ['song_id', 'title', 'artist_id', 'year']),
+                           ('artists', ['artist_id', 'name', 'location']),
+                           ('time', ['hour', 'day', 'week', 'month', 'year', 'weekday'])]:
+        cur.execute('SELECT {} FROM {};'.format(', '.join(columns), table))
+        assert sorted(cur.fetchall()) == rows(local[table], columns), table
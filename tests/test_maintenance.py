@@ -0,0 +1,48 @@
+import pytest
+from instrumentation import recorder
+from maintenance import decide, run_maintenance
+from conftest import FakeCursor, FakeConnection
+
+
+def stats(unsorted=0, stats_off=0, rows=1000, visible_rows=1000, size_mb=10):
+    return {'table': 'songplays', 'unsorted': unsorted, 'stats_off': stats_off, 'rows': rows,
+            'visible_rows': visible_rows, 'size_mb': size_mb}
+
+
+@pytest.mark.parametrize('table, actions', [
+    (stats(), []),
+    (stats(rows=0, visible_rows=0), []),
+    (stats(visible_rows=951), []),
+    (stats(visible_rows=950), ['VACUUM DELETE ONLY']),
+    (stats(unsorted=4.9), []),
+    (stats(unsorted=5), ['VACUUM SORT ONLY']),
+    (stats(stats_off=9.9), []),
+    (stats(stats_off=10), ['ANALYZE']),
+    (stats(unsorted=20, stats_off=30, visible_rows=500), ['VACUUM DELETE ONLY', 'VACUUM SORT ONLY', 'ANALYZE'])])
+def test_decide_thresholds(table, actions):
+    assert [action for action, _ in decide(table)] == actions
+
+
+def test_decide_uses_configured_thresholds():
+    assert [action for action, _ in decide(stats(unsorted=5, stats_off=10), sort_threshold=20,
+                                           analyze_threshold=50)] == []
+
+
+def test_run_maintenance_follows_priority_and_budget():
+    # table, unsorted, stats_off, tbl_rows, estimated_visible_rows, size (MB) as SVV_TABLE_INFO returns them
+    rows = [('users', 0, 20, 100, 100, 10),
+            ('songs', 50, 0, 1000, 1000, 200),
+            # 100 GB at VACUUM_MB_PER_SECOND does not fit the budget, its ANALYZE still runs
+            ('songplays', 30, 40, 10 ** 8, 9 * 10 ** 7, 100000),
+            ('artists', 0, 0, 100, 100, 10),
+            ('staging_events', 90, 90, 1000, 0, 50)]
+    conn = FakeConnection(FakeCursor(results=[rows]))
+
+    run_maintenance(conn, budget=600)
+
+    assert [query for query, _ in conn.cur.statements[1:]] == ['ANALYZE songplays;', 'VACUUM SORT ONLY songs;',
+                                                               'ANALYZE users;']
+    assert conn.autocommit is False
+    skipped = [(record['step'], record['decision']) for record in recorder.records if record['status'] == 'skipped']
+    assert skipped == [('VACUUM DELETE ONLY songplays', 'budget'), ('VACUUM SORT ONLY songplays', 'budget')]
+    assert [record['step'] for record in recorder.records if record.get('decision') == 'none'] == ['skip artists']
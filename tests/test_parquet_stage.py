@@ -0,0 +1,77 @@
+import os
+import json
+import pytest
+from prestage import list_source_sizes
+from parquet_stage import plan_tasks, convert, column_kinds, SOURCES
+from conftest import song_record, event_record, write_records
+
+pq = pytest.importorskip('pyarrow.parquet')
+
+ARROW_TYPES = {'VARCHAR': 'string', 'INTEGER': 'int32', 'BIGINT': 'int64', 'FLOAT': 'double',
+               'DECIMAL': 'decimal128(18, 0)', 'TIMESTAMP': 'timestamp[ms]'}
+
+
+def convert_tree(tmp_path, name, **options):
+    location = str(tmp_path / name)
+    tasks = plan_tasks(name, list_source_sizes(location), str(tmp_path / 'parquet'), **options)
+    return tasks, convert(tasks, workers=1)
+
+
+def read_back(paths):
+    return [pq.read_table(path) for path in sorted(paths)]
+
+
+def assert_staging_types(table, name):
+    _, ddl, columns, _ = SOURCES[name]
+    assert [(field.name, str(field.type)) for field in table.schema] == [
+        (column, ARROW_TYPES[column_type.split('(')[0]]) for column, column_type in column_kinds(ddl, columns)]
+
+
+def test_songs_are_not_split_by_directory(tmp_path):
+    for i, letters in enumerate(['A/A/A', 'A/B/C', 'B/C/D', 'C/D/E', 'Z/Z/Z']):
+        write_records(tmp_path / 'song_data' / letters / 'TR{}.json'.format(i),
+                      [song_record(song_id='S{}'.format(i), artist_location=' ')])
+    # one document spread over several lines
+    with open(str(tmp_path / 'song_data' / 'A' / 'A' / 'A' / 'TRpretty.json'), 'w') as f:
+        json.dump(song_record(song_id='S9', artist_location='Paris'), f, indent=2)
+
+    tasks, totals = convert_tree(tmp_path, 'song_data')
+
+    assert len(tasks) == 1 and os.path.dirname(tasks[0]['path']) == str(tmp_path / 'parquet' / 'song_data')
+    assert (totals['rows'], totals['errors']) == (6, 0)
+    table, = read_back(totals['paths'])
+    assert_staging_types(table, 'song_data')
+    assert sorted(table.column('song_id').to_pylist()) == ['S0', 'S1', 'S2', 'S3', 'S4', 'S9']
+    # BLANKSASNULL
+    assert table.column('artist_location').to_pylist().count(None) == 5
+
+
+def test_songs_split_into_files_of_target_bytes(tmp_path):
+    for i in range(4):
+        write_records(tmp_path / 'song_data' / 'A' / 'TR{}.json'.format(i), [song_record(song_id='S{}'.format(i))])
+
+    tasks, totals = convert_tree(tmp_path, 'song_data', target_bytes=1)
+
+    assert len(tasks) == 4
+    assert sum(table.num_rows for table in read_back(totals['paths'])) == 4
+
+
+def test_logs_round_trip_by_month(tmp_path):
+    write_records(tmp_path / 'log_data' / '2018' / '11' / '2018-11-01-events.json',
+                  [event_record(), event_record(userId='', page='Home'), event_record(ts=1541105900000)])
+    path = write_records(tmp_path / 'log_data' / '2018' / '12' / '2018-12-01-events.json', [event_record()])
+    with open(path, 'a') as f:
+        f.write('{"not json\n')
+
+    tasks, totals = convert_tree(tmp_path, 'log_data', batch_rows=2)
+
+    assert sorted(os.path.relpath(os.path.dirname(task['path']), str(tmp_path / 'parquet' / 'log_data'))
+                  for task in tasks) == ['year=2018/month=11', 'year=2018/month=12']
+    assert (totals['rows'], totals['errors']) == (4, 1)
+    november, december = read_back(totals['paths'])
+    for table in (november, december):
+        assert_staging_types(table, 'log_data')
+    assert (november.num_rows, december.num_rows) == (3, 1)
+    assert pq.ParquetFile(sorted(totals['paths'])[0]).num_row_groups == 2
+    assert november.column('userId').to_pylist() == [7, None, 7]
+    assert str(november.column('ts')[0]) == '2018-11-01 20:57:10.796000'
@@ -0,0 +1,78 @@
+import re
+import gzip
+import json
+import threading
+import prestage
+from prestage import compact, list_source_sizes, chunk_count
+from conftest import make_config, song_record, event_record, write_records
+
+
+def chunk_records(paths):
+    records = []
+    for path in paths:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            records.extend(json.loads(line) for line in f)
+    return records
+
+
+def test_local_files_compacted_into_a_multiple_of_the_slices(tmp_path):
+    for i in range(10):
+        write_records(tmp_path / 'song_data' / str(i % 3) / 'song{}.json'.format(i),
+                      [song_record(song_id='S{}'.format(i))])
+    objects = list(list_source_sizes(str(tmp_path / 'song_data')))
+    target = sum(size for _, size in objects) // 5
+    paths = compact(objects, str(tmp_path / 'chunks'), 2, 'song_data', target_bytes=target, workers=3)
+
+    assert len(paths) == chunk_count(sum(size for _, size in objects), 2, target) == 6
+    assert sorted(record['song_id'] for record in chunk_records(paths)) == sorted('S{}'.format(i) for i in range(10))
+
+
+def test_s3_objects_fetched_concurrently(aws, tmp_path, monkeypatch):
+    s3 = aws['s3']
+    s3.create_bucket(Bucket='songs', CreateBucketConfiguration={'LocationConstraint': 'us-west-2'})
+    objects = []
+    for i in range(6):
+        body = json.dumps(song_record(song_id='S{}'.format(i)))
+        s3.put_object(Bucket='songs', Key='song_data/song{}.json'.format(i), Body=body)
+        objects.append(('s3://songs/song_data/song{}.json'.format(i), len(body)))
+    read = prestage.read_records
+    # the first three downloads only finish once all three are in flight
+    barrier = threading.Barrier(3, timeout=5)
+
+    def read_records(key, s3=None):
+        if key in [key for key, _ in objects[:3]]:
+            barrier.wait()
+        return read(key, s3)
+
+    monkeypatch.setattr(prestage, 'read_records', read_records)
+    records = prestage.fetch_records([key for key, _ in objects], s3, workers=3)
+    assert list(records) == [[song_record(song_id='S{}'.format(i))] for i in range(6)]
+
+    monkeypatch.setattr(prestage, 'read_records', read)
+    paths = compact(objects, str(tmp_path / 'chunks'), 2, 'song_data', s3, workers=3)
+    assert sorted(record['song_id'] for record in chunk_records(paths)) == ['S{}'.format(i) for i in range(6)]
+
+
+def test_large_s3_files_listed_as_they_are(aws, tmp_path):
+    s3 = aws['s3']
+    s3.create_bucket(Bucket='sparkify', CreateBucketConfiguration={'LocationConstraint': 'us-west-2'})
+    for i in range(3):
+        s3.put_object(Bucket='sparkify', Key='log_data/2018/11/day{}.json'.format(i),
+                      Body=json.dumps(event_record(ts=1541105830796 + i)))
+    large = '\n'.join(json.dumps(event_record(ts=1541105900000 + i)) for i in range(50))
+    s3.put_object(Bucket='sparkify', Key='log_data/2018/11/large.json', Body=large)
+    s3.put_object(Bucket='sparkify', Key='song_data/A/song.json', Body=json.dumps(song_record()))
+    config = make_config(AWS={'key': 'testing', 'secret': 'testing'}, IAM_ROLE={'arn': 'arn:aws:iam::123:role/copy'},
+                         S3={'log_data': "'s3://sparkify/log_data'", 'song_data': "'s3://sparkify/song_data'",
+                             'log_jsonpath': "'auto'", 'manifest_prefix': 's3://sparkify/manifests'})
+
+    queries = prestage.prestage(config, str(tmp_path / 'prestage'), slices=2, target_bytes=len(large))
+
+    events_chunks, events_large, songs_chunks = queries
+    assert 'GZIP' in events_chunks and 'GZIP' in songs_chunks and 'GZIP' not in events_large
+    assert 'MAXERROR 0' in events_large
+    manifest = re.search(r"FROM '(s3://[^']+)'", events_large).group(1)
+    body = s3.get_object(Bucket='sparkify', Key=manifest[len('s3://sparkify/'):])['Body'].read()
+    assert [entry['url'] for entry in json.loads(body)['entries']] == ['s3://sparkify/log_data/2018/11/large.json']
+    chunks = [path for path in (tmp_path / 'prestage' / 'log_data').iterdir()]
+    assert len(chunk_records(chunks)) == 3
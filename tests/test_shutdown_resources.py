@@ -0,0 +1,96 @@
+import shutil
+import pytest
+from create_resources import provision, get_config, describe_cluster
+from shutdown_resources import shutdown, snapshot_name
+from conftest import ROOT, NO_WAIT
+
+
+@pytest.fixture
+def config_file(tmp_path):
+    """a copy of dwh.cfg the snapshot identifier can be written to"""
+    path = str(tmp_path / 'dwh.cfg')
+    shutil.copy(ROOT + '/dwh.cfg', path)
+    config = get_config(path)
+    config.set('WLM', 'parameter_group', '')
+    with open(path, 'w') as f:
+        config.write(f)
+    return path
+
+
+def start(aws, config_file):
+    config = get_config(config_file)
+    messages = []
+    cluster_props, _, _ = provision(config, aws['iam'], aws['redshift'], aws['ec2'], messages.append, **NO_WAIT)
+    return config, cluster_props, messages
+
+
+def stop(aws, config, mode, config_file):
+    return shutdown(config, aws['iam'], aws['redshift'], aws['ec2'], mode, progress=lambda message: None,
+                    config_file=config_file, **NO_WAIT)
+
+
+def role_names(aws):
+    return [role['RoleName'] for role in aws['iam'].list_roles()['Roles']]
+
+
+def test_pause_keeps_cluster_and_role(aws, config_file):
+    config, _, _ = start(aws, config_file)
+    assert stop(aws, config, 'pause', config_file) is None
+
+    assert describe_cluster(aws['redshift'], config)['ClusterStatus'] == 'paused'
+    assert config['REDSHIFT']['ROLE_NAME'] in role_names(aws)
+    _, cluster_props, messages = start(aws, config_file)
+    assert any(message.startswith('Resuming paused Redshift cluster') for message in messages)
+    assert cluster_props['ClusterStatus'] == 'available'
+
+
+def test_snapshot_records_identifier_and_next_run_restores(aws, config_file):
+    config, _, _ = start(aws, config_file)
+    snapshot = stop(aws, config, 'snapshot', config_file)
+
+    assert snapshot.startswith(config['REDSHIFT']['CLUSTER_IDENTIFIER'] + '-')
+    assert describe_cluster(aws['redshift'], config) is None
+    assert config['REDSHIFT']['ROLE_NAME'] not in role_names(aws)
+    assert get_config(config_file).get('REDSHIFT', 'SNAPSHOT_IDENTIFIER') == snapshot
+    snapshots = aws['redshift'].describe_cluster_snapshots(SnapshotIdentifier=snapshot)['Snapshots']
+    assert [s['Status'] for s in snapshots] == ['available']
+
+    _, cluster_props, messages = start(aws, config_file)
+    assert 'Restoring Redshift cluster {} from snapshot {}'.format(
+        config['REDSHIFT']['CLUSTER_IDENTIFIER'], snapshot) in messages
+    assert cluster_props['ClusterStatus'] == 'available'
+
+
+def test_delete_after_snapshot_creates_a_fresh_cluster(aws, config_file):
+    config, _, _ = start(aws, config_file)
+    snapshot = stop(aws, config, 'snapshot', config_file)
+    config, _, _ = start(aws, config_file)
+    assert stop(aws, config, 'delete', config_file) is None
+
+    assert get_config(config_file).get('REDSHIFT', 'SNAPSHOT_IDENTIFIER') == ''
+    _, cluster_props, messages = start(aws, config_file)
+    assert not any(snapshot in message for message in messages)
+    assert any(message.startswith('Creating a Redshift Cluster') for message in messages)
+    assert cluster_props['ClusterStatus'] == 'available'
+
+
+def test_delete_removes_everything(aws, config_file):
+    config, _, _ = start(aws, config_file)
+    assert stop(aws, config, 'delete', config_file) is None
+
+    assert describe_cluster(aws['redshift'], config) is None
+    assert config['REDSHIFT']['ROLE_NAME'] not in role_names(aws)
+    assert aws['redshift'].describe_cluster_snapshots()['Snapshots'] == []
+    _, _, messages = start(aws, config_file)
+    assert any(message.startswith('Creating a Redshift Cluster') for message in messages)
+
+
+def test_unknown_mode_is_rejected(aws, config_file):
+    with pytest.raises(ValueError):
+        stop(aws, get_config(config_file), 'hibernate', config_file)
+
+
+def test_snapshot_name():
+    import datetime
+    config = get_config(ROOT + '/dwh.cfg')
+    assert snapshot_name(config, datetime.datetime(2018, 11, 30, 22, 15)) == 'sparkify-dwh-20181130-221500'
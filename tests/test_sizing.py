@@ -0,0 +1,66 @@
+import json
+import etl
+import summaries
+from sizing import open_load_window, close_load_window
+from prestage import cluster_slices
+from conftest import ROOT, make_config, FakeConnection, song_record, event_record, write_records, NO_WAIT
+
+
+def sizing_config(tmp_path):
+    """two small sources and a history measuring 1 byte per slice second, so the largest size is the fastest"""
+    write_records(tmp_path / 'log_data' / 'events.json', [event_record()])
+    write_records(tmp_path / 'song_data' / 'song.json', [song_record()])
+    history = tmp_path / 'sizing.jsonl'
+    history.write_text(json.dumps({'node_type': 'dc2.large', 'bytes_per_slice_second': 1}) + '\n')
+    return make_config(S3={'log_data': str(tmp_path / 'log_data'), 'song_data': str(tmp_path / 'song_data')},
+                       ETL={'sizing': 'true', 'sizing_history': str(history)})
+
+
+def expect_cluster(redshift, node_type, nodes, status='available'):
+    redshift.stubber.add_response('describe_clusters', {'Clusters': [
+        {'ClusterIdentifier': 'sparkify-dwh', 'NodeType': node_type, 'NumberOfNodes': nodes,
+         'ClusterStatus': status}]}, {'ClusterIdentifier': 'sparkify-dwh'})
+
+
+def expect_resize(redshift, node_type, nodes):
+    redshift.stubber.add_response('resize_cluster', {'Cluster': {}}, {
+        'ClusterIdentifier': 'sparkify-dwh', 'ClusterType': 'multi-node', 'NodeType': node_type,
+        'NumberOfNodes': nodes, 'Classic': False})
+
+
+def test_window_resizes_up_and_back_down(redshift, tmp_path):
+    config = sizing_config(tmp_path)
+    expect_cluster(redshift, 'dc2.large', 2)
+    expect_cluster(redshift, 'dc2.large', 2)
+    expect_resize(redshift, 'dc2.large', 4)
+    expect_cluster(redshift, 'dc2.large', 4)
+    plan = open_load_window(config, redshift, progress=lambda message: None, **NO_WAIT)
+    assert (plan['node_type'], plan['nodes'], plan['baseline'], plan['files']) == ('dc2.large', 4, ['dc2.large', 2], 2)
+    assert cluster_slices(config, plan) == 8
+    assert cluster_slices(config) == 2 * config.getint('REDSHIFT', 'NUM_NODES')
+
+    expect_cluster(redshift, 'dc2.large', 4)
+    expect_resize(redshift, 'dc2.large', 2)
+    expect_cluster(redshift, 'dc2.large', 2)
+    run = close_load_window(config, plan, redshift, progress=lambda message: None, **NO_WAIT)
+    assert (run['node_type'], run['nodes'], run['bytes']) == ('dc2.large', 4, plan['bytes'])
+    with open(config.get('ETL', 'SIZING_HISTORY')) as f:
+        assert json.loads(f.readlines()[-1]) == run
+
+
+def test_window_closes_after_the_inserts(monkeypatch):
+    run = etl.Run(ROOT + '/dwh.cfg')
+    run.config.set('ETL', 'MAX_WORKERS', '1')
+    run.config.set('ETL', 'MAINTENANCE', 'true')
+    run.window = {'node_type': 'dc2.large', 'nodes': 4}
+    events = []
+    monkeypatch.setattr(run, 'connection', lambda workload='etl': (FakeConnection().cursor(), FakeConnection()))
+    monkeypatch.setattr(etl, 'insert_tables', lambda cur, conn, wlm: events.append('insert'))
+    monkeypatch.setattr(etl, 'close_window', lambda run, plan: events.append(('close', plan['nodes'])))
+    monkeypatch.setattr(summaries, 'refresh_summaries', lambda cur, conn, full=False: events.append('summaries'))
+    import maintenance
+    monkeypatch.setattr(maintenance, 'run_maintenance', lambda conn, **options: events.append('maintenance'))
+    etl.transform(run)
+
+    assert events == ['insert', ('close', 4), 'summaries', 'maintenance']
+    assert run.window is None
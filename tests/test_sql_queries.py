@@ -0,0 +1,80 @@
+import re
+import pytest
+import sql_queries
+import create_tables
+import song_matching
+import incremental
+from conftest import make_config, FakeConnection, song_record, event_record, write_records
+
+
+def executed(cur):
+    return [query for query, _ in cur.statements]
+
+
+def test_configure_after_import_rerenders_create_tables():
+    conn = FakeConnection()
+    sql_queries.configure(make_config(ETL={'schema_profile': 'default'}))
+    create_tables.create_tables(conn.cursor(), conn)
+    assert sql_queries.staging_events_table_create in executed(conn.cursor())
+
+    conn = FakeConnection()
+    sql_queries.configure(make_config(ETL={'schema_profile': 'keyed'}))
+    create_tables.create_tables(conn.cursor(), conn)
+    assert sql_queries.staging_events_table_create_keyed in executed(conn.cursor())
+    assert sql_queries.staging_events_table_create not in executed(conn.cursor())
+
+
+def test_configure_after_import_rerenders_song_keys_and_merges():
+    sql_queries.configure(make_config(ETL={'song_match_duration': 'true', 'time_profile': 'hourly'}))
+    conn = FakeConnection()
+    song_matching.compute_song_keys(conn.cursor(), conn)
+    assert any('duration' in query for query in executed(conn.cursor()))
+
+    conn = FakeConnection()
+    incremental.merge_tables(conn.cursor(), conn)
+    assert sql_queries.time_hour_table_merge in executed(conn.cursor())
+
+
+def test_renders_without_config_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sql_queries.configure(None)
+    assert sql_queries.TIME_PROFILE == 'event'
+    assert "'auto'" in sql_queries.staging_events_copy
+    assert sql_queries.create_table_queries
+
+
+def test_local_etl_runs_outside_repo(tmp_path, monkeypatch):
+    import local_etl
+    monkeypatch.chdir(tmp_path)
+    sql_queries.configure(None)
+    write_records(tmp_path / 'song_data' / 'song.json', [song_record()])
+    write_records(tmp_path / 'log_data' / 'events.json', [event_record()])
+    tables = local_etl.transform(local_etl.read_staging_events(str(tmp_path / 'log_data')),
+                                 local_etl.read_staging_songs(str(tmp_path / 'song_data')))
+    assert len(tables['songplays']) == 1
+    assert tables['songplays']['song_id'].iloc[0] == 'S1'
+
+
+def distkey(table):
+    ddl = next(query for query in sql_queries.create_table_queries
+               if re.search(r'CREATE TABLE IF NOT EXISTS\s+{}\('.format(table), query))
+    match = re.search(r'DISTKEY\((\w+)\)', ddl)
+    return match.group(1) if match else None
+
+
+@pytest.mark.parametrize('query', ['songplay_insert', 'songplay_merge'])
+def test_keyed_songplays_join_tables_share_the_join_distkey(query):
+    sql_queries.configure(make_config(ETL={'schema_profile': 'keyed'}))
+    join = re.search(r'FROM (\w+) events\s+JOIN (\w+) songs\s+ON events\.(\w+) = songs\.(\w+)',
+                     getattr(sql_queries, query))
+    events, songs, events_column, songs_column = join.groups()
+    assert distkey(events) == events_column == distkey(songs) == songs_column == 'song_key'
+
+
+def test_time_insert_and_merge_derive_the_same_columns():
+    def derived(query):
+        return re.sub(r'\w+\.start_time', 'start_time', ' '.join(re.findall(r'EXTRACT\(\w+ FROM [\w.]+\)', query)))
+
+    assert derived(sql_queries.time_table_merge) == derived(sql_queries.time_table_insert)
+    sql_queries.configure(make_config(ETL={'dialect': 'postgres'}))
+    assert derived(sql_queries.time_table_merge) == derived(sql_queries.time_table_insert)
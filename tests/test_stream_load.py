@@ -0,0 +1,59 @@
+import os
+import pytest
+import etl
+from conftest import make_config, FakeConnection, song_record, event_record, write_records
+
+
+def stream_config(tmp_path, dialect='postgres', schema_profile='default'):
+    """a dwh.cfg streaming local sources, written to tmp_path"""
+    write_records(tmp_path / 'log_data' / '2018' / '11' / 'events.json',
+                  [event_record(), event_record(ts=1541105900000, userId='8', song='Other')])
+    write_records(tmp_path / 'song_data' / 'A' / 'song.json', [song_record()])
+    config = make_config(S3={'log_data': str(tmp_path / 'log_data'), 'song_data': str(tmp_path / 'song_data'),
+                             'log_jsonpath': "'auto'"},
+                         ETL={'stream_load': 'true', 'dialect': dialect, 'schema_profile': schema_profile,
+                              'max_workers': 1, 'metrics_file': ''})
+    path = str(tmp_path / 'dwh.cfg')
+    with open(path, 'w') as f:
+        config.write(f)
+    return path
+
+
+def test_stream_load_refused_on_redshift(tmp_path):
+    run = etl.Run(stream_config(tmp_path, dialect='redshift'))
+    run.connection = lambda workload='etl': (FakeConnection().cursor(), FakeConnection())
+    with pytest.raises(ValueError):
+        etl.load(run)
+
+
+def test_postgres_sessions_skip_query_group(tmp_path, monkeypatch):
+    pytest.importorskip('psycopg2')
+    import db
+    opened = []
+    monkeypatch.setattr(db.psycopg2, 'connect', lambda **settings: opened.append(FakeConnection()) or opened[-1])
+    run = etl.Run(stream_config(tmp_path))
+    try:
+        run.connection()
+    finally:
+        run.close()
+        db.close_pools()
+    assert opened[0].cursor().statements == []
+
+
+@pytest.mark.parametrize('schema_profile', ['default', 'keyed'])
+def test_streamed_pipeline_on_postgres(pg_conn, tmp_path, monkeypatch, schema_profile):
+    import db
+    connect = db.psycopg2.connect
+    monkeypatch.setattr(db.psycopg2, 'connect', lambda **settings: connect(os.environ['SPARKIFY_TEST_DSN']))
+    try:
+        etl.run_phases(['create', 'load', 'transform'], stream_config(tmp_path, schema_profile=schema_profile))
+    finally:
+        db.close_pools()
+
+    cur = pg_conn.cursor()
+    counts = {}
+    for table in ['staging_events', 'staging_songs', 'songplays', 'users', 'songs', 'artists', 'time']:
+        cur.execute('SELECT COUNT(*) FROM {};'.format(table))
+        counts[table] = cur.fetchone()[0]
+    assert counts == {'staging_events': 2, 'staging_songs': 1, 'songplays': 1, 'users': 2, 'songs': 1,
+                      'artists': 1, 'time': 1}
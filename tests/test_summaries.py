@@ -0,0 +1,41 @@
+import pytest
+import sql_queries
+from summaries import refresh_summaries
+from create_tables import create_tables
+from conftest import make_config, FakeCursor, FakeConnection
+
+
+def test_full_refresh_deletes_inside_the_transaction():
+    conn = FakeConnection()
+    refresh_summaries(conn.cursor(), conn, full=True)
+    statements = [query for query, _ in conn.cursor().statements]
+    assert not any('TRUNCATE' in query for query in statements)
+    assert statements[:4] == sql_queries.summary_delete_queries
+    assert conn.commits == 1
+
+
+def test_failed_refresh_rolls_back_the_rebuild():
+    conn = FakeConnection(FakeCursor(fail_on='UPDATE artist_play_counts'))
+    with pytest.raises(RuntimeError):
+        refresh_summaries(conn.cursor(), conn, full=True)
+    assert (conn.commits, conn.rollbacks) == (0, 1)
+
+
+def test_refresh_follows_loaded_at_not_songplay_id(pg_conn):
+    sql_queries.configure(make_config(ETL={'dialect': 'postgres'}))
+    cur = pg_conn.cursor()
+    create_tables(cur, pg_conn)
+    insert = ("INSERT INTO songplays (songplay_id, start_time, user_id, song_id, artist_id, loaded_at) "
+              "VALUES (%s, '2018-11-01 10:00', '7', %s, 'A1', %s);")
+    cur.executemany(insert, [(100, 'S1', '2018-12-01 00:00'), (101, 'S2', '2018-12-01 00:00')])
+    pg_conn.commit()
+    refresh_summaries(cur, pg_conn)
+    # IDENTITY values of a later load can be lower than those of an earlier one
+    cur.executemany(insert, [(5, 'S1', '2018-12-02 00:00'), (6, 'S1', '2018-12-02 00:00')])
+    pg_conn.commit()
+    refresh_summaries(cur, pg_conn)
+
+    cur.execute("SELECT song_id, play_count FROM song_play_counts ORDER BY 1;")
+    assert cur.fetchall() == [('S1', 3), ('S2', 1)]
+    cur.execute("SELECT play_count FROM artist_play_counts;")
+    assert cur.fetchone()[0] == 4
@@ -0,0 +1,62 @@
+import pandas as pd
+import sql_queries
+import local_etl
+from create_tables import create_tables
+from upsert import dedupe_query, upsert_query
+from sql_queries import song_upsert, artist_upsert
+from conftest import make_config
+
+# staged song records of one artist: two songs of the same year and one without a year
+SONGS = [(1, 'S1', 'First', 'A1', 'Artist', 'Here', 2005, 200.0),
+         (1, 'S2', 'Second', 'A1', 'Artist', 'There', 2005, 180.0),
+         (1, 'S0', 'Early', 'A1', 'Artist', 'Nowhere', None, 150.0),
+         (1, 'S2', 'Second (remaster)', 'A1', 'Artist', 'There', 2005, 181.0)]
+SONG_COLUMNS = ['num_songs', 'song_id', 'title', 'artist_id', 'artist_name', 'artist_location', 'year', 'duration']
+
+
+def test_dedupe_orders_by_every_tie_breaker():
+    query = dedupe_query(artist_upsert)
+
+    assert 'PARTITION BY artist_id ORDER BY year DESC NULLS LAST, song_id DESC NULLS LAST' in query
+    assert 'ORDER BY year DESC NULLS LAST, artist_id DESC NULLS LAST, title DESC NULLS LAST, ' \
+           'duration DESC NULLS LAST' in dedupe_query(song_upsert)
+    # without order_by the natural key decides
+    spec = dict(artist_upsert, order_by=None)
+    assert 'PARTITION BY artist_id ORDER BY artist_id DESC NULLS LAST' in dedupe_query(spec)
+
+
+def test_rendered_upsert_statements():
+    statements = upsert_query(artist_upsert).splitlines()
+
+    assert statements[0] == 'DROP TABLE IF EXISTS artists_upsert_stage;'
+    assert 'DELETE FROM artists USING artists_upsert_stage WHERE artists.artist_id = artists_upsert_stage.artist_id;' \
+        in statements
+    assert statements[-1] == 'DROP TABLE artists_upsert_stage;'
+    assert 'MERGE INTO artists USING artists_upsert_stage' in upsert_query(artist_upsert, 'merge')
+
+
+def test_local_upsert_picks_the_same_winners():
+    songs = pd.DataFrame(SONGS, columns=SONG_COLUMNS).reindex(
+        columns=sql_queries.staging_songs_columns + ['song_key'])
+
+    for rows in (songs, songs.iloc[::-1]):
+        assert local_etl.upsert_frame(rows, artist_upsert)['location'].tolist() == ['There']
+        assert sorted(local_etl.upsert_frame(rows, song_upsert)['title']) == ['Early', 'First', 'Second (remaster)']
+
+
+def test_dedupe_on_postgres_is_deterministic(pg_conn):
+    sql_queries.configure(make_config(ETL={'dialect': 'postgres'}))
+    cur = pg_conn.cursor()
+    create_tables(cur, pg_conn)
+
+    for rows in (SONGS, SONGS[::-1]):
+        cur.execute('TRUNCATE staging_songs; TRUNCATE artists; TRUNCATE songs;')
+        cur.executemany('INSERT INTO staging_songs ({}) VALUES ({});'.format(
+            ', '.join(SONG_COLUMNS), ', '.join(['%s'] * len(SONG_COLUMNS))), rows)
+        cur.execute(sql_queries.artist_table_insert)
+        cur.execute(sql_queries.song_table_insert)
+        cur.execute('SELECT artist_id, location FROM artists;')
+        assert cur.fetchall() == [('A1', 'There')]
+        cur.execute('SELECT title FROM songs ORDER BY title;')
+        assert [title for title, in cur.fetchall()] == ['Early', 'First', 'Second (remaster)']
+    pg_conn.commit()
@@ -0,0 +1,109 @@
+import csv
+import pytest
+import sql_queries
+from instrumentation import recorder
+from sinks import ConsoleSink, CsvSink, ParquetSink, make_sink
+from conftest import FakeCursor, FakeConnection
+
+validation = pytest.importorskip('validation')
+
+COLUMNS = ['song_id', 'title', 'cnt']
+ROWS = [('S1', 'Song', 3), ('S2', 'Other', 2), ('S3', 'Tune', 1)]
+
+
+class NamedCursor(FakeCursor):
+    """a server side cursor iterating over its rows"""
+
+    def __init__(self, rows, columns):
+        super().__init__()
+        self.rows = rows
+        self.description = [(column, None) for column in columns]
+        self.itersize = None
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def close(self):
+        self.closed = True
+
+
+class ReportConnection(FakeConnection):
+    """hands out a NamedCursor for named cursors, the plain FakeCursor otherwise"""
+
+    def __init__(self, rows=ROWS, columns=COLUMNS):
+        super().__init__()
+        self.named = NamedCursor(rows, columns)
+        self.names = []
+
+    def cursor(self, name=None):
+        if name is None:
+            return self.cur
+        self.names.append(name)
+        return self.named
+
+
+def run_query(sink, conn=None, itersize=2000):
+    conn = conn or ReportConnection()
+    return conn, validation.execute_query(conn.cursor(), conn, 'SELECT 1;', sink, itersize, 'top_ten_songs')
+
+
+def test_rows_are_fetched_through_a_named_cursor():
+    conn, rows = run_query(ConsoleSink(), itersize=500)
+
+    assert rows == 3
+    assert conn.names[0].startswith('validation_')
+    assert (conn.named.statements, conn.named.itersize, conn.named.closed) == ([('SELECT 1;', None)], 500, True)
+    assert conn.commits == 1
+    assert (recorder.records[-1]['step'], recorder.records[-1]['rows']) == ('top_ten_songs', 3)
+
+
+def test_console_sink_prints_an_aligned_table(capsys):
+    run_query(ConsoleSink(width=8))
+
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[:3] == ['song_id  | title    | cnt     ', '---------+----------+---------',
+                         'S1       | Song     | 3       ']
+
+
+def test_empty_result_still_opens_the_sink(tmp_path):
+    path = str(tmp_path / 'empty.csv')
+    _, rows = run_query(CsvSink(path), ReportConnection(rows=[]))
+
+    assert rows == 0
+    with open(path) as f:
+        assert list(csv.reader(f)) == [COLUMNS]
+
+
+def test_csv_sink_writes_header_and_rows(tmp_path):
+    sink = make_sink('csv', 'top_ten_songs', str(tmp_path / 'results'))
+    _, rows = run_query(sink)
+
+    assert rows == 3
+    with open(str(tmp_path / 'results' / 'top_ten_songs.csv')) as f:
+        assert list(csv.reader(f)) == [COLUMNS] + [[str(value) for value in row] for row in ROWS]
+
+
+def test_parquet_sink_writes_row_groups_of_batch_size(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    path = str(tmp_path / 'top_ten_songs.parquet')
+    _, rows = run_query(ParquetSink(path, batch_size=2))
+
+    assert rows == 3
+    assert pq.ParquetFile(path).num_row_groups == 2
+    assert pq.read_table(path).to_pylist() == [dict(zip(COLUMNS, row)) for row in ROWS]
+
+
+def test_unload_renders_the_configured_prefix_and_role():
+    conn = FakeConnection()
+    validation.analyse_data(conn.cursor(), conn, sink='unload', unload_prefix='s3://bucket/reports/',
+                            role_arn='arn:aws:iam::123:role/unload')
+
+    statements = [query for query, _ in conn.cur.statements]
+    assert len(statements) == len(sql_queries.validation_queries) == conn.commits
+    for statement, name in zip(statements, ['top_ten_songs', 'top_ten_artists', 'listen_time']):
+        assert statement.strip().startswith("UNLOAD ('")
+        assert "TO 's3://bucket/reports/{}/'".format(name) in statement
+        assert "IAM_ROLE 'arn:aws:iam::123:role/unload'" in statement
+    # quotes inside the query are doubled for the UNLOAD literal
+    assert "''23-24, 0-2''" in statements[2]
@@ -0,0 +1,110 @@
+import json
+import pytest
+from wlm import wlm_options, wlm_parameters, step_slots, run_with_slots
+from conftest import ROOT, make_config, FakeCursor, FakeConnection, NO_WAIT
+
+
+@pytest.fixture
+def config():
+    """dwh.cfg with the WLM parameter group enabled"""
+    return make_config(WLM={'parameter_group': 'sparkify-wlm'})
+
+
+def queues(value):
+    return {tuple(queue.get('query_group', [])): queue for queue in json.loads(value)}
+
+
+def test_auto_wlm_json(config):
+    etl, bi, default, sqa = json.loads(wlm_parameters(wlm_options(config))[0]['ParameterValue'])
+    assert (etl['query_group'], etl['priority'], etl['queue_type']) == (['etl'], 'high', 'auto')
+    assert (bi['query_group'], bi['priority'], bi['concurrency_scaling']) == (['bi'], 'normal', 'off')
+    assert default == {'auto_wlm': True, 'queue_type': 'auto', 'priority': 'normal'}
+    assert sqa == {'short_query_queue': True}
+
+
+def test_manual_wlm_json():
+    config = make_config(WLM={'wlm_mode': 'manual', 'concurrency_scaling': 'true',
+                              'short_query_acceleration': 'false'})
+    by_group = queues(wlm_parameters(wlm_options(config))[0]['ParameterValue'])
+    assert by_group[('etl',)]['query_concurrency'] == 4
+    assert by_group[('etl',)]['memory_percent_to_use'] == 60
+    assert by_group[('bi',)]['concurrency_scaling'] == 'auto'
+    assert by_group[()] == {'query_concurrency': 5, 'memory_percent_to_use': 10}
+
+
+def test_manual_wlm_rejects_memory_overcommit():
+    with pytest.raises(ValueError):
+        wlm_parameters(wlm_options(make_config(WLM={'wlm_mode': 'manual', 'etl_memory_percent': 70})))
+
+
+def test_heavy_steps_claim_slots_under_manual_wlm_only(config):
+    manual = wlm_options(make_config(WLM={'wlm_mode': 'manual'}))
+    assert step_slots('songplay_table_insert', manual) == 3
+    assert step_slots('user_table_merge', manual) == 1
+    assert step_slots('songplay_table_insert', wlm_options(config)) == 1
+
+    cur = FakeCursor()
+    run_with_slots(cur, 3, lambda: cur.execute('INSERT INTO songplays ...'))
+    assert [query for query, _ in cur.statements] == ['SET wlm_query_slot_count TO 3;', 'INSERT INTO songplays ...',
+                                                      'SET wlm_query_slot_count TO 1;']
+
+
+def test_parameter_group_created_with_wlm_json(redshift, config):
+    from create_resources import ensure_parameter_group
+    parameters = wlm_parameters(wlm_options(config))
+    redshift.stubber.add_client_error('describe_cluster_parameter_groups', 'ClusterParameterGroupNotFound',
+                                      expected_params={'ParameterGroupName': 'sparkify-wlm'})
+    redshift.stubber.add_response('create_cluster_parameter_group', {'ClusterParameterGroup': {}},
+                                  {'ParameterGroupName': 'sparkify-wlm', 'ParameterGroupFamily': 'redshift-1.0',
+                                   'Description': 'Sparkify ETL and BI workload management'})
+    redshift.stubber.add_response('describe_cluster_parameters', {'Parameters': []},
+                                  {'ParameterGroupName': 'sparkify-wlm', 'Source': 'user'})
+    redshift.stubber.add_response('modify_cluster_parameter_group', {},
+                                  {'ParameterGroupName': 'sparkify-wlm', 'Parameters': parameters})
+    assert ensure_parameter_group(redshift, config, progress=lambda message: None) == 'sparkify-wlm'
+
+
+def test_parameter_group_left_alone_when_in_sync(redshift, config):
+    from create_resources import ensure_parameter_group
+    parameters = wlm_parameters(wlm_options(config))
+    redshift.stubber.add_response('describe_cluster_parameter_groups', {'ParameterGroups': []},
+                                  {'ParameterGroupName': 'sparkify-wlm'})
+    redshift.stubber.add_response('describe_cluster_parameters', {'Parameters': parameters},
+                                  {'ParameterGroupName': 'sparkify-wlm', 'Source': 'user'})
+    assert ensure_parameter_group(redshift, config, progress=lambda message: None) == 'sparkify-wlm'
+
+
+def test_empty_parameter_group_keeps_the_default(redshift):
+    from create_resources import ensure_parameter_group
+    assert ensure_parameter_group(redshift, make_config(WLM={'parameter_group': ''})) is None
+
+
+def test_provision_creates_cluster_in_parameter_group(aws, config):
+    from create_resources import provision
+    cluster_props, _, _ = provision(config, aws['iam'], aws['redshift'], aws['ec2'], lambda message: None, **NO_WAIT)
+
+    assert [group['ParameterGroupName'] for group in cluster_props['ClusterParameterGroups']] == ['sparkify-wlm']
+    assert ('modify_cluster_parameter_group', 'sparkify-wlm', wlm_parameters(wlm_options(config))) in \
+        aws['redshift'].calls
+
+
+def test_pooled_sessions_tagged_with_query_group(monkeypatch):
+    pytest.importorskip('psycopg2')
+    import db
+    import etl
+    opened = []
+
+    def connect(**settings):
+        opened.append(FakeConnection())
+        return opened[-1]
+
+    monkeypatch.setattr(db.psycopg2, 'connect', connect)
+    run = etl.Run(ROOT + '/dwh.cfg')
+    try:
+        run.connection('etl')
+        run.connection('bi')
+    finally:
+        run.close()
+        db.close_pools()
+    assert [conn.cursor().statements for conn in opened] == [[("SET query_group TO %s;", ('etl',))],
+                                                             [("SET query_group TO %s;", ('bi',))]]
@@ -0,0 +1,59 @@
+def dedupe_query(spec):
+    """renders a SELECT that keeps one row per natural key, the latest by spec['order_by']
+    Args:
+        spec (dict): upsert declaration with keys
+            target: target table
+            source: staging table
+            key: target column(s) forming the natural key
+            columns: list of (target column, source expression)
+            order_by: source expression, or list of expressions breaking ties in turn,
+                deciding which record wins, latest first; NULLs lose
+            where: optional filter on the source
+    """
+    expressions = dict(spec['columns'])
+    keys = spec['key'] if isinstance(spec['key'], (list, tuple)) else [spec['key']]
+    partition = ', '.join(expressions[key] for key in keys)
+    order_by = spec.get('order_by') or [expressions[key] for key in keys]
+    if isinstance(order_by, str):
+        order_by = [order_by]
+    order_by = ', '.join('{} DESC NULLS LAST'.format(expression) for expression in order_by)
+    select = ',\n               '.join('{} AS {}'.format(source, target) for target, source in spec['columns'])
+    where = '\n        WHERE {}'.format(spec['where']) if spec.get('where') else ''
+    return ("""SELECT {columns}
+FROM (SELECT {select},
+               ROW_NUMBER() OVER (PARTITION BY {partition} ORDER BY {order_by}) AS row_num
+        FROM {source}{where}) ranked
+WHERE row_num = 1""").format(columns=', '.join(target for target, _ in spec['columns']),
+                             select=select, partition=partition, order_by=order_by,
+                             source=spec['source'], where=where)
+
+
+def upsert_query(spec, mode='delete_insert'):
+    """renders the statements that upsert a staging table into a dimension
+    Rows are deduplicated on the natural key only, then either replace the
+    matching target rows (delete_insert) or are applied with MERGE (merge).
+    The statements are returned as one string so they run on one session.
+    Args:
+        spec (dict): upsert declaration, see dedupe_query
+        mode (string): 'delete_insert' or 'merge'
+    """
+    target = spec['target']
+    stage = '{}_upsert_stage'.format(target)
+    keys = spec['key'] if isinstance(spec['key'], (list, tuple)) else [spec['key']]
+    columns = [column for column, _ in spec['columns']]
+    match = ' AND '.join('{0}.{1} = {2}.{1}'.format(target, key, stage) for key in keys)
+
+    statements = ["DROP TABLE IF EXISTS {};".format(stage),
+                  "CREATE TEMP TABLE {} AS\n{};".format(stage, dedupe_query(spec))]
+    if mode == 'merge':
+        updates = ', '.join('{0} = {1}.{0}'.format(column, stage) for column in columns if column not in keys)
+        statements.append(("MERGE INTO {target} USING {stage} ON {match}\n"
+                           "WHEN MATCHED THEN UPDATE SET {updates}\n"
+                           "WHEN NOT MATCHED THEN INSERT ({columns}) VALUES ({values});").format(
+            target=target, stage=stage, match=match, updates=updates, columns=', '.join(columns),
+            values=', '.join('{}.{}'.format(stage, column) for column in columns)))
+    else:
+        statements.append("DELETE FROM {} USING {} WHERE {};".format(target, stage, match))
+        statements.append("INSERT INTO {0} ({1}) SELECT {1} FROM {2};".format(target, ', '.join(columns), stage))
+    statements.append("DROP TABLE {};".format(stage))
+    return '\n'.join(statements)
@@ -1,35 +1,169 @@
-from sql_queries import validation_queries
+import time
+import itertools
+import configparser
+import sql_queries
+from sql_queries import unload_query_template
+from db import get_pool
+from sinks import ConsoleSink, ListSink, make_sink
+from wlm import wlm_options
+from instrumentation import run_statement, recorder, configure_from, describe, last_query_id_query
 
-def execute_query(cur, conn, query):
-    """Execute SQL query on Redshift
+_cursor_ids = itertools.count()
+
+
+def execute_query(cur, conn, query, sink=None, itersize=2000, step=None):
+    """Execute SQL query on Redshift and stream the result into a sink
+    Rows are fetched through a server side (named) cursor itersize rows at a
+    time, so client memory stays constant whatever the size of the result.
     Args:
         cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
         conn (connection object): Connection to SQL Engine
         query (string): SQL Query
+        sink: object with open(columns)/write(row)/close(), defaults to printing a table
+        itersize (int): rows fetched per round trip
+        step (string): name the query is recorded under
+    Return(s):
+        whatever sink.close() returns
     """
+    sink = sink or ConsoleSink()
     try:
-        cur.execute(query)
-        rows = cur.fetchall()
-        for row in rows:
-            print(row)
+        started = time.time()
+        named = conn.cursor(name='validation_{}'.format(next(_cursor_ids)))
+        named.itersize = itersize
+        named.execute(query)
+        rows = iter(named)
+        first = next(rows, None)
+        sink.open([column[0] for column in named.description or []])
+        count = 0
+        if first is not None:
+            sink.write(first)
+            count = 1
+            for row in rows:
+                sink.write(row)
+                count += 1
+        named.close()
+        elapsed = time.time() - started
+        extra = {}
+        if recorder.capture_query_ids:
+            cur = conn.cursor()
+            cur.execute(last_query_id_query)
+            extra['query_id'] = cur.fetchone()[0]
         conn.commit()
+        recorder.record('validation', step or describe(query), elapsed, count, **extra)
+        print("{} rows in {:.2f}s ({:.0f} rows/sec)\n".format(count, elapsed, count / elapsed if elapsed else 0))
+        return sink.close()
     except Exception as e:
+        conn.rollback()
+        recorder.record('validation', step or describe(query), time.time() - started, status='failed', error=e)
         print(e)  
 
-def analyse_data(cur,conn):
+
+def unload_query(cur, conn, query, location, role_arn):
+    """UNLOADs a query result to S3 as Parquet instead of pulling it through the client
+    Args:
+        location (string): S3 prefix the files are written to
+        role_arn (string): IAM role allowed to write to location
+    """
+    try:
+        run_statement(cur, unload_query_template.format(query.strip().rstrip(';').replace("'", "''"), location, role_arn),
+                      'validation')
+        conn.commit()
+        print("unloaded to {}\n".format(location))
+    except Exception as e:
+        conn.rollback()
+        print(e)
+
+
+def report_name(query, index):
+    """returns the report name of a validation query, used to name output files"""
+    for name, (raw, summary) in sql_queries.report_queries.items():
+        if query in (raw, summary):
+            return name
+    return 'query_{}'.format(index)
+
+
+def route_query(query, source):
+    """returns the query that answers a validation query for the given source
+    Args:
+        query (string): raw validation query
+        source (string): 'raw' or 'summary'; queries without a summary always run raw
+    """
+    if source == 'raw':
+        return query
+    for raw, summary in sql_queries.report_queries.values():
+        if raw == query:
+            return summary
+    return query
+
+
+def compare_results(cur, conn, query):
+    """runs a report against the raw tables and the summaries and reports differences"""
+    summary = route_query(query, 'summary')
+    if summary == query:
+        return execute_query(cur, conn, query, ListSink())
+    print("raw:")
+    raw_rows = execute_query(cur, conn, query, ListSink()) or []
+    print("summary:")
+    summary_rows = execute_query(cur, conn, summary, ListSink()) or []
+    if sorted(map(tuple, raw_rows)) == sorted(map(tuple, summary_rows)):
+        print("summary matches raw\n")
+    elif [row[-1] for row in raw_rows] == [row[-1] for row in summary_rows]:
+        # LIMIT 10 can pick different rows among equal counts
+        print("summary counts match raw, tied rows differ\n")
+    else:
+        print("MISMATCH between summary and raw results\n")
+    return summary_rows
+
+def validation_options(config):
+    """returns the analyse_data keyword arguments configured in the [ETL] section of dwh.cfg"""
+    return {'source': config.get('ETL', 'REPORT_SOURCE', fallback='raw'),
+            'sink': config.get('ETL', 'REPORT_SINK', fallback='console'),
+            'itersize': config.getint('ETL', 'REPORT_ITERSIZE', fallback=2000),
+            'output_dir': config.get('ETL', 'REPORT_OUTPUT_DIR', fallback='results'),
+            'unload_prefix': config.get('ETL', 'REPORT_UNLOAD_PREFIX', fallback=''),
+            'role_arn': config.get('IAM_ROLE', 'ARN', fallback='')}
+
+
+def analyse_data(cur,conn, source='raw', sink='console', itersize=2000, output_dir='results',
+                 unload_prefix='', role_arn=''):
     """Execute validation SQL query on Redshift and prints results on screen
     Args:
         cur (cursor object): Cursor Object used to retrieve rows from SQL Engine
         conn (connection object): Connection to SQL Engine
-        query (string): SQL Query
+        source (string): 'raw' scans the fact table, 'summary' answers reports from
+            the summary tables, 'compare' runs both and reports differences
+        sink (string): console, csv, parquet or unload (UNLOAD to unload_prefix on S3)
+        itersize (int): rows fetched per round trip from the server side cursor
+        output_dir (string): directory csv/parquet results are written to
     """
     try:
         print("Executing validation of data loaded\n")
-        for query in validation_queries:
+        for index, query in enumerate(sql_queries.validation_queries):
             print("validation query:\n")
-            print(query)
+            if source == 'compare':
+                print(query)
+                print("\n")
+                compare_results(cur, conn, query)
+                continue
+            routed = route_query(query, source)
+            print(routed)
             print("\n") 
-            execute_query(cur,conn,query)        
+            name = report_name(query, index)
+            if sink == 'unload':
+                unload_query(cur, conn, routed, '{}/{}/'.format(unload_prefix.rstrip('/'), name), role_arn)
+                continue
+            execute_query(cur,conn,routed, make_sink(sink, name, output_dir), itersize, name)        
         print("Executing validation of data load completed\n")
     except Exception as e:
-        print(e)
\ No newline at end of file
+        print(e)
+
+
+if __name__ == "__main__":
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    configure_from(config)
+    pool = get_pool(config, wlm_options(config)['bi_query_group'])
+    with pool.connection() as conn:
+        analyse_data(conn.cursor(), conn, **validation_options(config))
+    pool.close()
+    recorder.summary()
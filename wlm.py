@@ -0,0 +1,91 @@
+import json
+
+# automatic WLM queue priorities, highest first
+WLM_PRIORITIES = ['highest', 'high', 'normal', 'low', 'lowest']
+WLM_MODES = ['auto', 'manual']
+PARAMETER_GROUP_FAMILY = 'redshift-1.0'
+
+set_slot_count = "SET wlm_query_slot_count TO {};"
+
+
+def wlm_options(config):
+    """reads the [WLM] section of dwh.cfg; an empty parameter_group keeps the default parameter group"""
+    section = 'WLM'
+    options = {
+        'parameter_group': config.get(section, 'PARAMETER_GROUP', fallback=''),
+        'mode': config.get(section, 'WLM_MODE', fallback='auto'),
+        'etl_query_group': config.get(section, 'ETL_QUERY_GROUP', fallback='etl'),
+        'bi_query_group': config.get(section, 'BI_QUERY_GROUP', fallback='bi'),
+        'etl_priority': config.get(section, 'ETL_PRIORITY', fallback='high'),
+        'bi_priority': config.get(section, 'BI_PRIORITY', fallback='normal'),
+        'short_query_acceleration': config.getboolean(section, 'SHORT_QUERY_ACCELERATION', fallback=True),
+        'concurrency_scaling': config.getboolean(section, 'CONCURRENCY_SCALING', fallback=False),
+        'etl_slots': config.getint(section, 'ETL_SLOTS', fallback=4),
+        'bi_slots': config.getint(section, 'BI_SLOTS', fallback=4),
+        'etl_memory_percent': config.getint(section, 'ETL_MEMORY_PERCENT', fallback=60),
+        'bi_memory_percent': config.getint(section, 'BI_MEMORY_PERCENT', fallback=30),
+        'heavy_slot_count': config.getint(section, 'HEAVY_SLOT_COUNT', fallback=3),
+        'heavy_steps': [step.strip() for step in config.get(section, 'HEAVY_STEPS', fallback='').split(',')
+                        if step.strip()]}
+    if options['mode'] not in WLM_MODES:
+        raise ValueError('unknown wlm_mode {!r}, expected one of {}'.format(options['mode'], WLM_MODES))
+    for priority in ['etl_priority', 'bi_priority']:
+        if options[priority] not in WLM_PRIORITIES:
+            raise ValueError('unknown {} {!r}, expected one of {}'.format(priority, options[priority], WLM_PRIORITIES))
+    return options
+
+
+def wlm_configuration(options):
+    """returns the wlm_json_configuration queues: ETL, BI, the default queue and short query acceleration
+    Automatic WLM sizes memory and concurrency itself and only takes queue priorities;
+    manual WLM splits slots and memory between the queues.
+    """
+    scaling = 'auto' if options['concurrency_scaling'] else 'off'
+    if options['mode'] == 'auto':
+        queues = [{'query_group': [options['etl_query_group']], 'user_group': [], 'auto_wlm': True,
+                   'queue_type': 'auto', 'priority': options['etl_priority'], 'concurrency_scaling': 'off'},
+                  # dashboards are bursty, extra clusters absorb their peaks
+                  {'query_group': [options['bi_query_group']], 'user_group': [], 'auto_wlm': True,
+                   'queue_type': 'auto', 'priority': options['bi_priority'], 'concurrency_scaling': scaling},
+                  {'auto_wlm': True, 'queue_type': 'auto', 'priority': 'normal'}]
+    else:
+        default_memory = 100 - options['etl_memory_percent'] - options['bi_memory_percent']
+        if default_memory < 1:
+            raise ValueError('etl_memory_percent and bi_memory_percent leave no memory for the default queue')
+        queues = [{'query_group': [options['etl_query_group']], 'user_group': [],
+                   'query_concurrency': options['etl_slots'], 'memory_percent_to_use': options['etl_memory_percent'],
+                   'concurrency_scaling': 'off'},
+                  {'query_group': [options['bi_query_group']], 'user_group': [],
+                   'query_concurrency': options['bi_slots'], 'memory_percent_to_use': options['bi_memory_percent'],
+                   'concurrency_scaling': scaling},
+                  {'query_concurrency': 5, 'memory_percent_to_use': default_memory}]
+    if options['short_query_acceleration']:
+        queues.append({'short_query_queue': True})
+    return queues
+
+
+def wlm_parameters(options):
+    """returns the cluster parameters of the WLM parameter group"""
+    return [{'ParameterName': 'wlm_json_configuration',
+             'ParameterValue': json.dumps(wlm_configuration(options), sort_keys=True)}]
+
+
+def step_slots(name, options):
+    """returns the WLM slots a step claims: heavy_slot_count for heavy_steps under manual WLM, 1 otherwise
+    Automatic WLM ignores wlm_query_slot_count and sizes each query's memory from its plan.
+    """
+    if options['mode'] == 'manual' and name in options['heavy_steps']:
+        return options['heavy_slot_count']
+    return 1
+
+
+def run_with_slots(cur, slots, execute):
+    """runs execute() with wlm_query_slot_count raised to slots, so the step gets more memory and spills less
+    The SET is part of the caller's transaction: a failed step is rolled back together with it.
+    """
+    if slots <= 1:
+        return execute()
+    cur.execute(set_slot_count.format(slots))
+    result = execute()
+    cur.execute(set_slot_count.format(1))
+    return result